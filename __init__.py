@@ -1,65 +1,206 @@
-from data_mining.data_sources import TibberAPI, SensiboSensor, WeatherAPI
-import zipfile
-from datetime import datetime, timedelta
+from data_mining.data_sources import TibberAPI, TibberRealtimeSensor, SensiboSensor, WeatherAPI, SpotMarketAPI
+from data_mining.data_sources.http_client import AsyncHTTPClient
+from data_mining.data_sources.resilience import Resilience
+from data_mining.backup import run_backup
+from data_mining.scheduler import Scheduler
+from data_mining.metrics import METRICS, start_metrics_server, write_stats_file
+from data_mining.storage import StorageWriter, SQLiteSink
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import time
 import pytz
-from pathlib import Path
 import logging
 import atexit
 import asyncio
-import nest_asyncio
-nest_asyncio.apply()
 
 
 LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
 DEFAULT = {
+    "metadata_ttl": 24*60*60,
     "sampling_time": 60*60,
     "end_mining_at": None,
     "end_backup_at": None,
-    "max_backup_copies": 5
+    "max_backup_copies": 5,
+    "backup_compression_level": 6,
+    "backup_executor": 'thread',
+    "expected_backup_duration": 5*60,
+    "request_timeout": 10,
+    "max_concurrency": 8,
+    "retention_rows": None,
+    "retention_seconds": 7*24*60*60,
+    "storage_format": 'segment',
+    "backfill": False,
+    "max_backfill_days": 7,
+    "rollups": True,
+    "stagger": 5,
+    "missed_tick_policy": 'skip',
+    "lag_warning": 10,
+    "realtime_raw_interval": 1,
+    "realtime_aggregate_interval": 60,
+    "realtime_batch_size": 500,
+    "realtime_flush_interval": 10,
+    "spot_price_zones": ['Tr.heim'],
+    "spot_price_currency": 'NOK',
+    "log_file": "datamining_errors.log",
+    "log_level": 'DEBUG',
+    "metrics_host": '127.0.0.1',
+    "metrics_port": None,           # e.g. 9108, None = no http endpoint
+    "stats_file": None,             # e.g. 'data/stats.json', None = no stats file
+    "stats_interval": 60,           # [seconds]
+    "compaction": {
+        "enabled": True,
+        "offset": 2*60*60,          # [seconds] after local midnight
+        "settle_time": 60*60        # [seconds]
+    },
+    "sqlite": {
+        "enabled": False,
+        "path": 'datamining.sqlite',
+        "synchronous": 'NORMAL'     # 'OFF' | 'NORMAL' | 'FULL', fsync per batch (FULL) or per checkpoint (NORMAL)
+    },
+    "writer": {
+        "enabled": True,            # False = every sensor writes its rows on the event loop
+        "max_pending_rows": 10000,  # submitting sensors wait while this many rows are queued
+        "max_batch_rows": 2000,
+        "flush_interval": 1         # [seconds]
+    },
+    "resilience": {
+        "rate": 5,                  # [requests/second]
+        "burst": 10,
+        "max_retries": 3,
+        "backoff_base": 1,          # [seconds]
+        "backoff_max": 30,          # [seconds]
+        "failure_threshold": 5,
+        "reset_timeout": 60         # [seconds]
+    }
 }
 
+
+def _initialize_source(source_class, source_params):
+    # Runs in a 'source-init' thread. Constructors only make blocking requests (Sensibo pods, Nord Pool);
+    # clients bound to an event loop (pyTibber) are set up when mining starts, on the mining loop.
+    return source_class(**source_params)
+
+
 class DataMiner():
     '''
     Data Mining module
     ==================
     Saves data from:
     * TibberAPI
+    * Tibber real-time (Pulse) stream
     * Sensibo
     * Open Weather Map API
+    * Nord Pool spot prices
 
-    Stores in files as pickle format.
+    Stores every sample in an append-only segment log per sensor (see data_mining.storage), written by one
+    background writer shared by all sensors (StorageWriter, params['writer']).
 
     Backups are by default ran once every day at midnight, as well as whenever the program exits.
+    They are incremental (see data_mining.backup), only new data is stored.
+
+    Stage durations, successes, failures and retries of every source and the backups are collected in
+    data_mining.metrics, served at http://<host>:<port>/metrics and/or written to a stats file (params['metrics']).
     '''
     def __init__(self, params={}):
-        logging.basicConfig(filename="datamining_errors.log",
-                            format='%(asctime)s %(message)s', level=logging.DEBUG)
+        self._configure_logging(params.get('logging', {}))
+        metrics = params.get('metrics', {})
+        self.metrics_host = metrics.get('host', DEFAULT["metrics_host"])
+        self.metrics_port = metrics.get('port', DEFAULT["metrics_port"])
+        self.stats_file = metrics.get('stats_file', DEFAULT["stats_file"])
+        self.stats_interval = metrics.get('stats_interval', DEFAULT["stats_interval"])
+        self.storage_format = params.get('storage', {}).get('format', DEFAULT["storage_format"])
+        self.max_backup_copies = DEFAULT["max_backup_copies"]
+        self.backup_compression_level = DEFAULT["backup_compression_level"]
+        self.backup_executor = DEFAULT["backup_executor"]
+        self.expected_backup_duration = DEFAULT["expected_backup_duration"]
+        self._backup_pool = None
         atexit.register(self._backup, object_to_backup='data', backup_folder='backups')
         self._mining_coroutines = []
-        # Initialize all sensors which has been provided an API key
+        # One scheduler drives all sources and the backups, sources are staggered by DEFAULT["stagger"] seconds
+        self.scheduler = Scheduler(
+            clock=params.get('scheduler', {}).get('clock'),
+            lag_warning=params.get('scheduler', {}).get('lag_warning', DEFAULT["lag_warning"])
+        )
+        self._stagger = params.get('scheduler', {}).get('stagger', DEFAULT["stagger"])
+        # One background writer stage shared by all sources, group-committing their rows
+        writer_settings = {**DEFAULT["writer"], **params.get('writer', {})}
+        self.writer = StorageWriter(
+            max_pending_rows=writer_settings['max_pending_rows'],
+            max_batch_rows=writer_settings['max_batch_rows'],
+            flush_interval=writer_settings['flush_interval']
+        ) if writer_settings['enabled'] else None
+        # Optional SQLite database receiving every stored row, for concurrent analysis processes
+        sqlite_settings = {**DEFAULT["sqlite"], **params.get('sqlite', {})}
+        self.sink = None
+        if sqlite_settings['enabled']:
+            try:
+                self.sink = SQLiteSink(sqlite_settings['path'], synchronous=sqlite_settings['synchronous'])
+            except Exception as e:
+                logging.error(f"SQLite sink {sqlite_settings['path']} could not be opened: " + str(e))
+                print(f"SQLite sink {sqlite_settings['path']} could not be opened: " + str(e))
+        # One pooled keep-alive http session shared by all sources
+        self.http_client = AsyncHTTPClient(timeout=DEFAULT["request_timeout"])
+        # Initialize all sensors which has been provided an API key (built concurrently, see _initialize_sources)
+        self._pending_sources = []
+        self._sources = []
         try:
             tibber = params['tibber']
             sampling_time = tibber.get('sampling_time', DEFAULT["sampling_time"])
             end_mining_at = tibber.get('end_mining_at', DEFAULT["end_mining_at"])
-            self.tibberAPI = TibberAPI(
+            max_concurrency = tibber.get('max_concurrency', DEFAULT["max_concurrency"])
+            self._add_source('tibberAPI', TibberAPI,
                     api_key = tibber['api_key'],
                     sampling_time = sampling_time,
-                    end_mining_at = params['tibber']['end_mining_at']
+                    end_mining_at = end_mining_at,
+                    max_concurrency = max_concurrency,
+                    resilience = self._resilience('tibber', tibber),
+                    metadata_ttl = tibber.get('metadata_ttl', DEFAULT["metadata_ttl"]),
+                    **self._sensor_options(tibber)
                 )
-            self._mining_coroutines.append(self.tibberAPI.start_mining())
         except:
             print("Tibber api_key not found in parameters. Will not include tibber in data mining.")
 
+        try:
+            tibber_realtime = params['tibber_realtime']
+            self._add_source('tibberRealtimeSensor', TibberRealtimeSensor,
+                    api_key = tibber_realtime['api_key'],
+                    end_mining_at = tibber_realtime.get('end_mining_at', DEFAULT["end_mining_at"]),
+                    home_ids = tibber_realtime.get('home_ids'),
+                    websocket_url = tibber_realtime.get('websocket_url'),
+                    http_client = self.http_client,
+                    raw_interval = tibber_realtime.get('raw_interval', DEFAULT["realtime_raw_interval"]),
+                    aggregate_interval = tibber_realtime.get('aggregate_interval', DEFAULT["realtime_aggregate_interval"]),
+                    batch_size = tibber_realtime.get('batch_size', DEFAULT["realtime_batch_size"]),
+                    flush_interval = tibber_realtime.get('flush_interval', DEFAULT["realtime_flush_interval"]),
+                    resilience = self._resilience('tibber_realtime', tibber_realtime),
+                    metadata_ttl = tibber_realtime.get('metadata_ttl', DEFAULT["metadata_ttl"]),
+                    **self._sensor_options(tibber_realtime)
+                )
+        except:
+            print("Tibber realtime api_key not found in parameters. Will not include tibber realtime in data mining.")
+
         try:
             sensibo = params['sensibo']
             sampling_time = sensibo.get('sampling_time', DEFAULT["sampling_time"])
             end_mining_at = sensibo.get('end_mining_at', DEFAULT["end_mining_at"])
-            self.sensiboSensor = SensiboSensor(
+            request_timeout = sensibo.get('request_timeout', DEFAULT["request_timeout"])
+            max_concurrency = sensibo.get('max_concurrency', DEFAULT["max_concurrency"])
+            deduplicate = sensibo.get('deduplicate', True)
+            adaptive_polling = sensibo.get('adaptive_polling', False)
+            self._add_source('sensiboSensor', SensiboSensor,
                     api_key = sensibo['api_key'],
                     sampling_time = sampling_time,
-                    end_mining_at = end_mining_at
+                    end_mining_at = end_mining_at,
+                    http_client = self.http_client,
+                    request_timeout = request_timeout,
+                    max_concurrency = max_concurrency,
+                    deduplicate = deduplicate,
+                    adaptive_polling = adaptive_polling,
+                    resilience = self._resilience('sensibo', sensibo),
+                    server = sensibo.get('server'),
+                    metadata_ttl = sensibo.get('metadata_ttl', DEFAULT["metadata_ttl"]),
+                    **self._sensor_options(sensibo)
                 )
-            self._mining_coroutines.append(self.sensiboSensor.start_mining())
         except:
             print("Sensibo api_key not found in parameters. Will not include sensibo in data mining.")
 
@@ -67,23 +208,65 @@ class DataMiner():
             weather = params['weather']
             sampling_time = weather.get('sampling_time', DEFAULT["sampling_time"])
             end_mining_at = weather.get('end_mining_at', DEFAULT["end_mining_at"])
-            self.weatherAPI = WeatherAPI(
+            request_timeout = weather.get('request_timeout', DEFAULT["request_timeout"])
+            max_concurrency = weather.get('max_concurrency', DEFAULT["max_concurrency"])
+            if 'locations' not in weather and ('lat' not in weather or 'lon' not in weather):
+                raise KeyError('lat/lon')
+            self._add_source('weatherAPI', WeatherAPI,
                     api_key = params['weather']['api_key'], 
                     sampling_time = sampling_time,
                     end_mining_at = end_mining_at,
-                    lat = params['weather']['lat'],
-                    lon = params['weather']['lon']
+                    http_client = self.http_client,
+                    request_timeout = request_timeout,
+                    lat = weather.get('lat'),
+                    lon = weather.get('lon'),
+                    locations = weather.get('locations'),
+                    max_concurrency = max_concurrency,
+                    resilience = self._resilience('weather', weather),
+                    url = weather.get('url'),
+                    **self._sensor_options(weather)
                 )
-            self._mining_coroutines.append(self.weatherAPI.start_mining())
         except:
             print("Weather api_key, latiture or longitude not found in parameters. Will not include sensibo in data mining.")
 
+        try:
+            spotmarket = params['spotmarket']
+            sampling_time = spotmarket.get('sampling_time', DEFAULT["sampling_time"])
+            end_mining_at = spotmarket.get('end_mining_at', DEFAULT["end_mining_at"])
+            request_timeout = spotmarket.get('request_timeout', DEFAULT["request_timeout"])
+            self._add_source('spotMarketAPI', SpotMarketAPI,
+                    sampling_time = sampling_time,
+                    end_mining_at = end_mining_at,
+                    zones = spotmarket.get('zones', DEFAULT["spot_price_zones"]),
+                    currency = spotmarket.get('currency', DEFAULT["spot_price_currency"]),
+                    request_timeout = request_timeout,
+                    resilience = self._resilience('spotmarket', spotmarket),
+                    **self._sensor_options(spotmarket)
+                )
+        except KeyError:
+            print("Spot market parameters not found. Will not include spot prices in data mining.")
+        except Exception as e:
+            logging.error("Spot market: could not be initialized: " + str(e))
+            print("Spot market: could not be initialized: " + str(e))
+
+        self._initialize_sources()
+
+        # Daily compaction of the per-session files of closed days
+        compaction_settings = {**DEFAULT["compaction"], **params.get('compaction', {})}
+        self.run_compaction = compaction_settings['enabled']
+        self.compaction_offset = compaction_settings['offset']
+        self.compaction_settle_time = compaction_settings['settle_time']
+
         # Backups parameters
         self.end_backup_time = DEFAULT["end_backup_at"]
         try:
             backup_params = params['backup']
             self.run_backups = backup_params.get('run_backups', False)
             self.end_backup_time = backup_params.get('end_backups_at', DEFAULT["end_backup_at"])
+            self.max_backup_copies = backup_params.get('max_backup_copies', DEFAULT["max_backup_copies"])
+            self.backup_compression_level = backup_params.get('compression_level', DEFAULT["backup_compression_level"])
+            self.backup_executor = backup_params.get('executor', DEFAULT["backup_executor"])
+            self.expected_backup_duration = backup_params.get('expected_duration', DEFAULT["expected_backup_duration"])
         except:
             self.run_backups = True
             print("Backup parameters not found, running with default backup params: run_backups=True, end_backup_at=None")
@@ -92,14 +275,104 @@ class DataMiner():
 
 
     def start(self):
+        # Allows start() where an event loop is already running (e.g. in a notebook)
+        import nest_asyncio
+        nest_asyncio.apply()
         asyncio.run(self._async_start())
         return
 
+    def _add_source(self, attribute, source_class, **source_params):
+        self._pending_sources.append((attribute, source_class, source_params))
+
+    def _initialize_sources(self):
+        '''
+        Builds the configured sources at the same time: their constructors wait for api round-trips
+        (account, homes and devices, unless cached), which would otherwise add up.
+        '''
+        if not self._pending_sources:
+            return
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(self._pending_sources), thread_name_prefix='source-init') as executor:
+            futures = [executor.submit(_initialize_source, source_class, source_params)
+                       for _, source_class, source_params in self._pending_sources]
+        for (attribute, source_class, _), future in zip(self._pending_sources, futures):
+            try:
+                source = future.result()
+            except Exception as e:
+                logging.error(f"{source_class.__name__} could not be initialized: " + str(e))
+                print(f"{source_class.__name__} could not be initialized: " + str(e))
+                continue
+            setattr(self, attribute, source)
+            self._sources.append(source)
+            self._mining_coroutines.append(source.start_mining(self.scheduler))
+        self._pending_sources = []
+        METRICS.set('datamining_startup_seconds', time.monotonic() - started)
+        print(f"Sources initialized in {time.monotonic() - started:.2f} s")
+
+    def _sensor_options(self, source_params):
+        '''
+        Options shared by all sensors (see data_sources.Sensor)
+        '''
+        return {
+            'retention_rows': source_params.get('retention_rows', DEFAULT["retention_rows"]),
+            'retention_seconds': source_params.get('retention_seconds', DEFAULT["retention_seconds"]),
+            'storage_format': self.storage_format,
+            'backfill': source_params.get('backfill', DEFAULT["backfill"]),
+            'max_backfill_days': source_params.get('max_backfill_days', DEFAULT["max_backfill_days"]),
+            'schedule_offset': source_params.get('schedule_offset', self._stagger*len(self._pending_sources)),
+            'missed_tick_policy': source_params.get('missed_tick_policy', DEFAULT["missed_tick_policy"]),
+            'rollups': source_params.get('rollups', DEFAULT["rollups"]),
+            'writer': self.writer,
+            'sink': self.sink
+        }
+
+    def _configure_logging(self, logging_params):
+        '''
+        Configures the root logger once for the whole process (the sources only log through it)
+        '''
+        logging.basicConfig(filename=logging_params.get('file', DEFAULT["log_file"]),
+                            format='%(asctime)s %(message)s',
+                            level=getattr(logging, logging_params.get('level', DEFAULT["log_level"])))
+
+    def _resilience(self, source_name, source_params):
+        '''
+        Rate limit, retry and circuit breaker policy of one source, params[<source>]['resilience'] overrides the defaults
+        '''
+        settings = {**DEFAULT["resilience"], **source_params.get('resilience', {})}
+        return Resilience(source_name, **settings)
+
     async def _async_start(self):
-        await asyncio.gather(
-            *self._mining_coroutines,
-            self._async_backup_data()
-        )
+        metrics_server = await self._start_metrics_server()
+        stats_writer = asyncio.ensure_future(self._write_stats_periodically()) if self.stats_file else None
+        compaction = asyncio.ensure_future(self._compact_periodically()) if self.run_compaction else None
+        try:
+            await asyncio.gather(
+                *self._mining_coroutines,
+                self._async_backup_data()
+            )
+        finally:
+            # The sources flushed their rows when they stopped, this waits for the last batch
+            if self.writer is not None:
+                await self.writer.close()
+            if self._backup_pool is not None:
+                self._backup_pool.shutdown(wait=True)
+                self._backup_pool = None
+            if self.sink is not None:
+                self.sink.close()
+            await self.http_client.close()
+            if compaction is not None:
+                compaction.cancel()
+            if stats_writer is not None:
+                stats_writer.cancel()
+                self._write_stats_file()
+            if metrics_server is not None:
+                metrics_server.close()
+                await metrics_server.wait_closed()
+        for name, stats in self.scheduling_stats().items():
+            message = (f"SCHEDULER | {name} | runs: {stats['runs']}, failures: {stats['failures']}, missed ticks: {stats['missed_ticks']}, "
+                       f"lag mean/max: {stats['mean_lag']:.2f}/{stats['max_lag']:.2f} s")
+            logging.info(message)
+            print(message)
         print("Mining stopped.")
         return
 
@@ -107,76 +380,133 @@ class DataMiner():
         if self.run_backups == False:
             return
 
-        scheduled_time = self._get_midnight_time()
+        # A 24 hour job on the scheduler's grid runs at every local midnight
+        scheduled_time = self.scheduler.first_tick(24*60*60)
         end_backup_time = self.end_backup_time if self.end_backup_time else "Never"
         print(f"Backups started | next backup: {scheduled_time} | ending: {end_backup_time}")
-        
-        while self.end_backup_time is None or scheduled_time < self.end_backup_time:
-            time_now = datetime.now(tz=LOCAL_TIMEZONE)
-            time_until_backup = (scheduled_time - time_now).total_seconds()
-            if time_until_backup > 0:
-                await asyncio.sleep(time_until_backup)
-            
-            backup_success = self._backup('data', backup_folder='backups')
-            success_message = ""
-            if backup_success:
-                success_message += f"BACKUP | {scheduled_time} | Success: backuped files in /backups/"
-            
-            scheduled_time += timedelta(hours=24)
-            
-            if success_message:
-                message = f"{success_message} | Next backup at: {scheduled_time}"
+        await self.scheduler.run_job(
+            'backup', 24*60*60, self._scheduled_backup, missed_tick_policy='coalesce', end_at=self.end_backup_time)
+        return
+
+    async def _compact_periodically(self):
+        # A 24 hour job, compaction["offset"] after local midnight so the late rows of yesterday have settled
+        await self.scheduler.run_job('compaction', 24*60*60, self._scheduled_compaction,
+                                     offset=self.compaction_offset, missed_tick_policy='coalesce')
+
+    async def _scheduled_compaction(self, scheduled_time):
+        loop = asyncio.get_running_loop()
+        compaction_success = True
+        for source in self._sources:
+            try:
+                with METRICS.timer('datamining_stage_duration_seconds', source=source.sensor_name, stage='compaction'):
+                    stats = await loop.run_in_executor(None, source.compact_storage, self.compaction_settle_time)
+            except Exception as e:
+                logging.error(f"COMPACTION | {source.sensor_name} | failed: " + str(e))
+                print(f"COMPACTION | {source.sensor_name} | failed: " + str(e))
+                compaction_success = False
+                continue
+            if stats['files']:
+                message = (f"COMPACTION | {scheduled_time} | {source.sensor_name} | merged {stats['files']} files into "
+                           f"{stats['days']} days, {stats['duplicates']} duplicates removed")
                 logging.info(message)
                 print(message)
-        return
+        return compaction_success
 
-    def _backup(self, object_to_backup, backup_folder):
-        # settings
-        max_backup_copies = DEFAULT["max_backup_copies"]
-
-        # Setup paths and folder
-        object_to_backup_path = Path(object_to_backup)
-        backup_directory_path = Path(backup_folder)
-        if not object_to_backup_path.exists():
-            print("Backup: object does not exist")
+    async def _start_metrics_server(self):
+        if self.metrics_port is None:
+            return None
+        try:
+            return await start_metrics_server(METRICS, self.metrics_host, self.metrics_port)
+        except Exception as e:
+            logging.error(f"Metrics endpoint could not be started on {self.metrics_host}:{self.metrics_port}: " + str(e))
+            print(f"Metrics endpoint could not be started on {self.metrics_host}:{self.metrics_port}: " + str(e))
+            return None
+
+    async def _write_stats_periodically(self):
+        await self.scheduler.run_job('stats_file', self.stats_interval, self._scheduled_stats_file)
+
+    async def _scheduled_stats_file(self, scheduled_time):
+        return self._write_stats_file()
+
+    def _write_stats_file(self):
+        try:
+            write_stats_file(self.stats_file, METRICS)
+        except Exception as e:
+            logging.error(f"Stats file {self.stats_file} could not be written: " + str(e))
+            print(f"Stats file {self.stats_file} could not be written: " + str(e))
             return False
-        backup_directory_path.mkdir(parents=True, exist_ok=True)
-
-        # check how many existing backups exist
-        existing_backups = [
-            x for x in backup_directory_path.iterdir()
-            if x.is_file() and x.suffix == '.zip' and x.name.startswith('data_backup')
-        ]
-
-        # Enforce max backups and delete oldest if there will be too many after the new backup
-        oldest_to_newest_backup_by_name = list(sorted(existing_backups, key=lambda f: f.name))
-        while len(oldest_to_newest_backup_by_name) >= max_backup_copies:  # >= because we will have another soon
-            backup_to_delete = oldest_to_newest_backup_by_name.pop(0)
-            backup_to_delete.unlink()
-
-        # Create zip file (for both file and folder options)
-        backup_file_name = f'{object_to_backup_path.name}_backup__{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.zip'
-        zip_file = zipfile.ZipFile(str(backup_directory_path / backup_file_name), mode='w')
-        if object_to_backup_path.is_file():
-            # If the object to write is a file, write the file
-            zip_file.write(
-                object_to_backup_path.absolute(),
-                arcname=object_to_backup_path.name,
-                compress_type=zipfile.ZIP_DEFLATED
-            )
-        elif object_to_backup_path.is_dir():
-            # If the object to write is a directory, write all the files
-            for file in object_to_backup_path.glob('**/*'):
-                if file.is_file():
-                    zip_file.write(
-                        file.absolute(),
-                        arcname=str(file.relative_to(object_to_backup_path)),
-                        compress_type=zipfile.ZIP_DEFLATED
-                    )
-        zip_file.close()
         return True
-    
-    def _get_midnight_time(self):
-        time_now = datetime.now(tz=LOCAL_TIMEZONE)
-        midnight = time_now.replace(microsecond=0, second=0, minute=0, hour=0, day=time_now.day+1)
-        return midnight
+
+    def metrics(self):
+        '''
+        Counters, gauges and stage durations of all sources and the backups (see data_mining.metrics)
+        '''
+        return METRICS.snapshot()
+
+    async def _scheduled_backup(self, scheduled_time):
+        with METRICS.timer('datamining_stage_duration_seconds', source='backup', stage='backup'):
+            backup_success = await self._async_backup('data', backup_folder='backups')
+        METRICS.inc('datamining_backups_total', result='success' if backup_success else 'failure')
+        if backup_success:
+            message = f"BACKUP | {scheduled_time} | Success: backuped files in /backups/snapshots/"
+            logging.info(message)
+            print(message)
+        return backup_success
+
+    def scheduling_stats(self):
+        '''
+        Runs, failures, missed ticks and scheduling lag [seconds] per sensor and for the backups
+        '''
+        return self.scheduler.stats()
+
+    async def _async_backup(self, object_to_backup, backup_folder):
+        '''
+        Runs the backup in a worker thread (or process, params['backup']['executor'] = 'process'),
+        so the mining schedule keeps running while files are compressed.
+        '''
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        future = loop.run_in_executor(
+            self._get_backup_pool(), run_backup, object_to_backup, backup_folder,
+            self.max_backup_copies, self.backup_compression_level)
+        done, _ = await asyncio.wait({future}, timeout=self.expected_backup_duration)
+        if not done:
+            message = f"BACKUP | still running after {self.expected_backup_duration} s, slower than expected"
+            logging.warning(message)
+            print(message)
+        try:
+            manifest = await future
+        except Exception as e:
+            logging.error("Backup: something went wrong while backing up. " + str(e))
+            print("Backup: something went wrong while backing up. " + str(e))
+            return False
+        duration = time.monotonic() - started
+        if duration > self.expected_backup_duration:
+            logging.warning(f"BACKUP | took {duration:.0f} s, expected at most {self.expected_backup_duration} s")
+        return manifest is not None
+
+    def _get_backup_pool(self):
+        # One worker for every backup of the run, shut down when mining stops. The process is spawned, not forked:
+        # a fork would copy the mining loop's threads and locks (storage writer, SQLite sink) in whatever state they are
+        if self._backup_pool is None:
+            if self.backup_executor == 'process':
+                self._backup_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._backup_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+        return self._backup_pool
+
+    def _backup(self, object_to_backup, backup_folder):
+        # Incremental: only chunks that are not already in an earlier snapshot are stored
+        try:
+            with METRICS.timer('datamining_stage_duration_seconds', source='backup', stage='backup'):
+                manifest = run_backup(
+                    object_to_backup, backup_folder, self.max_backup_copies, self.backup_compression_level)
+        except Exception as e:
+            METRICS.inc('datamining_backups_total', result='failure')
+            logging.error("Backup: something went wrong while backing up. " + str(e))
+            print("Backup: something went wrong while backing up. " + str(e))
+            return False
+        METRICS.inc('datamining_backups_total', result='success' if manifest is not None else 'failure')
+        if self.stats_file:
+            self._write_stats_file()
+        return manifest is not None
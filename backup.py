@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+CHUNK_SIZE = 1024*1024  # [bytes]
+SNAPSHOT_PREFIX = 'data_backup__'
+
+
+class BackupStore():
+    '''
+    Incremental backups
+    ===================
+    Content addressed, deduplicated backups of a file or folder:
+
+        backups/chunks/<ab>/<sha256>                          zlib compressed chunk
+        backups/snapshots/data_backup__<Y-m-d-H-M-S>.json     manifest: file -> size, mtime, chunk hashes
+
+    Files are split into fixed size chunks, which fits the append-only data files: appending to a file
+    only adds new chunks. A chunk is only stored if no earlier snapshot has it, and files whose size and
+    modification time did not change since the last snapshot are not even read.
+
+    Every manifest allows a full restore on its own. Retention keeps the newest max_copies snapshots and
+    deletes the chunks no remaining snapshot refers to.
+    '''
+    def __init__(self, backup_folder='backups', chunk_size=CHUNK_SIZE, compression_level=6):
+        self.backup_folder = Path(backup_folder)
+        self.chunk_folder = self.backup_folder / 'chunks'
+        self.snapshot_folder = self.backup_folder / 'snapshots'
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+
+    def snapshot(self, object_to_backup, max_copies=None, progress=None):
+        '''
+        Backs up a file or a folder. Returns the path of the new manifest, or None if there was nothing to back up.
+        progress: optional callable(files_done, files_total, bytes_read), called after every file
+        '''
+        source = Path(object_to_backup)
+        if not source.exists():
+            print("Backup: object does not exist")
+            return None
+        self.chunk_folder.mkdir(parents=True, exist_ok=True)
+        self.snapshot_folder.mkdir(parents=True, exist_ok=True)
+
+        previous_files = self._latest_manifest().get('files', {})
+        if source.is_file():
+            files = {source.name: source}
+        else:
+            files = {str(f.relative_to(source)): f for f in sorted(source.glob('**/*')) if f.is_file()}
+
+        manifest = {'created': datetime.now().isoformat(), 'source': str(source), 'files': {}}
+        stats = {'new_chunks': 0, 'reused_files': 0, 'bytes_read': 0}
+        for files_done, (name, path) in enumerate(files.items(), start=1):
+            if progress:
+                progress(files_done - 1, len(files), stats['bytes_read'])
+            try:
+                stat = path.stat()
+                previous = previous_files.get(name)
+                if previous and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime:
+                    manifest['files'][name] = previous
+                    stats['reused_files'] += 1
+                    continue
+                chunks, new_chunks = self._store_file(path)
+                manifest['files'][name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'chunks': chunks}
+                stats['new_chunks'] += new_chunks
+                stats['bytes_read'] += stat.st_size
+            except FileNotFoundError:
+                continue  # removed while backing up (e.g. a sealed segment)
+
+        if progress:
+            progress(len(files), len(files), stats['bytes_read'])
+        manifest_path = self._write_manifest(manifest)
+        if max_copies:
+            self.enforce_retention(max_copies)
+        logging.info(f"Backup: {manifest_path.name} | {len(files)} files, {stats['reused_files']} unchanged, {stats['new_chunks']} new chunks")
+        return manifest_path
+
+    def snapshots(self):
+        ''' Manifests, oldest first '''
+        if not self.snapshot_folder.exists():
+            return []
+        return sorted(self.snapshot_folder.glob(f'{SNAPSHOT_PREFIX}*.json'))
+
+    def restore(self, target, snapshot=None):
+        '''
+        Restores every file of a snapshot (default: the newest) into the target folder.
+        '''
+        manifest_path = Path(snapshot) if snapshot else self.snapshots()[-1]
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        target = Path(target)
+        for name, entry in manifest['files'].items():
+            path = target / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as f:
+                for digest in entry['chunks']:
+                    f.write(self._read_chunk(digest))
+        return len(manifest['files'])
+
+    def enforce_retention(self, max_copies):
+        '''
+        Deletes the oldest snapshots beyond max_copies and every chunk that is no longer referenced.
+        '''
+        snapshots = self.snapshots()
+        for manifest_path in snapshots[:max(len(snapshots) - max_copies, 0)]:
+            manifest_path.unlink()
+
+        referenced = set()
+        for manifest_path in self.snapshots():
+            with open(manifest_path) as f:
+                for entry in json.load(f)['files'].values():
+                    referenced.update(entry['chunks'])
+        removed = 0
+        for chunk_path in self.chunk_folder.glob('*/*'):
+            if chunk_path.name not in referenced:
+                chunk_path.unlink()
+                removed += 1
+        return removed
+
+    def _store_file(self, path):
+        # Streams the file one chunk at a time, so memory use does not depend on the file size
+        chunks = []
+        new_chunks = 0
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                chunk_path = self._chunk_path(digest)
+                if not chunk_path.exists():
+                    chunk_path.parent.mkdir(exist_ok=True)
+                    temporary_path = chunk_path.with_suffix('.tmp')
+                    with open(temporary_path, 'wb') as chunk_file:
+                        chunk_file.write(zlib.compress(data, self.compression_level))
+                    os.replace(temporary_path, chunk_path)
+                    new_chunks += 1
+                chunks.append(digest)
+        return chunks, new_chunks
+
+    def _read_chunk(self, digest):
+        with open(self._chunk_path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Backup: chunk {digest} is corrupt")
+        return data
+
+    def _chunk_path(self, digest):
+        return self.chunk_folder / digest[:2] / digest
+
+    def _latest_manifest(self):
+        snapshots = self.snapshots()
+        if not snapshots:
+            return {}
+        with open(snapshots[-1]) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        name = f'{SNAPSHOT_PREFIX}{datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")}.json'
+        manifest_path = self.snapshot_folder / name
+        temporary_path = manifest_path.with_suffix('.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temporary_path, manifest_path)
+        return manifest_path
+
+
+class BackupProgress():
+    '''
+    Logs the progress of a backup at most once every `interval` seconds.
+    Picklable, so it can be handed to a worker process together with run_backup().
+    '''
+    def __init__(self, interval=10):
+        self.interval = interval
+        self._started = None
+        self._last_report = None
+
+    def __call__(self, files_done, files_total, bytes_read):
+        now = time.monotonic()
+        if self._started is None:
+            self._started = self._last_report = now
+        if now - self._last_report < self.interval and files_done < files_total:
+            return
+        self._last_report = now
+        message = (f"BACKUP | progress: {files_done}/{files_total} files, "
+                   f"{bytes_read/1e6:.1f} MB read in {now - self._started:.0f} s")
+        logging.info(message)
+        print(message)
+
+
+def run_backup(object_to_backup, backup_folder, max_copies, compression_level=6, progress_interval=10):
+    '''
+    Entry point for running a backup in a worker thread or process (see DataMiner._async_backup).
+    Returns the path of the new manifest as a string, or None.
+    '''
+    manifest_path = BackupStore(backup_folder, compression_level=compression_level).snapshot(
+        object_to_backup, max_copies=max_copies, progress=BackupProgress(progress_interval))
+    return str(manifest_path) if manifest_path else None
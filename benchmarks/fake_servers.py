@@ -0,0 +1,196 @@
+import asyncio
+import json
+import math
+import random
+import threading
+from datetime import datetime, timezone
+
+from aiohttp import web, WSMsgType
+
+SENSIBO_PATH = '/api/v2'
+WEATHER_PATH = '/data/2.5/weather'
+TIBBER_PATH = '/v1-beta/gql/subscriptions'
+SENSIBO_UPDATE_INTERVAL = 90      # [seconds] virtual, like the real pods
+WEATHER_UPDATE_INTERVAL = 600     # [seconds] virtual
+
+
+class FakeUpstream():
+    '''
+    Fake upstream apis
+    ==================
+    Local stand-ins for the Sensibo, OpenWeatherMap and Tibber live measurement apis, served by one aiohttp
+    app on its own event loop in a background thread (so the blocking requests sent while sources are
+    initialized get an answer too).
+
+    Measurements are stamped with `clock` (e.g. the AcceleratedClock of the miner's scheduler), so an
+    accelerated miner sees new observations at the pace of virtual time.
+
+    Settings:
+        - latency: [seconds] (real) added to every response
+        - error_rate: share of the requests answered with a 503
+        - pods: number of Sensibo pods, homes: number of Tibber homes
+        - message_interval: [seconds] (real) between two live measurements of a home
+
+    upstream = FakeUpstream(clock, latency=0.02, error_rate=0.01, pods=20).start()
+    upstream.sensibo_url, upstream.weather_url, upstream.tibber_url
+    upstream.stop()
+    '''
+    def __init__(self, clock, latency=0.0, error_rate=0.0, pods=4, homes=1, message_interval=0.05,
+                 host='127.0.0.1', port=0, seed=None):
+        self.clock = clock
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pods = {f"Room {i}": f"pod{i:04d}" for i in range(pods)}
+        self.home_ids = [f"home-{i:04d}" for i in range(homes)]
+        self.message_interval = message_interval
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self.messages = 0
+        self._random = random.Random(seed)
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def sensibo_url(self):
+        return self.base_url + SENSIBO_PATH
+
+    @property
+    def weather_url(self):
+        return self.base_url + WEATHER_PATH
+
+    @property
+    def tibber_url(self):
+        return f"ws://{self.host}:{self.port}{TIBBER_PATH}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='fake-upstream', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors, 'messages': self.messages}
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._start_app())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _start_app(self):
+        app = web.Application()
+        app.router.add_get(SENSIBO_PATH + '/users/me/pods', self._sensibo_pods)
+        app.router.add_get(SENSIBO_PATH + '/pods/{pod}/measurements', self._sensibo_measurements)
+        app.router.add_get(SENSIBO_PATH + '/pods/{pod}/acStates', self._sensibo_ac_states)
+        app.router.add_get(SENSIBO_PATH + '/pods/{pod}/historicalMeasurements', self._sensibo_history)
+        app.router.add_get(WEATHER_PATH, self._weather)
+        app.router.add_get(TIBBER_PATH, self._tibber_websocket)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def _respond(self, body):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text='fake upstream error')
+        return web.json_response(body)
+
+    def _signal(self, key, period, mean, amplitude):
+        # A smooth daily curve per device, plus a little noise
+        phase = (hash(key) % 1000)/1000*2*math.pi
+        return mean + amplitude*math.sin(2*math.pi*self.clock.now()/period + phase) + self._random.gauss(0, amplitude/20)
+
+    async def _sensibo_pods(self, request):
+        return await self._respond({'result': [{'id': pod, 'room': {'name': room}} for room, pod in self.pods.items()]})
+
+    async def _sensibo_measurements(self, request):
+        pod = request.match_info['pod']
+        now = self.clock.now()
+        measured = now - now % SENSIBO_UPDATE_INTERVAL
+        return await self._respond({'result': [{
+            'time': {'time': datetime.fromtimestamp(measured, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                     'secondsAgo': int(now - measured)},
+            'temperature': round(self._signal(pod, 86400, 21, 2), 1),
+            'humidity': round(self._signal(pod + 'h', 86400, 40, 5), 1)
+        }]})
+
+    async def _sensibo_ac_states(self, request):
+        pod = request.match_info['pod']
+        return await self._respond({'result': [{'acState': {
+            'on': self._signal(pod, 86400, 0, 1) > 0,
+            'targetTemperature': 22,
+            'fanLevel': 'auto',
+            'mode': 'heat'
+        }}]})
+
+    async def _sensibo_history(self, request):
+        return await self._respond({'result': {'temperature': [], 'humidity': []}})
+
+    async def _weather(self, request):
+        key = request.query.get('lat', '') + request.query.get('lon', '')
+        now = self.clock.now()
+        return await self._respond({
+            'dt': int(now - now % WEATHER_UPDATE_INTERVAL),
+            'main': {'temp': round(self._signal(key, 86400, 5, 6), 2)}
+        })
+
+    async def _tibber_websocket(self, request):
+        ws = web.WebSocketResponse(protocols=['graphql-transport-ws'])
+        await ws.prepare(request)
+        streams = []
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    break
+                payload = json.loads(message.data)
+                if payload.get('type') == 'connection_init':
+                    await ws.send_json({'type': 'connection_ack'})
+                elif payload.get('type') == 'subscribe':
+                    streams.append(asyncio.ensure_future(self._stream_live_measurements(ws, payload['id'])))
+        finally:
+            for stream in streams:
+                stream.cancel()
+        return ws
+
+    async def _stream_live_measurements(self, ws, home_id):
+        accumulated = 0.0
+        previous = self.clock.now()
+        while not ws.closed:
+            await asyncio.sleep(self.message_interval)
+            if self.error_rate and self._random.random() < self.error_rate/10:
+                await ws.close()  # a dropped connection, the sensor reconnects
+                return
+            now = self.clock.now()
+            power = max(self._signal(home_id, 86400, 1500, 800), 0)
+            accumulated += power*(now - previous)/3600/1000
+            previous = now
+            self.messages += 1
+            await ws.send_json({'id': home_id, 'type': 'next', 'payload': {'data': {'liveMeasurement': {
+                'timestamp': datetime.fromtimestamp(now, tz=timezone.utc).isoformat(),
+                'power': round(power, 1),
+                'powerProduction': 0,
+                'accumulatedConsumption': round(accumulated, 3),
+                'accumulatedCost': round(accumulated*1.2, 3)
+            }}}})
@@ -0,0 +1,312 @@
+'''
+Benchmark / load test
+=====================
+Runs a DataMiner against local fake Sensibo, OpenWeatherMap and Tibber live measurement apis
+(benchmarks/fake_servers.py) in accelerated virtual time, and reports:
+    - throughput: rows written and samples taken per (real) second, per source
+    - memory growth: resident memory over the simulated period, per simulated day
+    - per-sample write cost: duration of the store stage per sample and per row
+    - backup duration: the nightly (virtual midnight) backups of the growing data folder
+    - scheduling lag, retries and failures
+
+    python -m data_mining.benchmarks.run_benchmark --days 14 --speed 7200 --pods 20 --locations 10
+    python -m data_mining.benchmarks.run_benchmark --days 2 --latency 0.05 --error-rate 0.05 --output report.json
+
+Everything runs in a temporary working directory (--workdir to choose one, --keep to keep it).
+Compare the reports of two trees to measure a storage or concurrency change.
+'''
+import argparse
+import asyncio
+import atexit
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from data_mining import DataMiner, DEFAULT
+from data_mining.benchmarks.fake_servers import FakeUpstream
+from data_mining.metrics import METRICS
+from data_mining.scheduler import AcceleratedClock, LOCAL_TIMEZONE
+
+PROBE_INTERVAL = 60*60  # [seconds] virtual, how often memory and progress are sampled
+
+
+def rss_bytes():
+    ''' Current resident memory of the process (peak memory where /proc is not available) '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak*1024
+
+
+def folder_size(folder):
+    return sum(f.stat().st_size for f in Path(folder).glob('**/*') if f.is_file())
+
+
+class Probe():
+    '''
+    Samples memory and rows written every PROBE_INTERVAL virtual seconds, as a job of the miner's scheduler.
+    '''
+    def __init__(self, clock):
+        self.clock = clock
+        self.started = time.monotonic()
+        self.samples = []
+
+    async def __call__(self, scheduled_time):
+        rows = sum(counter['value'] for counter in METRICS.snapshot()['counters']
+                   if counter['name'] == 'datamining_rows_written_total')
+        self.samples.append({
+            'virtual_time': self.clock.now(),
+            'real_seconds': time.monotonic() - self.started,
+            'rss': rss_bytes(),
+            'rows': rows
+        })
+        return True
+
+    def memory_growth_per_day(self):
+        # Slope of a linear fit, the first simulated day (imports, warm up of the buffers) is left out
+        if len(self.samples) < 2:
+            return 0.0
+        times = np.array([s['virtual_time'] for s in self.samples])
+        memory = np.array([s['rss'] for s in self.samples], dtype=np.float64)
+        keep = times >= times[0] + 24*60*60
+        if keep.sum() >= 2:
+            times, memory = times[keep], memory[keep]
+        return float(np.polyfit((times - times[0])/(24*60*60), memory, 1)[0])
+
+
+def scaled_resilience(speed):
+    '''
+    Rate limits, backoff and the circuit breaker work in real seconds: scaled by the speed up, they take
+    the same share of virtual time as they would of real time.
+    '''
+    settings = dict(DEFAULT["resilience"])
+    settings['rate'] = settings['rate']*speed if settings['rate'] else None
+    for name in ('backoff_base', 'backoff_max', 'reset_timeout'):
+        settings[name] = settings[name]/speed
+    return settings
+
+
+def build_params(args, upstream, clock, end):
+    resilience = scaled_resilience(args.speed)
+    params = {
+        'scheduler': {'clock': clock},
+        'backup': {'run_backups': not args.no_backup, 'end_backups_at': end},
+        'storage': {'format': args.storage_format},
+        'logging': {'level': 'WARNING'}
+    }
+    if args.pods:
+        params['sensibo'] = {
+            'api_key': 'benchmark',
+            'server': upstream.sensibo_url,
+            'sampling_time': args.sensibo_sampling_time,
+            'end_mining_at': end,
+            'max_concurrency': args.max_concurrency,
+            'retention_seconds': args.retention_seconds,
+            'resilience': resilience
+        }
+    if args.locations:
+        params['weather'] = {
+            'api_key': 'benchmark',
+            'url': upstream.weather_url,
+            'locations': [{'lat': round(58 + i*0.1, 3), 'lon': round(5 + i*0.1, 3)} for i in range(args.locations)],
+            'sampling_time': args.weather_sampling_time,
+            'end_mining_at': end,
+            'max_concurrency': args.max_concurrency,
+            'retention_seconds': args.retention_seconds,
+            'resilience': resilience
+        }
+    if args.homes:
+        params['tibber_realtime'] = {
+            'api_key': 'benchmark',
+            'home_ids': upstream.home_ids,
+            'websocket_url': upstream.tibber_url,
+            'end_mining_at': end,
+            'retention_seconds': args.retention_seconds
+        }
+    return params
+
+
+def histogram(snapshot, name, **labels):
+    for entry in snapshot['histograms']:
+        if entry['name'] == name and all(entry['labels'].get(k) == v for k, v in labels.items()):
+            return entry
+    return {'count': 0, 'sum': 0.0, 'max': 0.0, 'mean': 0.0}
+
+
+def counter(snapshot, name, **labels):
+    return sum(entry['value'] for entry in snapshot['counters']
+               if entry['name'] == name and all(entry['labels'].get(k) == v for k, v in labels.items()))
+
+
+def build_report(args, miner, upstream, probe, real_seconds, rss_start):
+    snapshot = METRICS.snapshot()
+    sources = sorted({entry['labels']['source'] for entry in snapshot['counters'] + snapshot['histograms']
+                      if 'source' in entry['labels'] and entry['labels']['source'] != 'backup'})
+    report = {
+        'settings': vars(args),
+        'simulated_days': args.days,
+        'real_seconds': real_seconds,
+        'achieved_speed': args.days*24*60*60/real_seconds if real_seconds else None,
+        'upstream': upstream.stats(),
+        'sources': {},
+        'backups': {},
+        'memory': {
+            'rss_start': rss_start,
+            'rss_end': rss_bytes(),
+            'rss_peak': max([s['rss'] for s in probe.samples] + [rss_start]),
+            'growth_per_simulated_day': probe.memory_growth_per_day()
+        },
+        'data_folder_bytes': folder_size('data'),
+        'scheduler': miner.scheduling_stats()
+    }
+    for source in sources:
+        rows = counter(snapshot, 'datamining_rows_written_total', source=source)
+        store = histogram(snapshot, 'datamining_stage_duration_seconds', source=source, stage='store')
+        # With the storage writer the store stage only hands rows over, the disk write is timed by the writer
+        write = histogram(snapshot, 'datamining_writer_append_seconds', source=source)
+        report['sources'][source] = {
+            'rows_written': rows,
+            'rows_per_second': rows/real_seconds if real_seconds else None,
+            'samples_succeeded': counter(snapshot, 'datamining_samples_total', source=source, result='success'),
+            'samples_failed': counter(snapshot, 'datamining_samples_total', source=source, result='failure'),
+            'samples_unchanged': counter(snapshot, 'datamining_samples_total', source=source, result='unchanged'),
+            'requests': counter(snapshot, 'datamining_requests_total', source=source),
+            'retries': counter(snapshot, 'datamining_retries_total', source=source),
+            'fetch_mean_seconds': histogram(snapshot, 'datamining_stage_duration_seconds', source=source, stage='fetch')['mean'],
+            'store_mean_seconds': store['mean'],
+            'store_max_seconds': store['max'],
+            'store_seconds_per_row': store['sum']/rows if rows else None,
+            'write_seconds_per_row': write['sum']/rows if rows and write['count'] else None
+        }
+    commits = histogram(snapshot, 'datamining_writer_commit_seconds')
+    writer_rows = counter(snapshot, 'datamining_writer_rows_total')
+    report['writer'] = {
+        'batches': commits['count'],
+        'rows': writer_rows,
+        'commit_mean_seconds': commits['mean'],
+        'commit_max_seconds': commits['max'],
+        'commit_seconds_per_row': commits['sum']/writer_rows if writer_rows else None
+    }
+    backups = histogram(snapshot, 'datamining_stage_duration_seconds', source='backup', stage='backup')
+    report['backups'] = {
+        'count': backups['count'],
+        'mean_seconds': backups['mean'],
+        'max_seconds': backups['max'],
+        'failed': counter(snapshot, 'datamining_backups_total', result='failure')
+    }
+    return report
+
+
+def print_report(report):
+    print(f"Simulated {report['simulated_days']} days in {report['real_seconds']:.1f} s "
+          f"({report['achieved_speed']:.0f}x), data folder {report['data_folder_bytes']/1e6:.1f} MB")
+    print(f"Upstream: {report['upstream']}")
+    for source, stats in report['sources'].items():
+        per_row = stats['store_seconds_per_row']
+        write_per_row = stats['write_seconds_per_row']
+        print(f"{source:>16} | rows {stats['rows_written']:>9} ({stats['rows_per_second']:.0f}/s) | "
+              f"samples ok/unchanged/failed {stats['samples_succeeded']}/{stats['samples_unchanged']}/{stats['samples_failed']} | retries {stats['retries']} | "
+              f"fetch {stats['fetch_mean_seconds']*1000:.2f} ms | store {stats['store_mean_seconds']*1000:.2f} ms "
+              f"(max {stats['store_max_seconds']*1000:.1f} ms, {per_row*1e6 if per_row else 0:.1f} us/row) | "
+              f"write {write_per_row*1e6 if write_per_row else 0:.1f} us/row")
+    writer = report['writer']
+    if writer['batches']:
+        print(f"{'writer':>16} | {writer['batches']} batches, {writer['rows']} rows, commit mean {writer['commit_mean_seconds']*1000:.2f} ms, "
+              f"max {writer['commit_max_seconds']*1000:.1f} ms, {writer['commit_seconds_per_row']*1e6:.1f} us/row")
+    backups = report['backups']
+    print(f"{'backups':>16} | {backups['count']} runs, mean {backups['mean_seconds']:.2f} s, max {backups['max_seconds']:.2f} s, "
+          f"failed {backups['failed']}")
+    memory = report['memory']
+    print(f"{'memory':>16} | start {memory['rss_start']/1e6:.1f} MB, end {memory['rss_end']/1e6:.1f} MB, "
+          f"peak {memory['rss_peak']/1e6:.1f} MB, growth {memory['growth_per_simulated_day']/1e6:.2f} MB/simulated day")
+    for job, stats in report['scheduler'].items():
+        print(f"{job:>16} | runs {stats['runs']}, failures {stats['failures']}, missed ticks {stats['missed_ticks']}, "
+              f"lag mean/max {stats['mean_lag']:.1f}/{stats['max_lag']:.1f} s (virtual)")
+
+
+def run(args):
+    METRICS.reset()
+    clock = AcceleratedClock(speed=args.speed)
+    end = datetime.fromtimestamp(clock.start, tz=LOCAL_TIMEZONE) + timedelta(days=args.days)
+    upstream = FakeUpstream(clock, latency=args.latency, error_rate=args.error_rate, pods=args.pods,
+                            homes=args.homes, message_interval=args.message_interval, seed=args.seed).start()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    rss_start = rss_bytes()
+    try:
+        with output:
+            miner = DataMiner(build_params(args, upstream, clock, end))
+            # The benchmark measures the scheduled backups, not the one at exit
+            atexit.unregister(miner._backup)
+            probe = Probe(clock)
+
+            async def main():
+                await asyncio.gather(
+                    miner._async_start(),
+                    miner.scheduler.run_job('benchmark_probe', PROBE_INTERVAL, probe, end_at=end)
+                )
+
+            started = time.monotonic()
+            asyncio.run(main())
+            real_seconds = time.monotonic() - started
+    finally:
+        upstream.stop()
+    return build_report(args, miner, upstream, probe, real_seconds, rss_start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='DataMiner benchmark against local fake apis in accelerated virtual time')
+    parser.add_argument('--days', type=float, default=7, help='simulated days')
+    parser.add_argument('--speed', type=float, default=3600, help='virtual seconds per real second')
+    parser.add_argument('--pods', type=int, default=8, help='Sensibo pods (0 = no Sensibo source)')
+    parser.add_argument('--locations', type=int, default=4, help='weather locations (0 = no weather source)')
+    parser.add_argument('--homes', type=int, default=0, help='Tibber real-time homes (0 = no Tibber source)')
+    parser.add_argument('--latency', type=float, default=0.005, help='[seconds] real latency of every fake response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of the requests answered with a 503')
+    parser.add_argument('--message-interval', type=float, default=0.05, help='[seconds] real, between live measurements')
+    parser.add_argument('--sensibo-sampling-time', type=int, default=5*60, help='[seconds] virtual')
+    parser.add_argument('--weather-sampling-time', type=int, default=10*60, help='[seconds] virtual')
+    parser.add_argument('--max-concurrency', type=int, default=8)
+    parser.add_argument('--retention-seconds', type=int, default=24*60*60, help='[seconds] rows kept in memory')
+    parser.add_argument('--storage-format', default='segment', help="'segment' | 'npz' | 'parquet' | 'gorilla'")
+    parser.add_argument('--no-backup', action='store_true', help='do not run the nightly backups')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None, help='working directory (default: a temporary one)')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--output', default=None, help='also write the report as json to this file')
+    parser.add_argument('--verbose', action='store_true', help="show the miner's output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = Path(args.output).resolve() if args.output else None
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='datamining_benchmark_'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        report = run(args)
+    finally:
+        os.chdir(previous_cwd)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,350 @@
-from nordpool import elspot, elbas
-import requests
 import json
-import tibber
+import re
 import numpy as np
-import pickle
 import sys
 import data_mining.data_sources.sensibo_client as SC
+from data_mining.data_sources.http_client import AsyncHTTPClient
+from data_mining.data_sources.resilience import Resilience, HTTPStatusError, RETRY_WINDOW
+from data_mining.data_sources.metadata_cache import MetadataCache, METADATA_TTL
+from data_mining.data_sources.spot_prices import SpotPriceCache, PUBLICATION_HOUR
+from data_mining.data_sources.realtime import (
+    TIBBER_WEBSOCKET_URL, WEBSOCKET_PROTOCOL, USER_AGENT, LIVE_MEASUREMENT_FIELDS,
+    live_measurement_query, reconnect_delay, Downsampler)
+from data_mining.storage import StorageBackend, TimeSeriesStore
+from data_mining.storage.compaction import SETTLE_TIME
+from data_mining.scheduler import Scheduler, Clock
+from data_mining.metrics import METRICS
 import asyncio
-import nest_asyncio
-from datetime import date, datetime, timedelta, timezone
+import aiohttp
+from datetime import datetime, timedelta, timezone
 import pytz
-import sched
 import time
-from pathlib import Path
 import os
 from uuid import uuid1
 import logging
 
 LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+UPSTREAM_UPDATE_INTERVAL = 90  # [seconds] how often the Sensibo api gets new measurements
+UPSTREAM_UPDATE_MARGIN = 3     # [seconds] poll this long after an expected upstream update
+WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
+OBSERVATION_TIME_PATTERN = re.compile(r'"dt"\s*:\s*(\d+)')
+DEDUPLICATION_LOOKBACK = 7*24*60*60  # [seconds] how far back the newest stored measurement per pod is looked up at startup
+UNCHANGED = 'unchanged'  # returned by a fetch without new data upstream (nothing to store, not a failure)
+
+
+def find_gaps(times, start, end, max_spacing):
+    '''
+    Returns [(gap_start, gap_end), ...] where consecutive samples in `times` (sorted, including the
+    window edges start and end) are more than max_spacing apart. All values in the same unit.
+    '''
+    edges = np.concatenate([[start], np.asarray(times, dtype=np.float64), [end]])
+    spacing = np.diff(edges)
+    return [(edges[i], edges[i+1]) for i in np.nonzero(spacing > max_spacing)[0]]
+
+
+def open_tibber_connection(api_key):
+    '''
+    A pyTibber connection with an http session of the running event loop (call it from a coroutine).
+    The session is returned too, the caller closes it.
+    '''
+    # Imported here, only processes mining Tibber load the client
+    import tibber
+    session = aiohttp.ClientSession(headers={'User-Agent': USER_AGENT})
+    return tibber.Tibber(api_key, websession=session), session
+
+
+def parse_utc_time(text):
+    ''' Parses api timestamps like 2026-10-18T10:00:00Z / 2026-10-18T10:00:00.123Z '''
+    return datetime.fromisoformat(text.replace('Z', '+00:00')).astimezone(pytz.utc)
 
 
 class Sensor():
     '''
     Parent class which is inherited by all sensor classes.
+
+    Every sensor writes its samples through _record(), which keeps them in self.data
+    (a columnar TimeSeriesStore, one buffer per device) and queues them for the segment log.
+
+    self.data only holds the newest rows (see retention_rows/retention_seconds),
+    read_series() returns one series spanning both disk and memory.
+    On disk, rows go to the segment log and are optionally sealed into npz/parquet files (see storage_format).
+    Hourly/daily/weekly/monthly rollups of the numeric columns are kept up to date on every write (read_rollup()).
+
+    With backfill=True, gaps in the stored series of the last max_backfill_days are filled from the
+    api's history (_fetch_history) before mining starts.
+
+    Sampling is driven by a Scheduler (data_mining.scheduler): one sample() per tick of a fixed grid.
+    Every upstream request goes through self.resilience (rate limit, retries, circuit breaker),
+    retries of a tick end within its sampling window.
+
+    Every tick is instrumented (data_mining.metrics): the duration of the fetch (request and parse),
+    parse and store stages, and the successful/failed samples and written rows per source.
+
+    With a shared StorageWriter (writer=..., DataMiner passes one for all sources) new rows are handed to
+    the writer's background thread instead of being written on the event loop. Rows of a failed write are
+    kept and handed over again with the next sample; everything is flushed when mining stops.
+
+    With a sink (sink=SQLiteSink(...), params['sqlite']) the stored rows are written to the SQLite database too.
     '''
-    def __init__(self):
-        logging.basicConfig(filename="datamining_errors.log",
-                            format='%(asctime)s %(message)s', level=logging.DEBUG)
+    _owned_http_client = None
+
+    def __init__(self, retention_rows=None, retention_seconds=None, storage_format='segment',
+                 backfill=False, max_backfill_days=7, schedule_offset=0, missed_tick_policy='skip', rollups=True,
+                 writer=None, sink=None):
         self._session_id = str(int(time.time())) + '-' + str(uuid1())[:8]
+        self.backfill_enabled = backfill
+        self.max_backfill_days = max_backfill_days
+        # Seconds after each grid tick to sample at, and what to do with ticks missed by slow runs (see data_mining.scheduler)
+        self.schedule_offset = schedule_offset
+        self.missed_tick_policy = missed_tick_policy
+        # Bounded in-memory window, older rows are only kept in the segment log
+        self.data.retention_rows = retention_rows
+        self.data.retention_seconds = retention_seconds
+        self._pending_rows = []
+        self._writing_rows = []         # handed to the writer, not acknowledged as durable yet
+        self._writer = writer
+        # Sensors that send requests while they are initialized set up their policy before this
+        self.resilience = self._use_resilience(getattr(self, 'resilience', None))
         self._initialize_data_folders()
+        self._storage = StorageBackend(
+            folder='data'+os.sep+self.sensor_name,
+            sensor_name=self.sensor_name,
+            session_id=self._session_id,
+            schema=self.data.schema,
+            format=storage_format,
+            rollups=rollups,
+            sink=sink
+        )
 
-    async def start_mining(self):
-        scheduled_time = self._get_first_scheduled_time()
+    async def start_mining(self, scheduler=None):
+        '''
+        Samples on every tick of the scheduler until end_mining_at. Without a shared scheduler
+        (DataMiner passes one for all sources) the sensor runs on its own.
+        '''
+        scheduler = scheduler if scheduler else Scheduler()
+        scheduled_time = scheduler.first_tick(self.sampling_time, self.schedule_offset)
         self.time_mining_started = scheduled_time
         end_mining_at = self.end_mining_at if self.end_mining_at else "Never"
         
         print(f"{self.sensor_name} started mining | next scheduled measurement: {scheduled_time} | ending: {end_mining_at}")
-        
-        while self.end_mining_at is None or scheduled_time < self.end_mining_at:
-            time_now = datetime.now(tz=LOCAL_TIMEZONE)
-            time_until_measurement = (
-                scheduled_time - time_now).total_seconds()
-            if time_until_measurement > 0:
-                await asyncio.sleep(time_until_measurement)
-
-            # _get_latest_measurement() is unique for each sensor and is defined in each sensor class below
+
+        if self.backfill_enabled:
+            try:
+                await self.backfill()
+            except Exception as e:
+                logging.error(f"{self.sensor_name}: backfill failed. " + str(e))
+                print(f"{self.sensor_name}: backfill failed. " + str(e))
+
+        try:
+            # scheduled_time stays on the fixed grid, a sensor may shift the actual poll within its interval
+            await scheduler.run_job(
+                self.sensor_name, self.sampling_time, self.sample,
+                offset=self.schedule_offset,
+                missed_tick_policy=self.missed_tick_policy,
+                end_at=self.end_mining_at,
+                adjust=self._adjust_scheduled_time
+            )
+        finally:
+            await self._close_storage()
+            if self._owned_http_client is not None:
+                await self._owned_http_client.close()
+
+    async def sample(self, scheduled_time):
+        '''
+        One tick: gets the latest measurement and appends it to the log. Returns True on success,
+        also when there was nothing new upstream (counted as result="unchanged").
+        '''
+        self.resilience.deadline = scheduled_time.timestamp() + RETRY_WINDOW*self.sampling_time
+        # _get_latest_measurement() is unique for each sensor and is defined in each sensor class below
+        with self._stage('fetch'):
             response = await self._get_latest_measurement()
-            success_message = ""
-            if response:
-                saved = self._save_data_to_file()
-                if saved:
-                    success_message += f"{self.sensor_name} | {scheduled_time} | Success: got measurement and stored to file"
-
-            # set the time for next measurement
-            scheduled_time += timedelta(seconds=self.sampling_time)
-            if success_message:
-                message = f"{success_message} | Next scheduled time: {scheduled_time}"
-                logging.info(message)
-                print(message)
+        if response == UNCHANGED:
+            METRICS.inc('datamining_samples_total', source=self.sensor_name, result='unchanged')
+            logging.info(f"{self.sensor_name} | {scheduled_time} | No new measurement upstream")
+            return True
+        if response:
+            with self._stage('store'):
+                response = await self._store()
+        METRICS.inc('datamining_samples_total', source=self.sensor_name, result='success' if response else 'failure')
+        if not response:
+            return False
+        stored = 'queued for storage' if self._writer is not None else 'stored to file'
+        message = f"{self.sensor_name} | {scheduled_time} | Success: got measurement and {stored}"
+        logging.info(message)
+        print(message)
+        return True
 
-    def _save_data_to_file(self):
-        time_now = datetime.now(tz=LOCAL_TIMEZONE)
-        basedir = os.getcwd()+os.sep+'data'+os.sep
+    def _round_result(self, results):
+        '''
+        Combines the results of the devices of one round: True if any got a new measurement,
+        UNCHANGED if none had anything new and none failed, otherwise False.
+        '''
+        if any(result is True for result in results):
+            return True
+        if results and all(result == UNCHANGED for result in results):
+            return UNCHANGED
+        return False
+
+    def _stage(self, stage):
+        ''' Times a stage of a tick (with self._stage('parse'): ...) as datamining_stage_duration_seconds '''
+        return METRICS.timer('datamining_stage_duration_seconds', source=self.sensor_name, stage=stage)
+
+    def _adjust_scheduled_time(self, scheduled_time):
+        '''
+        Returns when to actually poll for the measurement scheduled at scheduled_time.
+        Sensors can override this to align polls with the upstream update cadence.
+        '''
+        return scheduled_time
+
+    def _use_http_client(self, http_client, timeout):
+        '''
+        Returns the shared http client if one is given, otherwise creates one which is closed when mining stops.
+        '''
+        if http_client is None:
+            http_client = AsyncHTTPClient(timeout=timeout)
+            self._owned_http_client = http_client
+        return http_client
+
+    def _use_resilience(self, resilience):
+        '''
+        Returns the given rate limit / retry / circuit breaker policy, or one with the default settings.
+        '''
+        return resilience if resilience else Resilience(self.sensor_name)
+
+    async def backfill(self):
+        '''
+        Detects gaps (no sample for more than 2 sampling times) in the stored series of the last
+        max_backfill_days, fetches the missing range in bulk from the api history, and writes the
+        rows that are not stored yet (one per sampling interval) through the normal storage path.
+        Returns the number of rows added.
+        '''
+        now = time.time()
+        window_start = now - self.max_backfill_days*24*60*60
+        self.resilience.deadline = None
+        gaps = {}
+        stored_buckets = {}
+        for device in self._backfill_devices():
+            times = self._storage.read(device, window_start, now, columns=[])['time']/1000
+            device_gaps = find_gaps(times, window_start, now, 2*self.sampling_time)
+            if device_gaps:
+                gaps[device] = device_gaps
+                stored_buckets[device] = set((times // self.sampling_time).astype(np.int64).tolist())
+        if not gaps:
+            return 0
 
-        folder_daily = basedir+self.sensor_name+os.sep+'daily'+os.sep
-        filename_daily = self.sensor_name + '_' + \
-            time_now.strftime('%Y-%m-%d') + '__' + self._session_id
+        history = await self._fetch_history(gaps)
+        rows = {}
+        for row in history:
+            device, row_time = row['device'], row['time'].timestamp()
+            if device not in gaps or not any(start < row_time < end for start, end in gaps[device]):
+                continue
+            bucket = int(row_time // self.sampling_time)
+            if bucket in stored_buckets[device] or (device, bucket) in rows:
+                continue
+            rows[(device, bucket)] = row
 
-        folder_weekly = basedir+self.sensor_name+os.sep+'weekly'+os.sep
-        filename_weekly = self.sensor_name + '_' + \
-            time_now.strftime('%Y-week-%V') + '__' + self._session_id
+        for row in sorted(rows.values(), key=lambda row: row['time']):
+            self._record(row['device'], row['time'], row['values'])
+        # Like sample(): through the storage writer if there is one, the rows are older than the log's newest
+        # but the rollups recompute the buckets of late rows
+        if not await self._store():
+            return 0
+        message = f"{self.sensor_name} | backfill: filled {sum(len(g) for g in gaps.values())} gaps with {len(rows)} rows"
+        logging.info(message)
+        print(message)
+        return len(rows)
 
-        folder_monthly = basedir+self.sensor_name+os.sep+'monthly'+os.sep
-        filename_monthly = self.sensor_name + '_' + \
-            time_now.strftime('%Y-month-%m') + '__' + self._session_id
+    def _backfill_devices(self):
+        ''' Devices whose series are checked for gaps, defined by each sensor class supporting backfill '''
+        return []
 
-        folder_yearly = basedir+self.sensor_name+os.sep+'yearly'+os.sep
-        filename_yearly = self.sensor_name + '_' + \
-            time_now.strftime('%Y') + '__' + self._session_id
+    def _merge_history_results(self, results):
+        # Results of asyncio.gather(..., return_exceptions=True): a failing device is logged and skipped
+        rows = []
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"{self.sensor_name}: could not get history for backfill. " + str(result))
+                print(f"{self.sensor_name}: could not get history for backfill. " + str(result))
+                continue
+            rows += result
+        return rows
 
+    async def _fetch_history(self, gaps):
+        '''
+        gaps: {device: [(start, end), ...]} in epoch seconds
+        Returns rows [{'device': str, 'time': datetime, 'values': {...}}, ...] covering (at least) the gaps
+        '''
+        return []
+
+    def _record(self, device, timestamp, values):
+        '''
+        Appends a new row to the in-memory store (self.data) and queues it
+        to be written to the segment log by the next _save_data_to_file()
+        '''
+        self.data.append(device, timestamp.timestamp(), values)
+        self._pending_rows.append({
+            'device': device,
+            'time': timestamp.timestamp(),
+            'values': values
+        })
+
+    async def _store(self):
+        '''
+        Hands the rows gathered since the last store to the writer (waiting while its queue is full),
+        or writes them right away without one. Returns False if they could not be written.
+        '''
+        if self._writer is None:
+            return self._save_data_to_file()
+        if not self._pending_rows:
+            return True
+        rows, self._pending_rows = self._pending_rows, []
+        self._writing_rows.append(rows)
         try:
-            with open(folder_daily+filename_daily+".pkl", "wb") as f:
-                pickle.dump(self.data, f)
-            with open(folder_weekly+filename_weekly+".pkl", "wb") as f:
-                pickle.dump(self.data, f)
-            with open(folder_monthly+filename_monthly+".pkl", "wb") as f:
-                pickle.dump(self.data, f)
-            with open(folder_yearly+filename_yearly+".pkl", "wb") as f:
-                pickle.dump(self.data, f)
+            future = await self._writer.submit(self._storage, rows)
+        except Exception as e:
+            # The writer has stopped, the rows are written directly when mining stops
+            self._writing_rows = [batch for batch in self._writing_rows if batch is not rows]
+            self._pending_rows = rows + self._pending_rows
+            logging.error(f"{self.sensor_name}: the storage writer has stopped, keeping {len(rows)} rows. " + repr(e))
+            print(f"{self.sensor_name}: the storage writer has stopped, keeping {len(rows)} rows. " + repr(e))
+            return False
+        future.add_done_callback(lambda future: self._on_written(rows, future))
+        return True
+
+    def _on_written(self, rows, future):
+        # The writer resolves the future once the rows are synced, so they may be evicted from here on
+        self._writing_rows = [batch for batch in self._writing_rows if batch is not rows]
+        error = future.exception() if not future.cancelled() else asyncio.CancelledError()
+        if error is None:
+            METRICS.inc('datamining_rows_written_total', len(rows), source=self.sensor_name)
+            self._evict_from_memory(durable=True)
+            return
+        # Handed over again with the next sample, before the rows gathered since
+        self._pending_rows = rows + self._pending_rows
+        logging.error(f"{self.sensor_name}: could not write {len(rows)} rows, retrying with the next sample. " + str(error))
+        print(f"{self.sensor_name}: could not write {len(rows)} rows, retrying with the next sample. " + str(error))
+
+    async def _close_storage(self):
+        # Queued rows are written before the storage is closed, rows of a failed write get a last try
+        if self._writer is not None:
+            try:
+                if await self._store():
+                    await self._writer.flush()
+            except Exception as e:
+                logging.error(f"{self.sensor_name}: the storage writer has stopped, writing the remaining rows directly. " + repr(e))
+                print(f"{self.sensor_name}: the storage writer has stopped, writing the remaining rows directly. " + repr(e))
+            # Rows of batches the writer never acknowledged (written again if they were, compaction keeps them once)
+            self._pending_rows = [row for rows in self._writing_rows for row in rows] + self._pending_rows
+            self._writing_rows = []
+        if self._pending_rows:
+            self._save_data_to_file()
+        self._storage.close()
+
+    def _save_data_to_file(self):
+        # Only the rows gathered since the last save are appended to the log
+        rows = len(self._pending_rows)
+        try:
+            self._storage.append(self._pending_rows)
         except Exception as e:
             logging.error(
                 "save_data_to_file: Something went wrong while writing data to files.")
@@ -95,26 +352,82 @@ class Sensor():
             print(f"{self.sensor_name}: save_data_to_file: Something went wrong while writing data to files.")
             print(str(e))
             return False
+        self._pending_rows = []
+        METRICS.inc('datamining_rows_written_total', rows, source=self.sensor_name)
+        self._evict_from_memory()
         return True
 
-    def _get_first_scheduled_time(self):
-        time_now = datetime.now(tz=LOCAL_TIMEZONE)
-        # seconds to minutes
-        dt_minutes = self.sampling_time/60
-        if int(dt_minutes*np.ceil(time_now.minute/dt_minutes)) < 60:
-            scheduled_time = time_now.replace(
-                second=0, microsecond=0, minute=int(dt_minutes*np.ceil(time_now.minute/dt_minutes)))
-        else:
-            scheduled_time = time_now.replace(
-                second=0, microsecond=0, minute=0, hour=time_now.hour+1)
-        return scheduled_time
+    def _evict_from_memory(self, durable=False):
+        '''
+        Drops the rows outside the retention window from memory, except rows that are not written yet
+        (pending or still queued in the writer, e.g. backfilled rows older than the window).
+        durable=True: the written rows are synced already (by the storage writer's thread).
+        '''
+        keep_from = self._unwritten_times()
+        if not self.data.needs_eviction(keep_from):
+            return 0
+        if not durable:
+            try:
+                # Make sure the evicted rows are durable before dropping them from memory
+                self._storage.sync()
+            except Exception as e:
+                logging.error(f"{self.sensor_name}: could not sync the segment log, keeping all rows in memory. " + str(e))
+                return 0
+        return self.data.evict(keep_from)
+
+    def _unwritten_times(self):
+        # {device: oldest time (epoch seconds) of a row that is not durable yet}
+        oldest = {}
+        for rows in [self._pending_rows] + self._writing_rows:
+            for row in rows:
+                if row['device'] not in oldest or row['time'] < oldest[row['device']]:
+                    oldest[row['device']] = row['time']
+        return oldest
+
+    def read_series(self, device, start=None, end=None):
+        '''
+        Returns {'time': int64 epoch [ms], <column>: array, ...} for start <= time < end (datetimes, None = unbounded).
+        Rows that have been evicted from memory are read back from disk.
+        '''
+        start = start.timestamp() if start else None
+        end = end.timestamp() if end else None
+        in_memory = self.data[device].to_dict() if device in self.data else None
+        oldest_in_memory = in_memory['time'][0]/1000 if in_memory is not None and len(in_memory['time']) else None
+
+        disk_end = oldest_in_memory if end is None or (oldest_in_memory is not None and oldest_in_memory < end) else end
+        on_disk = self._storage.read(device, start, disk_end)
+        if in_memory is None:
+            return on_disk
+
+        in_range = np.ones(len(in_memory['time']), dtype=bool)
+        if start is not None:
+            in_range &= in_memory['time'] >= start*1000
+        if end is not None:
+            in_range &= in_memory['time'] < end*1000
+        return {
+            name: np.concatenate([on_disk[name], in_memory[name][in_range]])
+            for name in on_disk
+        }
+
+    def read_rollup(self, device, metric, granularity, start=None, end=None):
+        '''
+        Returns the 'hour' / 'day' / 'week' / 'month' aggregates of a metric:
+        {'time': int64 epoch [ms], 'count', 'sum', 'min', 'max', 'last', 'mean'} for start <= time < end (datetimes, None = unbounded)
+        '''
+        start = start.timestamp() if start else None
+        end = end.timestamp() if end else None
+        return self._storage.read_rollup(device, metric, granularity, start, end)
+
+    def compact_storage(self, settle_time=SETTLE_TIME):
+        '''
+        Merges the per-session files of closed days into one file per day (see storage.Compactor).
+        Reads and rewrites whole days, so DataMiner runs it in a worker thread.
+        '''
+        return self._storage.compact(settle_time)
 
     def _initialize_data_folders(self):
         try:
-            os.makedirs('data/'+self.sensor_name+'/daily', exist_ok=True)
-            os.makedirs('data/'+self.sensor_name+'/weekly', exist_ok=True)
-            os.makedirs('data/'+self.sensor_name+'/monthly', exist_ok=True)
-            os.makedirs('data/'+self.sensor_name+'/yearly', exist_ok=True)
+            os.makedirs('data/'+self.sensor_name+'/log', exist_ok=True)
         except Exception as e:
             logging.error("ERROR: " + str(e))
             print("ERROR (_initialize_data_folders): " + str(e))
@@ -123,8 +436,213 @@ class Sensor():
 
 
 class TibberRealtimeSensor(Sensor):
-    # TODO
-    pass
+    '''
+    Tibber real-time sensor (Pulse / Watty)
+    =======================================
+    Subscribes to Tibber's live measurements over a websocket (graphql-transport-ws) instead of polling.
+    Readings arrive every few seconds and are stored per home as:
+        - raw rows (device = home id): power, powerProduction, accumulatedConsumption, accumulatedCost,
+          at most one per raw_interval seconds (None = no raw rows)
+        - aggregates (device = "<home id>@<aggregate_interval>s"): mean (power), power_min, power_max and
+          the number of readings (samples) of every aggregate_interval seconds (None = no aggregates)
+
+    Rows are buffered and written in batches: when batch_size rows are pending, and every flush_interval seconds
+    (a job of the scheduler). A dropped connection is reopened with exponential backoff; so is a connection
+    without any message for idle_timeout seconds.
+
+    Settings:
+        - home_ids: homes to subscribe to, by default every home of the account with real-time consumption
+          (cached for metadata_ttl seconds, see MetadataCache)
+        - websocket_url: the subscription endpoint, e.g. a local stand-in server for testing
+    '''
+    _clock = Clock()
+
+    def __init__(self, api_key, end_mining_at=None, home_ids=None, websocket_url=None, http_client=None,
+                 raw_interval=1, aggregate_interval=60, batch_size=500, flush_interval=10, idle_timeout=60,
+                 max_reconnect_delay=60, resilience=None, metadata_ttl=METADATA_TTL, **sensor_options):
+        self.sensor_name = 'tibber_realtime'
+        self.api_key = api_key
+        self.end_mining_at = end_mining_at
+        self.sampling_time = flush_interval
+        self.websocket_url = websocket_url if websocket_url else TIBBER_WEBSOCKET_URL
+        self.http_client = self._use_http_client(http_client, None)
+        self.resilience = self._use_resilience(resilience)
+        self.raw_interval = raw_interval
+        self.aggregate_interval = aggregate_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.max_reconnect_delay = max_reconnect_delay
+        self.metadata = MetadataCache(self.sensor_name, api_key, metadata_ttl)
+        # Without home_ids the account's homes are looked up when mining starts, on the mining event loop
+        self.home_ids = list(home_ids) if home_ids else None
+        self.reconnects = 0
+        self._received = False          # a measurement arrived since the last (re)connect
+        self._last_raw_bucket = {}      # home id -> raw_interval bucket of the newest raw row
+        self._downsamplers = {}
+        self._initialize_data_structure()
+        super().__init__(**sensor_options)
+
+    async def _get_real_time_homes(self):
+        home_ids = self.metadata.get()
+        # An empty list is never cached, but may be left by an older version
+        if home_ids:
+            return home_ids
+        session = None
+        try:
+            tibber_conn, session = open_tibber_connection(self.api_key)
+            await self.resilience.call(tibber_conn.update_info)
+            homes = tibber_conn.get_homes()
+            # has_real_time_consumption is None until each home has been looked up
+            results = await asyncio.gather(*[
+                self.resilience.call(home.update_real_time_consumption_enabled)
+                for home in homes
+            ], return_exceptions=True)
+            home_ids = []
+            for home, result in zip(homes, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Tibber realtime: could not look up home {home.home_id}: " + str(result))
+                    print(f"Tibber realtime: could not look up home {home.home_id}: " + str(result))
+                elif home.has_real_time_consumption:
+                    home_ids.append(home.home_id)
+            if not home_ids:
+                logging.warning("Tibber realtime: no home of the account has real-time consumption")
+                print("Tibber realtime: no home of the account has real-time consumption")
+            elif not any(isinstance(result, Exception) for result in results):
+                self.metadata.set(home_ids)
+            return home_ids
+        except Exception as e:
+            logging.error("Tibber realtime: could not get the homes of the account: " + str(e))
+            print("Tibber realtime: could not get the homes of the account.")
+            print(str(e))
+            return []
+        finally:
+            if session is not None:
+                await session.close()
+
+    async def start_mining(self, scheduler=None):
+        scheduler = scheduler if scheduler else Scheduler()
+        # The end of the stream and the reconnect delays follow the scheduler's clock
+        self._clock = scheduler.clock
+        if self.home_ids is None:
+            self.home_ids = await self._get_real_time_homes()
+        if self.aggregate_interval:
+            self._downsamplers = {home_id: Downsampler(self.aggregate_interval) for home_id in self.home_ids}
+        end_mining_at = self.end_mining_at if self.end_mining_at else "Never"
+        print(f"{self.sensor_name} started streaming | homes: {len(self.home_ids)} | ending: {end_mining_at}")
+        writer = asyncio.ensure_future(scheduler.run_job(
+            f"{self.sensor_name}_writer", self.flush_interval, self._flush_batch, end_at=self.end_mining_at))
+        try:
+            await self._stream()
+        finally:
+            writer.cancel()
+            for home_id, downsampler in self._downsamplers.items():
+                for aggregate in downsampler.flush():
+                    self._record_aggregate(home_id, aggregate)
+            await self._close_storage()
+            if self._owned_http_client is not None:
+                await self._owned_http_client.close()
+
+    def _remaining(self):
+        if self.end_mining_at is None:
+            return None
+        return self.end_mining_at.timestamp() - self._clock.now()
+
+    def _stopped(self):
+        remaining = self._remaining()
+        return remaining is not None and remaining <= 0
+
+    async def _stream(self):
+        attempt = 0
+        while self.home_ids and not self._stopped():
+            self._received = False
+            try:
+                await self._consume_websocket()
+            except Exception as e:
+                logging.error("Tibber realtime: connection lost. " + str(e))
+                print("Tibber realtime: connection lost. " + str(e))
+            if self._stopped():
+                break
+            attempt = 0 if self._received else attempt + 1
+            delay = reconnect_delay(attempt, maximum=self.max_reconnect_delay)
+            remaining = self._remaining()
+            print(f"Tibber realtime: reconnecting in {delay:.1f} s")
+            await self._clock.sleep(delay if remaining is None else min(delay, remaining))
+            self.reconnects += 1
+            METRICS.inc('datamining_reconnects_total', source=self.sensor_name)
+
+    async def _consume_websocket(self):
+        async with self.http_client.ws_connect(self.websocket_url, protocols=[WEBSOCKET_PROTOCOL],
+                                               headers={'User-Agent': USER_AGENT}) as ws:
+            await ws.send_json({'type': 'connection_init', 'payload': {'token': self.api_key}})
+            ack = await ws.receive_json(timeout=self.idle_timeout)
+            if ack.get('type') != 'connection_ack':
+                raise ConnectionError(f"expected connection_ack, got {ack}")
+            for home_id in self.home_ids:
+                await ws.send_json({'id': home_id, 'type': 'subscribe', 'payload': {'query': live_measurement_query(home_id)}})
+
+            while not self._stopped():
+                remaining = self._remaining()
+                try:
+                    message = await ws.receive(
+                        timeout=self.idle_timeout if remaining is None else min(self.idle_timeout, remaining))
+                except asyncio.TimeoutError:
+                    if self._stopped():
+                        break
+                    raise ConnectionError(f"no message for {self.idle_timeout} s")
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    raise ConnectionError(f"websocket closed ({message.type.name})")
+                payload = json.loads(message.data)
+                if payload.get('type') == 'next':
+                    await self._on_measurement(payload['id'], payload['payload']['data']['liveMeasurement'])
+                elif payload.get('type') == 'ping':
+                    await ws.send_json({'type': 'pong'})
+                elif payload.get('type') in ('error', 'complete'):
+                    raise ConnectionError(f"subscription {payload.get('id')} ended: {payload.get('payload')}")
+
+    async def _on_measurement(self, home_id, measurement):
+        self._received = True
+        METRICS.inc('datamining_stream_messages_total', source=self.sensor_name)
+        timestamp = datetime.fromisoformat(measurement['timestamp'])
+        measurement_time = timestamp.timestamp()
+        if self.raw_interval is not None:
+            bucket = int(measurement_time // self.raw_interval) if self.raw_interval else measurement_time
+            if self._last_raw_bucket.get(home_id) != bucket:
+                self._last_raw_bucket[home_id] = bucket
+                self._record(home_id, timestamp, {field: measurement.get(field) for field in LIVE_MEASUREMENT_FIELDS})
+        if home_id in self._downsamplers:
+            for aggregate in self._downsamplers[home_id].add(measurement_time, measurement.get('power')):
+                self._record_aggregate(home_id, aggregate)
+        if len(self._pending_rows) >= self.batch_size:
+            await self._write_batch()
+
+    def _record_aggregate(self, home_id, aggregate):
+        self._record(f"{home_id}@{self.aggregate_interval}s", datetime.fromtimestamp(aggregate['time'], tz=LOCAL_TIMEZONE), {
+            'power': aggregate['mean'],
+            'power_min': aggregate['min'],
+            'power_max': aggregate['max'],
+            'samples': aggregate['count']
+        })
+
+    async def _flush_batch(self, scheduled_time):
+        if not self._pending_rows:
+            return True
+        return await self._write_batch()
+
+    async def _write_batch(self):
+        with self._stage('store'):
+            return await self._store()
+
+    def _initialize_data_structure(self):
+        self.data = TimeSeriesStore({
+            'power': 'float',
+            'powerProduction': 'float',
+            'accumulatedConsumption': 'float',
+            'accumulatedCost': 'float',
+            'power_min': 'float',
+            'power_max': 'float',
+            'samples': 'float'
+        })
 
 
 class TibberAPI(Sensor):
@@ -141,68 +659,148 @@ class TibberAPI(Sensor):
             = data_points interval
         - n: > 0
             = how many datapoints to pull
+
+    The homes and their names are cached for metadata_ttl seconds (see MetadataCache), a restart
+    within that time does not request the account and home info again.
     '''
-    def __init__(self, api_key, sampling_time, end_mining_at=None):
+    def __init__(self, api_key, sampling_time, end_mining_at=None, max_concurrency=8, resilience=None,
+                 metadata_ttl=METADATA_TTL, **sensor_options):
         self.sensor_name = 'tibber'
         self.api_key = api_key
         self.sampling_time = sampling_time
         self.end_mining_at = end_mining_at
+        self.max_concurrency = max_concurrency
+        self.resilience = self._use_resilience(resilience)
+        self.metadata = MetadataCache(self.sensor_name, api_key, metadata_ttl)
+        self.homes = []
+        self.home_names = {}    # home id -> app nickname, the device name of the home's rows
+        self._tibber_session = None
+        self._initialize_data_structure()
+        super().__init__(**sensor_options)
+
+    async def start_mining(self, scheduler=None):
+        # pyTibber's http session has to belong to the loop that mines, so the connection is made here
+        await self._connect()
+        try:
+            await super().start_mining(scheduler)
+        finally:
+            await self._close_connection()
+
+    async def _connect(self):
+        '''
+        Opens the pyTibber connection and looks up the homes. Returns False if no home could be found,
+        sample() then connects again on its next tick (failed lookups count towards the circuit breaker).
+        '''
+        import tibber
+        await self._close_connection()
+        cached_homes = self.metadata.get()
         try:
-            self._tibber_conn = tibber.Tibber(self.api_key)
-            self._tibber_conn.sync_update_info()
+            self._tibber_conn, self._tibber_session = open_tibber_connection(self.api_key)
+            if cached_homes is not None:
+                self.home_names = {home['id']: home['name'] for home in cached_homes}
+                self.homes = [tibber.TibberHome(home_id, self._tibber_conn) for home_id in self.home_names]
+                return True
+            await self.resilience.call(self._tibber_conn.update_info)
             self.homes = self._tibber_conn.get_homes()
         except Exception as e:
+            logging.error("Tibber: could not connect. " + str(e))
             print(str(e))
             print("Tibber: could not connect.")
+            self.homes = []
+            return False
+        if not self.homes:
+            logging.error("Tibber: no homes found for the api key.")
+            print("Tibber: no homes found for the api key.")
+            return False
 
-        self._initialize_data_structure()
-
-        for home in self.homes:
-            try:
-                home.sync_update_info()
-                home_name = home.info['viewer']['home']['appNickname']
-                self.data['data'][home_name] = {
-                    'time': [],
-                    'consumption': [],
-                    'cost': [],
-                    'total_cost': []
-                }
-            except Exception as e:
-                logging.error("Tibber: could not sync home info: " + str(e))
+        results = await asyncio.gather(*[self.resilience.call(home.update_info) for home in self.homes], return_exceptions=True)
+        for home, result in zip(self.homes, results):
+            if isinstance(result, Exception):
+                logging.error("Tibber: could not sync home info: " + str(result))
                 print("Tibber: could not sync home info")
-                print(str(e))
-        super().__init__()
+                print(str(result))
+                continue
+            self.home_names[home.home_id] = home.info['viewer']['home']['appNickname']
+        if len(self.home_names) == len(self.homes):
+            self.metadata.set([{'id': home_id, 'name': name} for home_id, name in self.home_names.items()])
+        return True
+
+    async def _close_connection(self):
+        if self._tibber_session is not None:
+            await self._tibber_session.close()
+            self._tibber_session = None
+
+    def _home_name(self, home):
+        return self.home_names.get(home.home_id, home.home_id)
 
     async def _get_latest_measurement(self):
-        for home in self.homes:
-            # Settings
-            home_name = home.info['viewer']['home']['appNickname']
-            resolution = "HOURLY"
-            n = 1
+        # Without homes (the connection failed when mining started) the tick connects again
+        if not self.homes and not await self._connect():
+            return False
+        # Homes are requested concurrently, at most max_concurrency at a time
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*[self._get_home_measurement(home, semaphore) for home in self.homes])
+        return any(results)
 
-            # Get data
-            try:
-                # loop = asyncio.get_event_loop()
-                
-                historic_data = await home.get_historic_data(n, resolution)
+    async def _get_home_measurement(self, home, semaphore):
+        # Settings
+        home_name = self._home_name(home)
+        resolution = "HOURLY"
+        n = 1
+
+        # Get data
+        try:
+            async with semaphore:
+                historic_data = await self.resilience.call(home.get_historic_data, n, resolution)
+            with self._stage('parse'):
                 for data_point in historic_data:
                     timestamp = datetime.strptime(data_point['from'], '%Y-%m-%dT%H:%M:%S%z')
-                    self.data['data'][home_name]['time'].append(timestamp)
-                    self.data['data'][home_name]['consumption'].append(data_point['consumption'])
-                    self.data['data'][home_name]['cost'].append(data_point['cost'])
-                    self.data['data'][home_name]['total_cost'].append(data_point['totalCost'])
-            except Exception as e:
-                logging.error("Tibber: could not get historic data. " + str(e))
-                print("Tibber: could not get historic data.")
-                print(str(e))
-                return False
+                    self._record(home_name, timestamp, {
+                        'consumption': data_point['consumption'],
+                        'cost': data_point['cost'],
+                        'total_cost': data_point['totalCost']
+                    })
+        except Exception as e:
+            logging.error(f"Tibber: could not get historic data for {home_name}. " + str(e))
+            print(f"Tibber: could not get historic data for {home_name}.")
+            print(str(e))
+            return False
         return True
 
+    def _backfill_devices(self):
+        return [self._home_name(home) for home in self.homes]
+
+    async def _fetch_history(self, gaps):
+        # One request per home for all hours since the oldest gap
+        oldest_gap = min(start for device_gaps in gaps.values() for start, _ in device_gaps)
+        n = int(np.ceil((time.time() - oldest_gap)/3600)) + 1
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch(home):
+            home_name = self._home_name(home)
+            if home_name not in gaps:
+                return []
+            async with semaphore:
+                historic_data = await self.resilience.call(home.get_historic_data, n, "HOURLY")
+            return [{
+                'device': home_name,
+                'time': datetime.strptime(data_point['from'], '%Y-%m-%dT%H:%M:%S%z'),
+                'values': {
+                    'consumption': data_point['consumption'],
+                    'cost': data_point['cost'],
+                    'total_cost': data_point['totalCost']
+                }
+            } for data_point in historic_data]
+
+        results = await asyncio.gather(*[fetch(home) for home in self.homes], return_exceptions=True)
+        return self._merge_history_results(results)
+
     def _initialize_data_structure(self):
-        self.data = {
-            'sampling_time': self.sampling_time,
-            'data': {}
-        }
+        self.data = TimeSeriesStore({
+            'consumption': 'float',
+            'cost': 'float',
+            'total_cost': 'float'
+        })
 
 
 class SensiboSensor(Sensor):
@@ -213,77 +811,199 @@ class SensiboSensor(Sensor):
 
     The sensobi api updates with new values every 90-91 seconds,
     so to avoid duplicates, set the sampling time above this.
+
+    All pods are requested concurrently, at most max_concurrency pods at a time.
+
+    Settings:
+        - deduplicate: True / False
+            = a measurement with the same timestamp as the last stored one for that pod is skipped,
+              and its ac state is not requested (the last stored one is read back from storage at startup)
+        - adaptive_polling: True / False
+            = learns the upstream update cadence of every pod and delays each poll (within the sampling
+              interval) until all pods have refreshed, so every stored row is a new measurement
+        - server: base url of the api (default https://home.sensibo.com/api/v2), e.g. a local stand-in server
+        - metadata_ttl: [seconds] how long the list of pods is cached (see MetadataCache)
     '''
-    def __init__(self, api_key, sampling_time, end_mining_at):
+    def __init__(self, api_key, sampling_time, end_mining_at, http_client=None, request_timeout=None, max_concurrency=8,
+                 deduplicate=True, adaptive_polling=False, resilience=None, server=None, metadata_ttl=METADATA_TTL,
+                 **sensor_options):
         self.sensor_name = 'sensibo'
         self.api_key = api_key
         self.sampling_time = sampling_time
         self.end_mining_at = end_mining_at
-        self.what_to_measure = ['temperature', 'humidity']
-        self.states_to_record = ['on', 'targetTemperature', 'fanLevel', 'mode']
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.http_client = self._use_http_client(http_client, request_timeout)
+        self.resilience = self._use_resilience(resilience)
+        self.what_to_measure = ['temperature', 'humidity']                   # float columns
+        self.states_to_record = ['on', 'targetTemperature', 'fanLevel', 'mode']  # bool/float/categorical columns
         self.time_since_last_measurement = None
+        self.deduplicate = deduplicate
+        self.adaptive_polling = adaptive_polling
+        self._last_measurement_time = {}    # pod -> epoch of the newest upstream measurement
+        self._upstream_interval = {}        # pod -> estimated upstream update interval [seconds]
         try:
-            self.home = SC.SensiboClientAPI(self.api_key)
-            self.devices = self.home.devices()
+            self.home = SC.SensiboClientAPI(
+                self.api_key, http_client=self.http_client, timeout=self.request_timeout, resilience=self.resilience,
+                server=server)
+            self.metadata = MetadataCache(self.sensor_name, api_key, metadata_ttl)
+            self.devices = self.metadata.get()
+            if self.devices is None:
+                self.devices = self.home.devices()
+                self.metadata.set(self.devices)
         except:
             print('Home Sensibo could not be accessed. Code terminated.')
             sys.exit()
         self._initialize_data_structure()
-        super().__init__()
+        super().__init__(**sensor_options)
+        self._load_last_measurement_times()
+
+    async def start_mining(self, scheduler=None):
+        try:
+            await super().start_mining(scheduler)
+        finally:
+            await self.home.aclose()
+
+    def _load_last_measurement_times(self):
+        # After a restart, the newest stored measurement of every pod is not stored again
+        try:
+            newest = self._storage.newest_times(list(self.devices), time.time() - DEDUPLICATION_LOOKBACK)
+        except Exception as e:
+            logging.error("Sensibo: could not read the newest stored measurements. " + str(e))
+            print("Sensibo: could not read the newest stored measurements. " + str(e))
+            return
+        self._last_measurement_time.update(newest)
 
     async def _get_latest_measurement(self):
-        for pump in self.devices.keys():
-            try:
-                latest_measurement = self.home.pod_measurement(self.devices[pump])[0]
-                current_state = self.home.pod_ac_state(self.devices[pump])
-            except Exception as e:
-                logging.error("Sensibo get_latest_measurement: Could not get measurements or state" + str(e))
-                print("Sensibo get_latest_measurement: Could not get measurements or state")
-                print(str(e))
-                return False
-            
-            # TODO: Setting: "avoid duplicates"
-            # if self.time_since_last_measurement != None and latest_measurement['time']['secondsAgo'] >= self.time_since_last_measurement:
-            #     print("Sensibo data: Latest measurement was already recorded. Aborting until next interval to avoid duplicates.")
-            #     return False
-            
-            for measurement_type in self.data['data'][pump]['measurements'].keys():
+        # Pods are requested concurrently, at most max_concurrency at a time.
+        # A pod that fails is logged and skipped, the rest of the round is still stored.
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*[self._get_pod_measurement(pump, semaphore) for pump in self.devices.keys()])
+        return self._round_result(results)
+
+    async def _get_pod_measurement(self, pump, semaphore):
+        try:
+            async with semaphore:
+                if self.deduplicate:
+                    # The ac state is only requested if the measurement is new
+                    latest_measurement = (await self.home.async_pod_measurement(self.devices[pump]))[0]
+                    if self._is_duplicate(pump, latest_measurement):
+                        return UNCHANGED
+                    current_state = await self.home.async_pod_ac_state(self.devices[pump])
+                else:
+                    measurements, current_state = await asyncio.gather(
+                        self.home.async_pod_measurement(self.devices[pump]),
+                        self.home.async_pod_ac_state(self.devices[pump])
+                    )
+                    latest_measurement = measurements[0]
+        except Exception as e:
+            logging.error(f"Sensibo get_latest_measurement: Could not get measurements or state for {pump}. " + str(e))
+            print(f"Sensibo get_latest_measurement: Could not get measurements or state for {pump}")
+            print(str(e))
+            return False
+
+        with self._stage('parse'):
+            values = {}
+            for measurement_type in self.what_to_measure:
                 if measurement_type in latest_measurement:
-                    self.data['data'][pump]['measurements'][measurement_type].append(latest_measurement[measurement_type])
+                    values[measurement_type] = latest_measurement[measurement_type]
                 else:
-                    self.data['data'][pump]['measurements'][measurement_type].append(np.NaN)
+                    values[measurement_type] = np.nan
                     print(latest_measurement)
                     print('Sensibo measurement '+str(measurement_type) +' for '+str(pump)+' missing, put NaN ')
 
-            for state in self.data['data'][pump]['states']:
-                    if state in current_state:
-                        self.data['data'][pump]['states'][state].append(current_state[state])
-                    else:
-                        self.data['data'][pump]['states'][state].append(np.NaN)
-                        print(current_state)
-                        print('Sensibo state '+str(state)+' for ' + str(pump)+' missing, put NaN ')
-            timestamp = datetime.strptime(latest_measurement['time']['time'], '%Y-%m-%dT%H:%M:%S.%fZ')
-            utc_timestamp = timestamp.replace(tzinfo=pytz.utc)
-            self.data['data'][pump]['times'].append(utc_timestamp.astimezone(tz=LOCAL_TIMEZONE))
-            self.time_since_last_measurement = latest_measurement['time']['secondsAgo']
+            for state in self.states_to_record:
+                if state in current_state:
+                    values[state] = current_state[state]
+                else:
+                    values[state] = np.nan
+                    print(current_state)
+                    print('Sensibo state '+str(state)+' for ' + str(pump)+' missing, put NaN ')
+            utc_timestamp = self._measurement_time(latest_measurement)
+            self._record(pump, utc_timestamp, values)
+        self._observe_upstream_update(pump, utc_timestamp.timestamp())
+        self.time_since_last_measurement = latest_measurement['time']['secondsAgo']
         return True
 
-    def _initialize_data_structure(self):
-        self.data = {
-            'sampling_time': self.sampling_time,
-            'data': {}
-        }
-        for pump in self.devices.keys():
-            self.data['data'][pump] = {'times': [],
-                               'measurements': {},
-                               'states': {}}
+    def _measurement_time(self, measurement):
+        timestamp = datetime.strptime(measurement['time']['time'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        return timestamp.replace(tzinfo=pytz.utc)
+
+    def _is_duplicate(self, pump, measurement):
+        measurement_time = self._measurement_time(measurement).timestamp()
+        last_time = self._last_measurement_time.get(pump)
+        # Compared in ms, the resolution of stored times
+        if last_time is not None and round(last_time*1000) == round(measurement_time*1000):
+            logging.info(f"Sensibo: measurement for {pump} at {measurement['time']['time']} already stored, skipped")
+            return True
+        return False
+
+    def _observe_upstream_update(self, pump, measurement_time):
+        '''
+        Refines the estimate of the pod's upstream update interval. The time between two stored measurements
+        is a whole number of upstream intervals, so each difference is divided by its nearest multiple.
+        '''
+        previous_time = self._last_measurement_time.get(pump)
+        self._last_measurement_time[pump] = measurement_time
+        if previous_time is None or measurement_time <= previous_time:
+            return
+        interval = self._upstream_interval.get(pump, UPSTREAM_UPDATE_INTERVAL)
+        updates = max(round((measurement_time - previous_time)/interval), 1)
+        observed_interval = (measurement_time - previous_time)/updates
+        # Exponential moving average, robust against a single late upstream update
+        self._upstream_interval[pump] = 0.8*interval + 0.2*observed_interval
 
+    def _adjust_scheduled_time(self, scheduled_time):
+        '''
+        Adaptive polling: delays the poll until the next expected upstream update of every pod
+        (plus a small margin), at most one upstream interval after the scheduled time.
+        '''
+        if not self.adaptive_polling or not self._last_measurement_time:
+            return scheduled_time
+        scheduled = scheduled_time.timestamp()
+        delay = 0
+        for pump, measurement_time in self._last_measurement_time.items():
+            interval = self._upstream_interval.get(pump, UPSTREAM_UPDATE_INTERVAL)
+            until_next_update = (measurement_time - scheduled) % interval
+            delay = max(delay, min(until_next_update + UPSTREAM_UPDATE_MARGIN, interval))
+        return scheduled_time + timedelta(seconds=delay)
+
+    def _backfill_devices(self):
+        return list(self.devices.keys())
+
+    async def _fetch_history(self, gaps):
+        # One historicalMeasurements request per pod for all days since the oldest gap.
+        # The history only has measurements, the states are left missing.
+        oldest_gap = min(start for device_gaps in gaps.values() for start, _ in device_gaps)
+        days = min(int(np.ceil((time.time() - oldest_gap)/(24*60*60))), self.max_backfill_days)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch(pump):
+            async with semaphore:
+                history = await self.home.async_pod_historical_measurements(self.devices[pump], days=max(days, 1))
+            values_per_time = {}
             for measurement_type in self.what_to_measure:
-                self.data['data'][pump]['measurements'][measurement_type] = []
+                for point in history.get(measurement_type, []):
+                    values_per_time.setdefault(point['time'], {})[measurement_type] = point['value']
+            return [{
+                'device': pump,
+                'time': parse_utc_time(point_time),
+                'values': values
+            } for point_time, values in values_per_time.items()]
+
+        results = await asyncio.gather(*[fetch(pump) for pump in gaps], return_exceptions=True)
+        return self._merge_history_results(results)
+
+    def _initialize_data_structure(self):
+        self.data = TimeSeriesStore({
+            'temperature': 'float',
+            'humidity': 'float',
+            'on': 'bool',
+            'targetTemperature': 'float',
+            'fanLevel': 'category',
+            'mode': 'category'
+        })
 
-            for state in self.states_to_record:
-                self.data['data'][pump]['states'][state] = []
-                
 
 class WeatherAPI(Sensor):
     '''
@@ -295,91 +1015,202 @@ class WeatherAPI(Sensor):
 
     An alternative api call is the One Call: https://openweathermap.org/api/one-call-api
 
+    Settings:
+        - lat, lon: a single location (device name "<lat>,<lon>")
+        - locations: [{'lat': .., 'lon': .., 'name': ..(optional)}, ...] or [(lat, lon), ...]
+            = more locations, all requested concurrently (at most max_concurrency at a time)
+              under the source's rate limit (see resilience)
+        - url: the current weather endpoint (default WEATHER_URL), e.g. a local stand-in server
+
+    The newest observation time (the api's 'dt') of every location is cached: a response with
+    the same dt as the last stored one is not parsed nor stored again.
     '''
-    def __init__(self, lat, lon, api_key, sampling_time, end_mining_at):
+    def __init__(self, lat, lon, api_key, sampling_time, end_mining_at, http_client=None, request_timeout=None,
+                 resilience=None, locations=None, max_concurrency=8, url=None, **sensor_options):
         self.sensor_name = 'weather'
         self.api_key = api_key
         self.sampling_time = sampling_time
         self.end_mining_at = end_mining_at
+        self.request_timeout = request_timeout
+        self.max_concurrency = max_concurrency
+        self.http_client = self._use_http_client(http_client, request_timeout)
+        self.resilience = self._use_resilience(resilience)
         self.lat = lat
         self.lon = lon
-        self.url = f"http://api.openweathermap.org/data/2.5/weather?lat={self.lat}&lon={self.lon}&appid={self.api_key}&units=metric"
+        self.locations = self._parse_locations(lat, lon, locations)
+        base_url = url if url else WEATHER_URL
+        self.urls = {
+            name: f"{base_url}?lat={location_lat}&lon={location_lon}&appid={self.api_key}&units=metric"
+            for name, (location_lat, location_lon) in self.locations.items()
+        }
+        self.url = next(iter(self.urls.values()), None)
+        self._observation_times = {}  # location -> 'dt' of the newest stored observation
         self._initialize_data_structure()
-        super().__init__()
+        super().__init__(**sensor_options)
+
+    def _parse_locations(self, lat, lon, locations):
+        parsed = {}
+        if lat is not None and lon is not None:
+            parsed[f"{lat},{lon}"] = (lat, lon)
+        for location in locations if locations else []:
+            if isinstance(location, dict):
+                name = location.get('name', f"{location['lat']},{location['lon']}")
+                parsed[name] = (location['lat'], location['lon'])
+            else:
+                parsed[f"{location[0]},{location[1]}"] = (location[0], location[1])
+        return parsed
 
     async def _get_latest_measurement(self):
+        # Locations are requested concurrently, at most max_concurrency at a time
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*[self._get_location_measurement(name, semaphore) for name in self.locations])
+        return self._round_result(results)
+
+    async def _get_location_measurement(self, name, semaphore):
         try:
-            response = requests.get(self.url, timeout=30)
-            if response.status_code == 200:
-                current_data = json.loads(response.text)
+            async with semaphore:
+                headers, text = await self.resilience.call(self._request_current_weather, self.urls[name])
+            # The observation time is read without parsing the whole body, an unchanged observation is skipped
+            observation_time = OBSERVATION_TIME_PATTERN.search(text)
+            if observation_time and self._observation_times.get(name) == int(observation_time.group(1)):
+                logging.info(f"Weather API: observation for {name} unchanged, skipped")
+                return UNCHANGED
+            with self._stage('parse'):
+                current_data = json.loads(text)
                 timestamp = datetime.utcfromtimestamp(current_data['dt']).replace(tzinfo=timezone.utc)
                 timestamp = timestamp.astimezone(LOCAL_TIMEZONE)
-                
-                self.data['data']['time'].append(timestamp)
-                self.data['data']['temperature'] = current_data['main']['temp']
-
-                self.current["time"] = timestamp
-                self.current["temperature"] = current_data['main']['temp']
-                self.last_updated = response.headers["Date"]
-            else: 
-                logging.error("Weather API: Could not get request from the URL. Check API key, lat, or lon: " + str(response.status_code))
-                print("Weather API: Could not get request from the URL. Check API key, lat, or lon:")
-                print("===> Request status code: ", response.status_code)
-                return False
+                self._record(name, timestamp, {'temperature': current_data['main']['temp']})
+            self._observation_times[name] = current_data['dt']
+
+            self.latest[name] = {'time': timestamp, 'temperature': current_data['main']['temp']}
+            self.current["time"] = timestamp
+            self.current["temperature"] = current_data['main']['temp']
+            self.last_updated = headers.get("Date")
+        except HTTPStatusError as e:
+            logging.error(f"Weather API: Could not get request from the URL for {name}. Check API key, lat, or lon: " + str(e.status))
+            print(f"Weather API: Could not get request from the URL for {name}. Check API key, lat, or lon:")
+            print("===> Request status code: ", e.status)
+            return False
         except Exception as e:
-            logging.error("Weather API: Could not get request from the URL. Check API key, lat, or lon: " + str(e))
-            print("Weather API: Could not get request from the URL. Check API key, lat, or lon:")
+            logging.error(f"Weather API: Could not get request from the URL for {name}. Check API key, lat, or lon: " + str(e))
+            print(f"Weather API: Could not get request from the URL for {name}. Check API key, lat, or lon:")
             print('===> ' + str(e))
             return False
         return True
 
+    async def _request_current_weather(self, url):
+        status, headers, text = await self.http_client.request('GET', url, timeout=self.request_timeout)
+        if status != 200:
+            raise HTTPStatusError(status, headers)
+        return headers, text
+
     def _initialize_data_structure(self):
-        self.data = {
-            'sampling_time': self.sampling_time,
-            'data': {
-                'time': [],
-                'temperature': []
-            }
-        }
-        self.current = {}
+        self.data = TimeSeriesStore({'temperature': 'float'})
+        self.current = {}   # newest observation of any location
+        self.latest = {}    # location -> newest observation
 
 
 class SpotMarketAPI(Sensor):
     '''
     Spot market API
     ===============
-    TODO?
-    '''
-    def __init__(self, zone='Tr.heim'):
-        self.spot_prices = elspot.Prices()
-        self.zone = zone
+    Hourly day-ahead prices [currency/MWh] from Nord Pool elspot, one device per price area.
 
-        self.sensor_name = 'spotmarket'
+    Prices are published once a day (tomorrow's around 13:00), so every day is requested once and
+    kept in a local cache (see SpotPriceCache). A poll only stores the days that are not stored yet,
+    polls in between never reach Nord Pool.
 
-    def _initialize_data_structure(self):
-        self.data = {
-            'time': [],
-            'prices': []
-        }
+    The blocking nordpool client runs in the default executor, so it never blocks the event loop.
+    For analyses, fetch_range() returns the prices of any period from the cache, fetching only missing days.
+    '''
+    def __init__(self, sampling_time, end_mining_at=None, zones=('Tr.heim',), currency='NOK', request_timeout=None,
+                 cache_folder=None, resilience=None, **sensor_options):
+        self.sensor_name = 'spotmarket'
+        self.sampling_time = sampling_time
+        self.end_mining_at = end_mining_at
+        self.zones = [zones] if isinstance(zones, str) else list(zones)
+        self.resilience = self._use_resilience(resilience)
+        self.spot_prices = SpotPriceCache(
+            cache_folder if cache_folder else 'data'+os.sep+self.sensor_name+os.sep+'cache', currency, request_timeout)
+        self._stored_days = set()
+        self._initialize_data_structure()
+        super().__init__(**sensor_options)
 
-    def _get_data(self):
+    async def _get_latest_measurement(self):
         time_now = datetime.now(tz=LOCAL_TIMEZONE)
-        time_noon = time_now.replace(second=0, microsecond=0, minute=0, hour=12)
-
-        # Spot prices for next day are announces at noon every day
-        if time_now > time_noon:
-            day_list    = [0,1]
-        else:
-            day_list    = [0]
-
-        for day in day_list:
-            end_date = date.today() + timedelta(days=day)
-            prices = self.spot_prices.hourly(areas=[self.zone], end_date=end_date)
-
-        for i in range(24):
-            timestamp = prices['areas'][self.zone]['values'][i]['start']  # UTC times
-            timestamp = time.astimezone(LOCAL_TIMEZONE)                   # convert to local time
-            price = prices['areas'][self.zone]['values'][i]['value']
-            
-            self.data['time'].append(time)
-            self.data['prices'].append(price)
\ No newline at end of file
+        # Spot prices for next day are announced around noon every day
+        days = [time_now.date()]
+        if time_now.hour >= PUBLICATION_HOUR:
+            days.append(time_now.date() + timedelta(days=1))
+
+        stored = False
+        failed = False
+        for day in days:
+            if self._is_stored(day):
+                continue
+            try:
+                prices = await self.spot_prices.async_day_prices(day, self.resilience)
+            except Exception as e:
+                logging.error(f"Spot market: could not get prices for {day}. " + str(e))
+                print(f"Spot market: could not get prices for {day}.")
+                print(str(e))
+                failed = True
+                continue
+            if prices is None:
+                logging.info(f"Spot market: prices for {day} are not published yet")
+                continue
+            for zone in self.zones:
+                for start, price in prices.get(zone, []):
+                    self._record(zone, datetime.fromtimestamp(start, tz=LOCAL_TIMEZONE), {'price': price})
+            self._stored_days.add(day)
+            stored = True
+        if not stored and not failed:
+            # Every day is stored already, or tomorrow is not published yet
+            return UNCHANGED
+        return stored
+
+    def _is_stored(self, day):
+        # After a restart, the days already in storage are not stored again
+        if day in self._stored_days:
+            return True
+        # The local day has 23, 24 or 25 hours (DST), it ends at the next local midnight
+        next_day = day + timedelta(days=1)
+        day_start = LOCAL_TIMEZONE.localize(datetime(day.year, day.month, day.day)).timestamp()
+        day_end = LOCAL_TIMEZONE.localize(datetime(next_day.year, next_day.month, next_day.day)).timestamp()
+        hours = int(round((day_end - day_start)/3600))
+        for zone in self.zones:
+            times = self._storage.read(zone, day_start, day_end, columns=[])['time']
+            if len(np.unique(times)) < hours:
+                return False
+        self._stored_days.add(day)
+        return True
+
+    def fetch_range(self, first_day, last_day, zone=None):
+        '''
+        Returns {'time': int64 epoch [ms], 'price': float64} for every hour from first_day to last_day (dates, inclusive).
+        Cached days are read from disk, the rest is fetched from Nord Pool and cached.
+        '''
+        return self.spot_prices.range(first_day, last_day, zone if zone else self.zones[0])
+
+    async def async_fetch_range(self, first_day, last_day, zone=None):
+        return await self.spot_prices.async_range(first_day, last_day, zone if zone else self.zones[0], self.resilience)
+
+    def _backfill_devices(self):
+        return list(self.zones)
+
+    async def _fetch_history(self, gaps):
+        oldest_gap = min(start for device_gaps in gaps.values() for start, _ in device_gaps)
+        first_day = datetime.fromtimestamp(oldest_gap, tz=LOCAL_TIMEZONE).date()
+        last_day = datetime.now(tz=LOCAL_TIMEZONE).date()
+        rows = []
+        for zone in gaps:
+            prices = await self.async_fetch_range(first_day, last_day, zone)
+            rows += [{
+                'device': zone,
+                'time': datetime.fromtimestamp(time_ms/1000, tz=LOCAL_TIMEZONE),
+                'values': {'price': price}
+            } for time_ms, price in zip(prices['time'].tolist(), prices['price'].tolist())]
+        return rows
+
+    def _initialize_data_structure(self):
+        self.data = TimeSeriesStore({'price': 'float'})
@@ -0,0 +1,62 @@
+import aiohttp
+
+DEFAULT_TIMEOUT = 10  # [seconds]
+
+
+class AsyncHTTPClient():
+    '''
+    Async HTTP client
+    =================
+    One pooled keep-alive aiohttp session, shared by every source of a DataMiner process.
+
+    Each request has its own deadline (timeout), so a slow upstream api only delays the source
+    that called it and never blocks the event loop running the other sensors.
+
+    The session is created lazily inside the running event loop on the first request.
+    '''
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_connections=100, max_connections_per_host=10):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self._session = None
+
+    async def request(self, method, url, params=None, data=None, timeout=None):
+        '''
+        Returns (status, headers, text). Raises asyncio.TimeoutError if the deadline is exceeded.
+        '''
+        timeout = aiohttp.ClientTimeout(total=timeout if timeout else self.timeout)
+        session = self._get_session()
+        async with session.request(method, url, params=params, data=data, timeout=timeout) as response:
+            text = await response.text()
+            return response.status, response.headers, text
+
+    async def request_json(self, method, url, params=None, data=None, timeout=None):
+        '''
+        Like request(), but raises aiohttp.ClientResponseError for 4xx/5xx responses and returns the parsed json body.
+        '''
+        timeout = aiohttp.ClientTimeout(total=timeout if timeout else self.timeout)
+        session = self._get_session()
+        async with session.request(method, url, params=params, data=data, timeout=timeout) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    def ws_connect(self, url, protocols=(), headers=None, heartbeat=None):
+        '''
+        Opens a websocket on the shared session, use as `async with http_client.ws_connect(url) as ws:`
+        '''
+        return self._get_session().ws_connect(url, protocols=protocols, headers=headers, heartbeat=heartbeat)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+METADATA_TTL = 24*60*60  # [seconds]
+METADATA_FILE = 'metadata.json'
+
+
+class MetadataCache():
+    '''
+    Metadata cache
+    ==============
+    The device/home list of a source (Sensibo pods, Tibber homes), kept on disk for ttl seconds in
+    data/<sensor>/metadata.json, so a restart starts mining without the api round-trips that only list devices.
+    Entries are keyed by a hash of the api key, the key itself is never written. ttl=None or 0 disables the cache.
+
+    devices = cache.get()       # None if missing or older than ttl
+    cache.set(devices)
+    '''
+    def __init__(self, sensor_name, api_key, ttl=METADATA_TTL, folder='data'):
+        self.path = Path(folder) / sensor_name / METADATA_FILE
+        self.key = hashlib.sha256(str(api_key).encode('utf-8')).hexdigest()[:16]
+        self.ttl = ttl
+
+    def get(self):
+        if not self.ttl:
+            return None
+        entry = self._read().get(self.key)
+        if entry is None or time.time() - entry['saved'] > self.ttl:
+            return None
+        return entry['value']
+
+    def set(self, value):
+        if not self.ttl:
+            return
+        entries = self._read()
+        entries[self.key] = {'saved': time.time(), 'value': value}
+        self._write(entries)
+
+    def clear(self):
+        entries = self._read()
+        if entries.pop(self.key, None) is not None:
+            self._write(entries)
+
+    def _write(self, entries):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = self.path.with_name(self.path.name + '.tmp')
+            with open(temporary_path, 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(temporary_path, self.path)
+        except Exception as e:
+            logging.error(f"Metadata cache: could not write {self.path}: " + str(e))
+            print(f"Metadata cache: could not write {self.path}: " + str(e))
+
+    def _read(self):
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"Metadata cache: could not read {self.path}, ignoring it: " + str(e))
+            return {}
@@ -0,0 +1,57 @@
+import random
+
+TIBBER_WEBSOCKET_URL = 'wss://websocket-api.tibber.com/v1-beta/gql/subscriptions'
+WEBSOCKET_PROTOCOL = 'graphql-transport-ws'
+USER_AGENT = 'data-mining/1.0'
+LIVE_MEASUREMENT_FIELDS = ['power', 'powerProduction', 'accumulatedConsumption', 'accumulatedCost']
+
+
+def live_measurement_query(home_id, fields=LIVE_MEASUREMENT_FIELDS):
+    return 'subscription { liveMeasurement(homeId: "%s") { timestamp %s } }' % (home_id, ' '.join(fields))
+
+
+def reconnect_delay(attempt, base=1, maximum=60):
+    ''' Exponential backoff with full jitter, in seconds '''
+    return random.uniform(0, min(maximum, base*2**attempt))
+
+
+class Downsampler():
+    '''
+    Aggregates a stream of (time [epoch seconds], value) into fixed intervals aligned to the epoch.
+    add() returns the aggregates of the intervals that are complete: [{'time', 'mean', 'min', 'max', 'count'}, ...]
+    '''
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._bucket = None
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    def add(self, time, value):
+        if value is None:
+            return []
+        bucket = int(time // self.interval)
+        if self._bucket is not None and bucket < self._bucket:
+            return []  # late reading of an interval that is already written
+        done = self.flush() if self._bucket is not None and bucket != self._bucket else []
+        self._bucket = bucket
+        self._count += 1
+        self._sum += value
+        self._min = value if self._min is None else min(self._min, value)
+        self._max = value if self._max is None else max(self._max, value)
+        return done
+
+    def flush(self):
+        ''' Returns the aggregate of the current (possibly incomplete) interval and starts a new one '''
+        if not self._count:
+            return []
+        aggregate = {
+            'time': self._bucket*self.interval,
+            'mean': self._sum/self._count,
+            'min': self._min,
+            'max': self._max,
+            'count': self._count
+        }
+        self._count, self._sum, self._min, self._max = 0, 0.0, None, None
+        return [aggregate]
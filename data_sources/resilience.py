@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+
+from data_mining.metrics import METRICS
+
+RETRY_WINDOW = 0.8  # share of the sampling interval retries may use, the rest is left for storing the sample
+
+
+class HTTPStatusError(Exception):
+    '''
+    Raised by sources that read the status code themselves (AsyncHTTPClient.request) for an unexpected status.
+    '''
+    def __init__(self, status, headers=None, message=''):
+        super().__init__(f"HTTP {status} {message}".strip())
+        self.status = status
+        self.headers = headers if headers is not None else {}
+
+
+class CircuitOpenError(Exception):
+    '''
+    Raised instead of calling an upstream api whose circuit breaker is open.
+    '''
+
+
+def status_of(error):
+    ''' HTTP status of aiohttp, requests, pyTibber and HTTPStatusError errors, or None '''
+    status = getattr(error, 'status', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = getattr(error.response, 'status_code', None)
+    return status
+
+
+def is_transient(error):
+    '''
+    Timeouts, connection errors, 5xx and 429 are worth retrying, anything else (e.g. 401, 404, bad data) is not.
+    '''
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, aiohttp.ClientConnectionError,
+                          requests.Timeout, requests.ConnectionError)):
+        return True
+    status = status_of(error)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def retry_after(error):
+    '''
+    Seconds to wait according to the upstream api (Retry-After header as seconds or http date), or None
+    '''
+    if getattr(error, 'retry_after', None) is not None:
+        return float(error.retry_after)
+    headers = getattr(error, 'headers', None)
+    if headers is None and getattr(error, 'response', None) is not None:
+        headers = getattr(error.response, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(tz=timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket():
+    '''
+    Allows `rate` requests per second on average and bursts of up to `burst` requests (rate=None: unlimited).
+    A 429 pauses the whole bucket, so concurrent requests to the same api wait too.
+    '''
+    def __init__(self, rate=None, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def reserve(self):
+        '''
+        Takes one token, returns how many seconds the caller has to wait before using it.
+        '''
+        now = self.clock()
+        pause = max(self._paused_until - now, 0.0)
+        if self.rate is None:
+            return pause
+        self.tokens = min(self.tokens + (now - self._updated)*self.rate, self.burst)
+        self._updated = now
+        self.tokens -= 1
+        return max(-self.tokens/self.rate, pause)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, self.clock() + seconds)
+
+
+class CircuitBreaker():
+    '''
+    Opens after `failure_threshold` consecutive transient failures, so a failing api is not called at all.
+    After `reset_timeout` seconds it is half-open: one probe request is let through, its success closes
+    the circuit again, its failure keeps it open for another reset_timeout.
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=60, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and self.clock() - self._opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            self.state = 'open'
+            self._opened_at = self.clock()
+
+
+class Resilience():
+    '''
+    Resilience
+    ==========
+    Wraps every request a source sends to its upstream api:
+        - rate limit: a token bucket per source (rate [requests/second], burst)
+        - retries: transient errors (timeouts, 5xx, 429) are retried up to max_retries times with
+          exponential backoff and full jitter (backoff_base*2^attempt, at most backoff_max seconds).
+          A Retry-After of a 429 is honoured. Retries stop at the deadline (the end of the current
+          sampling window, set by the sensor for every tick), so they never spill into the next tick.
+        - circuit breaker: after failure_threshold transient failures in a row the api is not called for
+          reset_timeout seconds, then a single probe decides whether it is back.
+
+    Requests (by result), retries and rejected calls are counted per source in data_mining.metrics.
+
+    result = await resilience.call(http_client.request_json, 'GET', url)
+    '''
+    def __init__(self, name, rate=None, burst=1, max_retries=3, backoff_base=1, backoff_max=30,
+                 failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.deadline = None  # [epoch seconds] no retry is started after this, None = only max_retries applies
+        self.retries = 0
+        self.rejected = 0
+
+    async def call(self, function, *args, **kwargs):
+        '''
+        Awaits function(*args, **kwargs) under the rate limit, retry and circuit breaker policy.
+        Raises the last error if all attempts failed, CircuitOpenError if the circuit is open.
+        '''
+        attempt = 0
+        while True:
+            self._check_circuit()
+            await self.bucket.acquire()
+            try:
+                with METRICS.timer('datamining_request_duration_seconds', source=self.name):
+                    result = await function(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(e, attempt)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            METRICS.inc('datamining_requests_total', source=self.name, result='success')
+            return result
+
+    def call_sync(self, function, *args, **kwargs):
+        '''
+        Blocking version of call(), for the requests made while a source is initialized.
+        '''
+        attempt = 0
+        while True:
+            self._check_circuit()
+            wait = self.bucket.reserve()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                with METRICS.timer('datamining_request_duration_seconds', source=self.name):
+                    result = function(*args, **kwargs)
+            except Exception as e:
+                time.sleep(self._on_failure(e, attempt))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            METRICS.inc('datamining_requests_total', source=self.name, result='success')
+            return result
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            self.rejected += 1
+            METRICS.inc('datamining_circuit_rejected_total', source=self.name)
+            raise CircuitOpenError(f"{self.name}: circuit open after {self.breaker.failures} failures, request skipped")
+
+    def _on_failure(self, error, attempt):
+        '''
+        Returns the delay before the next attempt, or re-raises the error if it should not be retried.
+        '''
+        if not is_transient(error):
+            # The api answered, so it is up: a client error does not count against the circuit
+            self.breaker.record_success()
+            METRICS.inc('datamining_requests_total', source=self.name, result='error')
+            raise error
+        self.breaker.record_failure()
+        METRICS.inc('datamining_requests_total', source=self.name, result='transient_error')
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base*2**attempt))
+        upstream_delay = retry_after(error)
+        if upstream_delay is not None:
+            self.bucket.pause(upstream_delay)
+            delay = max(delay, upstream_delay)
+        out_of_time = self.deadline is not None and time.time() + delay > self.deadline
+        if attempt >= self.max_retries or out_of_time or self.breaker.state == 'open':
+            raise error
+        self.retries += 1
+        METRICS.inc('datamining_retries_total', source=self.name)
+        logging.warning(f"{self.name}: transient error ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f} s")
+        return delay
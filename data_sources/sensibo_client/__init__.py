@@ -1,24 +1,58 @@
 import requests
 import json
+from data_mining.data_sources.http_client import AsyncHTTPClient
 
 _SERVER = 'https://home.sensibo.com/api/v2'
 
 class SensiboClientAPI(object):
-    def __init__(self, api_key):
+    def __init__(self, api_key, http_client=None, timeout=None, resilience=None, server=None):
         self._api_key = api_key
+        # Base url of the api, e.g. a local stand-in server for testing
+        self._server = server if server else _SERVER
+        # A client created here is closed by aclose(), a shared one by its owner
+        self._owns_http_client = http_client is None
+        self._http_client = http_client if http_client else AsyncHTTPClient()
+        self._timeout = timeout
+        # Optional rate limit / retry / circuit breaker policy (data_sources.resilience.Resilience)
+        self._resilience = resilience
 
     def _get(self, path, ** params):
         params['apiKey'] = self._api_key
-        response = requests.get(_SERVER + path, params = params)
-        response.raise_for_status()
-        return response.json()
+        return self._call_sync(self._request, 'GET', path, params)
 
     def _patch(self, path, data, ** params):
         params['apiKey'] = self._api_key
-        response = requests.patch(_SERVER + path, params = params, data = data)
+        return self._call_sync(self._request, 'PATCH', path, params, data)
+
+    def _request(self, method, path, params, data = None):
+        response = requests.request(method, self._server + path, params = params, data = data, timeout = self._timeout)
         response.raise_for_status()
         return response.json()
 
+    def _call_sync(self, function, *args):
+        if self._resilience is None:
+            return function(*args)
+        return self._resilience.call_sync(function, *args)
+
+    async def _async_get(self, path, ** params):
+        params['apiKey'] = self._api_key
+        return await self._call(self._http_client.request_json,
+            'GET', self._server + path, params = params, timeout = self._timeout)
+
+    async def _async_patch(self, path, data, ** params):
+        params['apiKey'] = self._api_key
+        return await self._call(self._http_client.request_json,
+            'PATCH', self._server + path, params = params, data = data, timeout = self._timeout)
+
+    async def _call(self, function, *args, **kwargs):
+        if self._resilience is None:
+            return await function(*args, **kwargs)
+        return await self._resilience.call(function, *args, **kwargs)
+
+    async def aclose(self):
+        if self._owns_http_client:
+            await self._http_client.close()
+
     def devices(self):
         result = self._get("/users/me/pods", fields="id,room")
         return {x['room']['name']: x['id'] for x in result['result']}
@@ -28,7 +62,7 @@ class SensiboClientAPI(object):
         return result['result']
 
     def pod_historical_measurements(self, podUid, days=1):
-        result = self._get("/pods/%s/historicalMeasurements" % podUid, params= {'days':days})
+        result = self._get("/pods/%s/historicalMeasurements" % podUid, days = days)
         return result['result']
 
     def pod_ac_state(self, podUid):
@@ -39,6 +73,27 @@ class SensiboClientAPI(object):
         self._patch("/pods/%s/acStates/%s" % (podUid, propertyToChange),
                 json.dumps({'currentAcState': currentAcState, 'newValue': newValue}))
 
+    # Non-blocking versions of the calls above, to be awaited from inside the event loop
+    async def async_devices(self):
+        result = await self._async_get("/users/me/pods", fields="id,room")
+        return {x['room']['name']: x['id'] for x in result['result']}
+
+    async def async_pod_measurement(self, podUid):
+        result = await self._async_get("/pods/%s/measurements" % podUid)
+        return result['result']
+
+    async def async_pod_historical_measurements(self, podUid, days=1):
+        result = await self._async_get("/pods/%s/historicalMeasurements" % podUid, days = days)
+        return result['result']
+
+    async def async_pod_ac_state(self, podUid):
+        result = await self._async_get("/pods/%s/acStates" % podUid, limit = 1, fields="status,reason,acState")
+        return result['result'][0]['acState']
+
+    async def async_pod_change_ac_state(self, podUid, currentAcState, propertyToChange, newValue):
+        await self._async_patch("/pods/%s/acStates/%s" % (podUid, propertyToChange),
+                json.dumps({'currentAcState': currentAcState, 'newValue': newValue}))
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='Sensibo client example parser')
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import math
+import os
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+
+CACHE_FOLDER = 'data/spotmarket/cache'
+PUBLICATION_HOUR = 13  # [local hour] day-ahead prices for tomorrow are published shortly before this
+
+
+def is_published(area_prices):
+    # Nord Pool returns inf for hours without a price, e.g. tomorrow before the prices are published
+    return len(area_prices) >= 23 and all(math.isfinite(value) for _, value in area_prices)
+
+
+class SpotPriceCache():
+    '''
+    Spot price cache
+    ================
+    Day-ahead prices from Nord Pool elspot, cached locally with one json file per currency and day:
+
+        data/spotmarket/cache/<currency>_<YYYY-MM-DD>.json    {area: [[start (epoch seconds), price], ...]}
+
+    Every file holds all areas, so a day is only requested from Nord Pool once, whatever areas are
+    read later. Days whose prices are not published yet are not cached.
+
+    cache = SpotPriceCache(currency='NOK')
+    prices = cache.range(date(2026, 1, 1), date(2026, 1, 31), 'Tr.heim')   # {'time': int64 epoch [ms], 'price': float64}
+    '''
+    def __init__(self, cache_folder=CACHE_FOLDER, currency='NOK', timeout=None):
+        self.cache_folder = Path(cache_folder)
+        self.currency = currency
+        # Imported here, only processes mining spot prices load the nordpool client
+        from nordpool import elspot
+        self.prices_api = elspot.Prices(currency=currency, timeout=timeout)
+
+    def day_prices(self, day):
+        '''
+        Returns {area: [(start [epoch seconds], price), ...]} for one day, or None if not published yet.
+        Blocking, use async_day_prices() inside the event loop.
+        '''
+        cached = self.load(day)
+        if cached is not None:
+            return cached
+        return self._fetch(day)
+
+    async def async_day_prices(self, day, resilience=None):
+        '''
+        Like day_prices(), the request to Nord Pool runs in the default executor (optionally under a Resilience policy).
+        '''
+        cached = self.load(day)
+        if cached is not None:
+            return cached
+        loop = asyncio.get_running_loop()
+        if resilience is None:
+            return await loop.run_in_executor(None, self._fetch, day)
+        return await resilience.call(loop.run_in_executor, None, self._fetch, day)
+
+    def range(self, first_day, last_day, area):
+        '''
+        Bulk fetch of every hourly price of an area from first_day to last_day (dates, inclusive).
+        Only days missing from the cache are requested.
+        '''
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        return self._to_arrays([self.day_prices(day) for day in days], area)
+
+    async def async_range(self, first_day, last_day, area, resilience=None, max_concurrency=4):
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch(day):
+            async with semaphore:
+                return await self.async_day_prices(day, resilience)
+        return self._to_arrays(await asyncio.gather(*[fetch(day) for day in days]), area)
+
+    def load(self, day):
+        try:
+            with open(self._cache_path(day)) as f:
+                return {area: [tuple(price) for price in prices] for area, prices in json.load(f).items()}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error(f"SpotPriceCache: could not read {self._cache_path(day)}, fetching it again: " + str(e))
+            return None
+
+    def _fetch(self, day):
+        response = self.prices_api.hourly(end_date=day)
+        prices = {
+            area: [(value['start'].timestamp(), value['value']) for value in area_data['values']]
+            for area, area_data in response['areas'].items()
+        }
+        # Areas without (complete) prices are left out, a day without any is not cached
+        prices = {area: area_prices for area, area_prices in prices.items() if is_published(area_prices)}
+        if not prices:
+            return None
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        path = self._cache_path(day)
+        temporary_path = path.with_suffix('.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(prices, f)
+        os.replace(temporary_path, path)
+        return prices
+
+    def _to_arrays(self, days, area):
+        prices = [price for day in days if day for price in day.get(area, [])]
+        return {
+            'time': np.array([int(round(start*1000)) for start, _ in prices], dtype=np.int64),
+            'price': np.array([value for _, value in prices], dtype=np.float64)
+        }
+
+    def _cache_path(self, day):
+        return self.cache_folder / f"{self.currency}_{day.strftime('%Y-%m-%d')}.json"
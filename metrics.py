@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# [seconds] upper bounds of the duration histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Metrics():
+    '''
+    Metrics
+    =======
+    Process wide counters, gauges and duration histograms, e.g.:
+
+        METRICS.inc('datamining_samples_total', source='sensibo', result='success')
+        with METRICS.timer('datamining_stage_duration_seconds', source='sensibo', stage='store'):
+            ...
+
+    Exposed in the Prometheus text format by a local http endpoint (start_metrics_server) and/or
+    written as json to a stats file (write_stats_file), see params['metrics'].
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()  # backups report from a worker thread
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0]*len(self.buckets), 'count': 0, 'sum': 0.0, 'max': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        ''' Observes the duration [seconds] of the with-block, also when it raises '''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def value(self, name, **labels):
+        ''' Current value of a counter or gauge (0 if never set) '''
+        key = (name, _label_key(labels))
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def reset(self):
+        with self._lock:
+            self._counters, self._gauges, self._histograms = {}, {}, {}
+
+    def snapshot(self):
+        '''
+        {'counters': [...], 'gauges': [...], 'histograms': [...]}, every entry with its name and labels
+        '''
+        with self._lock:
+            return {
+                'time': time.time(),
+                'counters': [{'name': name, 'labels': dict(key), 'value': value}
+                             for (name, key), value in sorted(self._counters.items())],
+                'gauges': [{'name': name, 'labels': dict(key), 'value': value}
+                           for (name, key), value in sorted(self._gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(key), 'count': h['count'], 'sum': h['sum'], 'max': h['max'],
+                                'mean': h['sum']/h['count'] if h['count'] else 0.0}
+                               for (name, key), h in sorted(self._histograms.items())]
+            }
+
+    def render(self):
+        ''' Prometheus text exposition format (version 0.0.4) '''
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    for (metric_name, key), value in sorted(values.items()):
+                        if metric_name == name:
+                            lines.append(f'{name}{_format_labels(key)} {value}')
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (metric_name, key), histogram in sorted(self._histograms.items()):
+                    if metric_name != name:
+                        continue
+                    for bound, count in zip(self.buckets, histogram['buckets']):
+                        lines.append(f'{name}_bucket{_format_labels(key, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(key, [("le", "+Inf")])} {histogram["count"]}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {histogram["sum"]}')
+                    lines.append(f'{name}_count{_format_labels(key)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+async def start_metrics_server(registry=METRICS, host='127.0.0.1', port=9108):
+    '''
+    Serves GET /metrics (Prometheus text format) on host:port. Returns the asyncio server, close() it to stop.
+    '''
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass  # headers are not needed
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write((f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                          f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        except Exception as e:
+            logging.error("Metrics endpoint: could not answer a request: " + str(e))
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Metrics endpoint: http://{host}:{port}/metrics")
+    return server
+
+
+def write_stats_file(path, registry=METRICS):
+    ''' Writes registry.snapshot() as json, atomically (temporary file + rename) '''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(path.name + '.tmp')
+    with open(temporary_path, 'w') as f:
+        json.dump(registry.snapshot(), f, indent=1, default=lambda value: None if isinstance(value, float) and math.isnan(value) else str(value))
+    os.replace(temporary_path, path)
+    return path
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from data_mining.metrics import METRICS
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+MISSED_TICK_POLICIES = ['skip', 'coalesce', 'catch_up']
+DAY = 24*60*60  # [seconds]
+
+
+class Clock():
+    '''
+    Wall clock used by the scheduler. Replaceable, e.g. by a virtual clock in simulations.
+    '''
+    def now(self):
+        return time.time()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+class AcceleratedClock(Clock):
+    '''
+    Virtual clock running `speed` times faster than the wall clock, from `start` (epoch seconds, default now).
+    With speed=3600 a simulated hour takes a second, e.g. to mine weeks of data from stand-in servers (see benchmarks/).
+    '''
+    def __init__(self, speed=3600, start=None):
+        self.speed = speed
+        self.start = start if start is not None else time.time()
+        self._started = time.monotonic()
+
+    def now(self):
+        return self.start + (time.monotonic() - self._started)*self.speed
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds/self.speed)
+
+
+class Job():
+    '''
+    A periodic task of the scheduler and its statistics (lag = how late a run started compared to its planned time).
+    '''
+    def __init__(self, name, interval, offset, missed_tick_policy):
+        self.name = name
+        self.interval = interval
+        self.offset = offset
+        self.missed_tick_policy = missed_tick_policy
+        self.next_tick = None
+        self.runs = 0
+        self.failures = 0
+        self.missed_ticks = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def record_run(self, lag, success):
+        self.runs += 1
+        self.failures += 0 if success else 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+        METRICS.inc('datamining_job_runs_total', job=self.name, result='success' if success else 'failure')
+        METRICS.observe('datamining_schedule_lag_seconds', lag, job=self.name)
+
+    def record_missed(self, ticks):
+        self.missed_ticks += ticks
+        METRICS.inc('datamining_missed_ticks_total', ticks, job=self.name)
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'offset': self.offset,
+            'next_tick': self.next_tick,
+            'runs': self.runs,
+            'failures': self.failures,
+            'missed_ticks': self.missed_ticks,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'mean_lag': self.total_lag/self.runs if self.runs else 0.0
+        }
+
+
+class Scheduler():
+    '''
+    Scheduler
+    =========
+    One scheduler drives all sensors and the backup task of a DataMiner.
+
+    Ticks are placed on a fixed grid, so slow runs never make the schedule drift:
+        - intervals up to a day: every `interval` seconds counted from local midnight (+ offset),
+          restarting at every midnight, so e.g. 5 min ticks stay on :00, :05, ... across DST changes
+        - longer intervals: every `interval` seconds counted from the unix epoch (+ offset)
+
+    Offsets stagger the jobs, so the sources don't all fire in the same second.
+
+    Missed tick policy, when a run overruns one or more following ticks:
+        - 'skip': drop the missed ticks and continue at the next tick in the future
+        - 'coalesce': run once right away for the newest missed tick, then continue on the grid
+        - 'catch_up': run every missed tick back-to-back
+    '''
+    def __init__(self, clock=None, lag_warning=10):
+        self.clock = clock if clock else Clock()
+        self.lag_warning = lag_warning  # [seconds] runs starting later than this are logged
+        self.jobs = {}
+
+    def next_tick(self, after, interval, offset=0):
+        '''
+        Returns the first tick (epoch seconds) on the grid at or after `after`.
+        '''
+        if interval > DAY:
+            return math.ceil((after - offset)/interval)*interval + offset
+        day = datetime.fromtimestamp(after - offset, tz=LOCAL_TIMEZONE).date()
+        day_start = self._local_midnight(day) + offset
+        tick = day_start + math.ceil((after - day_start)/interval)*interval
+        next_day_start = self._local_midnight(day + timedelta(days=1)) + offset
+        return min(tick, next_day_start)
+
+    def stats(self):
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+    def first_tick(self, interval, offset=0):
+        return self._to_datetime(self.next_tick(self.clock.now(), interval, offset))
+
+    async def run_job(self, name, interval, callback, offset=0, missed_tick_policy='skip', end_at=None, adjust=None):
+        '''
+        Runs `await callback(scheduled_time)` on every tick until end_at (datetime, None = never).
+        adjust: optional callable(scheduled_time) -> datetime, when to actually run the tick
+        The callback returns True on success.
+        '''
+        if missed_tick_policy not in MISSED_TICK_POLICIES:
+            raise ValueError(f"Unknown missed tick policy '{missed_tick_policy}', expected one of {MISSED_TICK_POLICIES}")
+        job = Job(name, interval, offset, missed_tick_policy)
+        self.jobs[name] = job
+        end = end_at.timestamp() if end_at else None
+        tick = self.next_tick(self.clock.now(), interval, offset)
+
+        while end is None or tick < end:
+            job.next_tick = tick
+            scheduled_time = self._to_datetime(tick)
+            planned = adjust(scheduled_time).timestamp() if adjust else tick
+            wait = planned - self.clock.now()
+            if wait > 0:
+                await self.clock.sleep(wait)
+
+            lag = max(self.clock.now() - planned, 0.0)
+            if lag > self.lag_warning:
+                message = f"SCHEDULER | {name} | {scheduled_time} | started {lag:.1f} s late"
+                logging.warning(message)
+                print(message)
+            try:
+                success = await callback(scheduled_time)
+            except Exception as e:
+                logging.error(f"SCHEDULER | {name} | {scheduled_time} | run failed: " + str(e))
+                print(f"SCHEDULER | {name} | {scheduled_time} | run failed: " + str(e))
+                success = False
+            job.record_run(lag, bool(success))
+            tick = self._following_tick(job, tick)
+        return job
+
+    def _following_tick(self, job, tick):
+        following = self.next_tick(tick + 1e-3, job.interval, job.offset)
+        now = self.clock.now()
+        if following >= now or job.missed_tick_policy == 'catch_up':
+            return following
+
+        newest_missed = following
+        missed = 1
+        while True:
+            candidate = self.next_tick(newest_missed + 1e-3, job.interval, job.offset)
+            if candidate > now:
+                break
+            newest_missed = candidate
+            missed += 1
+        if job.missed_tick_policy == 'coalesce':
+            job.record_missed(missed - 1)
+            message = f"SCHEDULER | {job.name} | overran {missed} ticks, coalesced into one run"
+            logging.warning(message)
+            print(message)
+            return newest_missed
+        job.record_missed(missed)
+        message = f"SCHEDULER | {job.name} | overran, skipped {missed} ticks"
+        logging.warning(message)
+        print(message)
+        return candidate
+
+    def _local_midnight(self, day):
+        return LOCAL_TIMEZONE.localize(datetime(day.year, day.month, day.day)).timestamp()
+
+    def _to_datetime(self, tick):
+        return datetime.fromtimestamp(tick, tz=LOCAL_TIMEZONE)
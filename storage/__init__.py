@@ -0,0 +1,11 @@
+from data_mining.storage.segment_log import SegmentLog, read_frames, recover_segment, parse_segment_name, PERIODS
+from data_mining.storage.columnar import ColumnarBuffer, TimeSeriesStore
+from data_mining.storage.reader import DataReader
+from data_mining.storage.formats import convert_pickle_tree, FORMATS
+from data_mining.storage.backend import StorageBackend, STORAGE_FORMATS
+from data_mining.storage.alignment import Aligner, resample, asof
+from data_mining.storage.rollups import RollupStore, GRANULARITIES
+from data_mining.storage.writer import StorageWriter
+from data_mining.storage.compaction import Compactor, compact_tree
+from data_mining.storage.codec import encode_block, decode_block
+from data_mining.storage.sqlite_sink import SQLiteSink, SQLiteReader
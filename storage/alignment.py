@@ -0,0 +1,216 @@
+import numpy as np
+
+from data_mining.storage.reader import to_epoch
+
+AGGREGATIONS = ['mean', 'sum', 'min', 'max', 'count', 'first', 'last']
+FILL_RULES = [None, 'ffill', 'bfill', 'interpolate', 'zero']
+
+
+def present(values):
+    ''' Mask of the values that are not missing (NaN for floats, None for objects) '''
+    if values.dtype == object:
+        return np.not_equal(values, None).astype(bool)
+    return ~np.isnan(values)
+
+
+def resample(times, values, start, frequency, bins, aggregation='mean'):
+    '''
+    Aggregates samples (times: sorted int64 epoch [ms]) into `bins` intervals of `frequency` [ms] from `start` [ms].
+    Returns one value per bin, NaN/None for bins without samples (count: 0).
+    '''
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{aggregation}', expected one of {AGGREGATIONS}")
+    index = (times - start) // frequency
+    keep = (index >= 0) & (index < bins) & present(values)
+    index, values = index[keep], values[keep]
+    if aggregation == 'count':
+        return np.bincount(index, minlength=bins).astype(np.float64)
+
+    numeric = values.dtype != object
+    result = np.full(bins, np.nan) if numeric else np.full(bins, None, dtype=object)
+    if not len(index):
+        return result
+    # index is sorted, so every bin's samples are one contiguous run
+    starts = np.flatnonzero(np.concatenate([[True], index[1:] != index[:-1]]))
+    ends = np.concatenate([starts[1:], [len(index)]]) - 1
+    if aggregation == 'first':
+        result[index[starts]] = values[starts]
+    elif aggregation == 'last':
+        result[index[starts]] = values[ends]
+    elif not numeric:
+        raise ValueError(f"Aggregation '{aggregation}' needs a numeric column, use 'first', 'last' or 'count'")
+    elif aggregation == 'min':
+        result[index[starts]] = np.minimum.reduceat(values, starts)
+    elif aggregation == 'max':
+        result[index[starts]] = np.maximum.reduceat(values, starts)
+    else:
+        sums = np.add.reduceat(values, starts)
+        result[index[starts]] = sums if aggregation == 'sum' else sums/(ends - starts + 1)
+    return result
+
+
+def asof(times, values, targets, tolerance=None):
+    '''
+    For every target time, the newest sample at or before it (None/NaN if there is none, or if it is older than tolerance).
+    All times in epoch [ms].
+    '''
+    keep = present(values)
+    times, values = times[keep], values[keep]
+    position = np.searchsorted(times, targets, side='right') - 1
+    found = position >= 0
+    if tolerance is not None:
+        found &= targets - times[np.maximum(position, 0)] <= tolerance if len(times) else False
+    result = np.full(len(targets), np.nan) if values.dtype != object else np.full(len(targets), None, dtype=object)
+    if len(times):
+        result[found] = values[position[found]]
+    return result
+
+
+def fill(values, rule, limit=None):
+    '''
+    Fills missing values: 'ffill'/'bfill' (at most `limit` bins in a row), 'interpolate' (linear, numeric
+    columns, inner gaps only) or 'zero'.
+    '''
+    if rule not in FILL_RULES:
+        raise ValueError(f"Unknown fill rule '{rule}', expected one of {FILL_RULES}")
+    if rule is None or not len(values):
+        return values
+    missing = ~present(values)
+    if rule == 'zero':
+        filled = values.copy()
+        filled[missing] = 0
+        return filled
+    if rule == 'interpolate':
+        positions = np.arange(len(values))
+        known = ~missing
+        if known.sum() < 2:
+            return values
+        filled = values.astype(np.float64, copy=True)
+        inner = missing & (positions > positions[known][0]) & (positions < positions[known][-1])
+        filled[inner] = np.interp(positions[inner], positions[known], filled[known])
+        return filled
+
+    if rule == 'bfill':
+        return fill(values[::-1], 'ffill', limit)[::-1]
+    positions = np.arange(len(values))
+    source = np.where(missing, -1, positions)
+    np.maximum.accumulate(source, out=source)
+    fillable = source >= 0
+    if limit is not None:
+        fillable &= positions - source <= limit
+    filled = values.copy()
+    filled[fillable] = values[source[fillable]]
+    return filled
+
+
+class Aligner():
+    '''
+    Aligner
+    =======
+    Joins series of different sensors and cadences (hourly Tibber, 5 min Sensibo, irregular weather)
+    into one frame on a common time grid of `frequency` seconds:
+
+        aligner = Aligner(DataReader('data'), frequency=5*60, start=datetime(2026, 1, 1, tzinfo=pytz.utc))
+        aligner.add('tibber', 'Home', 'consumption', aggregation='sum', name='consumption')
+        aligner.add('sensibo', 'Living room', 'temperature', fill='ffill', fill_limit=3)
+        aligner.add('weather', '63.4,10.335', 'temperature', how='asof', tolerance=15*60, name='outdoor')
+        frame = aligner.update()                   # {'time': int64 epoch [ms], 'consumption': ..., ...}
+        frame = aligner.update(as_frame=True)      # pandas DataFrame, only the new bins are computed
+
+    Every column is either resampled (how='resample': aggregation of the samples inside each bin) or
+    as-of joined (how='asof': the newest sample at the bin's start, at most `tolerance` seconds old, or however old
+    with tolerance=None).
+    Bins are labelled by their start and counted from `origin` (epoch seconds).
+
+    update() is incremental: only the bins completed since the last update are read and aggregated,
+    the fill rules (cheap, vectorized) are applied to the whole frame when it is returned.
+    Samples arriving later than their bin was computed are not picked up, recompute(since) redoes a range.
+    '''
+    def __init__(self, reader, frequency, start, origin=0):
+        self.reader = reader
+        self.frequency = int(frequency*1000)
+        self.origin = int(origin*1000)
+        self.columns = {}
+        self.times = np.empty(0, dtype=np.int64)
+        self._values = {}
+        self._latest = {}        # as-of columns: (times, values) arrays of the newest sample seen, carried into the next update
+        self._start = self._floor(int(to_epoch(start)*1000))
+        self._complete_until = self._start
+
+    def add(self, sensor, device, column, how='resample', aggregation='mean', fill=None, fill_limit=None, tolerance=None,
+            name=None):
+        if how not in ('resample', 'asof'):
+            raise ValueError(f"Unknown join '{how}', expected 'resample' or 'asof'")
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{aggregation}', expected one of {AGGREGATIONS}")
+        if fill not in FILL_RULES:
+            raise ValueError(f"Unknown fill rule '{fill}', expected one of {FILL_RULES}")
+        name = name if name else column
+        self.columns[name] = {
+            'sensor': sensor, 'device': device, 'column': column, 'how': how, 'aggregation': aggregation,
+            'fill': fill, 'fill_limit': fill_limit, 'tolerance': tolerance*1000 if tolerance is not None else None
+        }
+        # A column added later is computed from the start on the next update
+        self.recompute(self._start)
+        return self
+
+    def update(self, end=None, as_frame=False):
+        '''
+        Computes the bins completed before `end` (datetime or epoch seconds, default now) and returns the frame.
+        '''
+        end_ms = int(to_epoch(end)*1000) if end is not None else int(np.datetime64('now', 'ms').astype(np.int64))
+        end_ms = self._floor(end_ms)
+        bins = (end_ms - self._complete_until)//self.frequency
+        if bins > 0:
+            new_times = self._complete_until + np.arange(bins, dtype=np.int64)*self.frequency
+            for name, spec in self.columns.items():
+                values = self._compute(name, spec, self._complete_until, end_ms, new_times)
+                previous = self._values.get(name)
+                self._values[name] = values if previous is None else np.concatenate([previous, values])
+            self.times = np.concatenate([self.times, new_times])
+            self._complete_until = end_ms
+        return self.frame(as_frame)
+
+    def recompute(self, since):
+        ''' Drops the bins from `since` (datetime or epoch seconds) on, the next update() computes them again '''
+        since_ms = max(self._floor(int(to_epoch(since)*1000)), self._start)
+        keep = self.times < since_ms
+        self.times = self.times[keep]
+        self._values = {name: values[keep] for name, values in self._values.items()} if keep.any() else {}
+        self._latest = {}
+        self._complete_until = min(self._complete_until, since_ms)
+
+    def frame(self, as_frame=False):
+        data = {'time': self.times}
+        for name, spec in self.columns.items():
+            values = self._values.get(name, np.full(len(self.times), np.nan))
+            data[name] = fill(values, spec['fill'], spec['fill_limit'])
+        if as_frame:
+            import pandas as pd
+            index = pd.to_datetime(data.pop('time'), unit='ms', utc=True)
+            return pd.DataFrame(data, index=index)
+        return data
+
+    def _compute(self, name, spec, start, end, targets):
+        if spec['how'] == 'resample':
+            data = self.reader.read(spec['sensor'], spec['device'], start/1000, end/1000, columns=[spec['column']])
+            return resample(data['time'], data[spec['column']], start, self.frequency, len(targets), spec['aggregation'])
+
+        # As-of: the newest sample before `start` comes from the previous update, or is looked up once:
+        # within tolerance, or without one the newest sample however old (reader.latest())
+        if name not in self._latest and spec['tolerance'] is None:
+            self._latest[name] = self.reader.latest(spec['sensor'], spec['device'], spec['column'], start/1000)
+        read_from = start if name in self._latest else start - spec['tolerance']
+        data = self.reader.read(spec['sensor'], spec['device'], read_from/1000, end/1000, columns=[spec['column']])
+        times, values = data['time'], data[spec['column']]
+        if name in self._latest:
+            latest_times, latest_values = self._latest[name]
+            times = np.concatenate([latest_times, times])
+            values = np.concatenate([latest_values, values]) if len(values) else latest_values
+        newest = np.flatnonzero(present(values))
+        if len(newest):
+            self._latest[name] = (times[newest[-1]:newest[-1] + 1], values[newest[-1]:newest[-1] + 1])
+        return asof(times, values, targets, spec['tolerance'])
+
+    def _floor(self, time_ms):
+        return (time_ms - self.origin)//self.frequency*self.frequency + self.origin
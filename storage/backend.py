@@ -0,0 +1,253 @@
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pytz
+
+from data_mining.storage.columnar import ColumnarBuffer
+from data_mining.storage.formats import get_format, write_columnar, COLUMNAR_FOLDER
+from data_mining.storage.segment_log import SegmentLog, read_frames, parse_segment_name, SEGMENT_SUFFIX
+from data_mining.storage.rollups import RollupStore, ROLLUP_FOLDER, to_floats
+from data_mining.storage.compaction import Compactor, SETTLE_TIME
+from data_mining.storage.sqlite_sink import write_sink
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+STORAGE_FORMATS = ['segment', 'npz', 'parquet', 'gorilla']
+
+
+class StorageBackend():
+    '''
+    Storage backend
+    ===============
+    Where a sensor's rows end up on disk, chosen by params['storage']['format']:
+        - 'segment' (default): rows stay in the append-only segment log (data/<sensor>/log)
+        - 'npz' / 'parquet' / 'gorilla': the segment log is only the write-ahead log. Once a day is closed, its
+          segments are sealed into one columnar file (data/<sensor>/columnar) and removed.
+
+    read() returns the same arrays independent of the format.
+
+    With rollups=True, hour/day/week/month aggregates of the numeric columns are updated on every append
+    (data/<sensor>/rollups, see RollupStore) and read with read_rollup().
+
+    With a sink (SQLiteSink, params['sqlite']) every appended batch is written to the database too.
+
+    compact() merges the per-session files of closed days into one file per day (see Compactor).
+
+    All methods hold the backend's lock, so the storage writer's thread can append while the sensor reads.
+    '''
+    def __init__(self, folder, sensor_name, session_id, schema, format='segment', rollups=True, sink=None):
+        if format not in STORAGE_FORMATS:
+            raise ValueError(f"Unknown storage format '{format}', expected one of {STORAGE_FORMATS}")
+        self.folder = Path(folder)
+        self.sensor_name = sensor_name
+        self.session_id = session_id
+        self.schema = schema
+        self.format = format
+        self.sink = sink
+        # Rows are appended by the storage writer's thread while the sensor reads on the event loop
+        self._lock = threading.RLock()
+        self.columnar_format = get_format(format) if format != 'segment' else None
+        self.log = SegmentLog(self.folder / 'log', sensor_name, session_id)
+        self._newest_day = None
+        self.rollup_metrics = [name for name, kind in schema.items() if kind in ('float', 'bool')]
+        self.rollups = RollupStore(self.folder / ROLLUP_FOLDER, sensor_name) if rollups else None
+        if self.rollups is not None and not self.rollups.exists():
+            # Data mined before rollups existed
+            self.rebuild_rollups()
+        if self.columnar_format:
+            (self.folder / COLUMNAR_FOLDER).mkdir(parents=True, exist_ok=True)
+            self.seal_closed_segments()
+
+    def append(self, rows):
+        with self._lock:
+            written = self.log.append(rows)
+            if self.sink is not None and rows:
+                write_sink(self.sink, self.sensor_name, rows, self.schema)
+            if self.rollups is not None and rows:
+                try:
+                    self._update_rollups(rows)
+                except Exception as e:
+                    logging.error(f"{self.sensor_name}: could not update the rollups: " + str(e))
+                    print(f"{self.sensor_name}: could not update the rollups: " + str(e))
+            if self.columnar_format and rows:
+                newest_day = max(datetime.fromtimestamp(row['time'], tz=LOCAL_TIMEZONE).date() for row in rows)
+                previous_day = self._newest_day
+                self._newest_day = max(newest_day, previous_day) if previous_day else newest_day
+                if previous_day is not None and newest_day > previous_day:
+                    self.seal_closed_segments()
+            return written
+
+    def _update_rollups(self, rows):
+        # Rows at or before the newest rolled up time (retried writes, re-polled hours, backfill) are not added
+        # again, the buckets they fall in are recomputed from the stored rows (this batch is in the log already)
+        new_rows, late_rows = self.rollups.split_late(rows)
+        self.rollups.add_rows(new_rows, self.rollup_metrics)
+        late_times = {}
+        for row in late_rows:
+            late_times.setdefault(row['device'], []).append(row['time'])
+        for device, times in late_times.items():
+            self.rollups.recompute(device, times, lambda start, end, device=device: self._read_unique(device, start, end))
+        self.rollups.flush()
+
+    def _read_unique(self, device, start=None, end=None):
+        # The rollup metrics of device with one sample per time, the last written wins (like compaction)
+        data = self.read(device, start, end, self.rollup_metrics)
+        last = np.ones(len(data['time']), dtype=bool)
+        last[:-1] = data['time'][1:] != data['time'][:-1]
+        return {name: values[last] for name, values in data.items()}
+
+    def newest_times(self, devices, start=None):
+        '''
+        Returns {device: newest stored time (epoch seconds)} for the devices with a row at or after start.
+        The rollups know the newest time of every device they track, the others are looked up in one pass over
+        the stored days, newest first, until every device is found.
+        '''
+        with self._lock:
+            newest = {}
+            if self.rollups is not None:
+                for device in devices:
+                    time = self.rollups.newest(device)
+                    if time is not None and (start is None or time >= start):
+                        newest[device] = time
+            missing = set(devices) - set(newest)
+            if not missing:
+                return newest
+            first_day = datetime.fromtimestamp(start, tz=LOCAL_TIMEZONE).date() if start is not None else None
+            days = {}
+            for path in self.log.segments() + self.columnar_files():
+                _, day, _ = parse_segment_name(path)
+                if first_day is None or day >= first_day:
+                    days.setdefault(day, []).append(path)
+            for day in sorted(days, reverse=True):
+                found = {}
+                for path in days[day]:
+                    if path.suffix == SEGMENT_SUFFIX:
+                        times = [(record['device'], record['time']) for record in read_frames(path)[0]]
+                    else:
+                        times = [(d['name'], d['max_time']) for d in self.columnar_format.meta(path)['devices']]
+                    for device, time in times:
+                        if device in missing and (start is None or time >= start):
+                            found[device] = max(found.get(device, time), time)
+                newest.update(found)
+                missing -= set(found)
+                if not missing:
+                    break
+            return newest
+
+    def sync(self):
+        with self._lock:
+            self.log.sync()
+
+    def close(self):
+        with self._lock:
+            self.log.close()
+            if self.columnar_format:
+                self.seal_closed_segments(include_open=True)
+
+    def seal_closed_segments(self, include_open=False):
+        '''
+        Converts the segments of closed days (every day before today) into columnar files.
+        With include_open=True the segments of this session for today are sealed too (used on close).
+        '''
+        with self._lock:
+            today = datetime.now(tz=LOCAL_TIMEZONE).date()
+            open_segments = self.log.open_segments()
+            sealed = 0
+            for path in self.log.segments():
+                _, day, session_id = parse_segment_name(path)
+                is_own_segment = self.log.is_own_session(session_id)
+                if path in open_segments:
+                    continue
+                if day >= today and not (include_open and is_own_segment):
+                    continue
+                if is_own_segment and day == self._newest_day and not include_open:
+                    continue
+                try:
+                    rows = read_frames(path)[0]
+                    write_columnar(self._sealed_path(path), rows, self.schema, self.columnar_format)
+                    path.unlink()
+                    sealed += 1
+                except Exception as e:
+                    logging.error(f"{self.sensor_name}: could not seal {path}: " + str(e))
+                    print(f"{self.sensor_name}: could not seal {path}: " + str(e))
+            return sealed
+
+    def _sealed_path(self, segment_path):
+        # Late rows for an already sealed day (e.g. Tibber's previous hour after midnight) get their own file
+        target = self.folder / COLUMNAR_FOLDER / (segment_path.stem + self.columnar_format.suffix)
+        sequence = 1
+        while target.exists():
+            target = self.folder / COLUMNAR_FOLDER / f"{segment_path.stem}-{sequence}{self.columnar_format.suffix}"
+            sequence += 1
+        return target
+
+    def rebuild_rollups(self):
+        '''
+        Recomputes the rollups from every stored row (segments and columnar files), rows stored twice are counted once.
+        '''
+        with self._lock:
+            self.rollups.clear()
+            devices = set()
+            for path in self.log.segments():
+                devices.update(row['device'] for row in read_frames(path)[0])
+            for path in self.columnar_files():
+                devices.update(d['name'] for d in self.columnar_format.meta(path)['devices'])
+            for device in sorted(devices):
+                data = self._read_unique(device)
+                columns = {name: to_floats(values) for name, values in data.items() if name != 'time'}
+                self.rollups.add(device, data['time']/1000, columns)
+            return self.rollups.flush()
+
+    def read_rollup(self, device, metric, granularity, start=None, end=None):
+        '''
+        Returns {'time': int64 epoch [ms], 'count', 'sum', 'min', 'max', 'last', 'mean'} per hour/day/week/month bucket
+        '''
+        with self._lock:
+            return self.rollups.read(device, metric, granularity, start, end)
+
+    def compact(self, settle_time=SETTLE_TIME):
+        '''
+        Merges the fragments of closed days, the lock is only held to swap the merged files in
+        '''
+        compactor = Compactor(self.folder, self.sensor_name, self.schema, settle_time,
+                              lock=self._lock, open_segments=self.log.open_segments)
+        return compactor.compact()
+
+    def columnar_files(self):
+        if not self.columnar_format:
+            return []
+        return sorted((self.folder / COLUMNAR_FOLDER).glob(f"{self.sensor_name}_*{self.columnar_format.suffix}"))
+
+    def read(self, device, start=None, end=None, columns=None):
+        '''
+        Returns {'time': int64 epoch [ms], <column>: array, ...} for start <= time < end (epoch seconds, None = unbounded)
+        '''
+        with self._lock:
+            columns = columns if columns is not None else list(self.schema)
+            first_day = datetime.fromtimestamp(start, tz=LOCAL_TIMEZONE).date() if start is not None else None
+            last_day = datetime.fromtimestamp(end, tz=LOCAL_TIMEZONE).date() if end is not None else None
+
+            parts = []
+            for path in self.columnar_files():
+                _, day, _ = parse_segment_name(path)
+                if (first_day and day < first_day) or (last_day and day > last_day):
+                    continue
+                data = self.columnar_format.read(path, device, columns)
+                if data is not None:
+                    parts.append(data)
+
+            from_log = ColumnarBuffer(self.schema)
+            for record in self.log.read_range(start, end, device=device):
+                from_log.append(int(round(record['time']*1000)), record['values'])
+            parts.append({name: values for name, values in from_log.to_dict().items() if name == 'time' or name in columns})
+
+            data = {name: np.concatenate([part[name] for part in parts]) for name in ['time'] + columns}
+            in_range = np.ones(len(data['time']), dtype=bool)
+            if start is not None:
+                in_range &= data['time'] >= start*1000
+            if end is not None:
+                in_range &= data['time'] < end*1000
+            order = np.argsort(data['time'][in_range], kind='stable')
+            return {name: values[in_range][order] for name, values in data.items()}
@@ -0,0 +1,258 @@
+import struct
+
+import numpy as np
+
+from data_mining.storage.columnar import COLUMN_DTYPES
+
+# A block is: rows (uint32) | streams (uint16) | byte length of every stream (uint32 each) | streams
+# with the time stream first, then one stream per schema column
+BLOCK_HEADER = struct.Struct('<IH')
+STREAM_LENGTH = struct.Struct('<I')
+# Float streams start with their encoding: XOR, or scaled integers (values with at most MAX_DECIMALS decimals)
+FLOAT_XOR = 0
+FLOAT_DECIMAL = 1
+FLOAT_HEADER = struct.Struct('<BBI')  # encoding | decimals | byte length of the missing value runs
+MAX_DECIMALS = 6
+MASK_64 = (1 << 64) - 1
+
+
+class BitWriter():
+    def __init__(self):
+        self._bytes = bytearray()
+        self._buffer = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        self._buffer = (self._buffer << bits) | (value & ((1 << bits) - 1))
+        self._bits += bits
+        while self._bits >= 8:
+            self._bits -= 8
+            self._bytes.append((self._buffer >> self._bits) & 0xFF)
+        self._buffer &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            return bytes(self._bytes) + bytes([(self._buffer << (8 - self._bits)) & 0xFF])
+        return bytes(self._bytes)
+
+
+class BitReader():
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+
+    def read(self, bits):
+        value = 0
+        while bits:
+            offset = self._position & 7
+            available = 8 - offset
+            take = available if available < bits else bits
+            byte = self._data[self._position >> 3]
+            value = (value << take) | ((byte >> (available - take)) & ((1 << take) - 1))
+            self._position += take
+            bits -= take
+        return value
+
+
+def encode_timestamps(times):
+    '''
+    int64 epoch [ms] -> the first time, the first delta and then the deltas-of-deltas, run-length encoded.
+    A regular sampling interval makes every delta-of-delta 0, so a whole day is a few bytes.
+    '''
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) == 0:
+        return b''
+    return encode_runs(np.concatenate([times[:1], np.diff(times[:2]), np.diff(times, 2)]))
+
+
+def decode_timestamps(data, count):
+    values = decode_runs(data, count, np.int64)
+    if count < 2:
+        return values
+    # values[1] is the first delta, the rest are deltas-of-deltas
+    deltas = np.cumsum(values[1:])
+    return np.concatenate([values[:1], values[0] + np.cumsum(deltas)])
+
+
+def encode_xor(values):
+    '''
+    float64 -> Gorilla XOR encoding: the first value as 64 bits, then the XOR with the previous value:
+        '0'                                             same value (missing values repeat as NaN too)
+        '10' + meaningful bits                          the XOR fits in the previous leading/trailing zero window
+        '11' + leading zeros (5) + length - 1 (6) + bits  a new window
+    '''
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+    writer = BitWriter()
+    if len(bits) == 0:
+        return b''
+    writer.write(int(bits[0]), 64)
+    leading, trailing = None, None
+    for xor in (bits[1:] ^ bits[:-1]).tolist():
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if leading is not None and new_leading >= leading and new_trailing >= trailing:
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+            continue
+        leading, trailing = new_leading, new_trailing
+        meaningful = 64 - leading - trailing
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        writer.write(meaningful - 1, 6)
+        writer.write(xor >> trailing, meaningful)
+    return writer.getvalue()
+
+
+def decode_xor(data, count):
+    if count == 0:
+        return np.empty(0, dtype=np.float64)
+    reader = BitReader(data)
+    value = reader.read(64)
+    values = [value]
+    meaningful, trailing = 64, 0
+    for _ in range(count - 1):
+        if reader.read(1) == 0:
+            values.append(value)
+            continue
+        if reader.read(1) == 1:
+            leading = reader.read(5)
+            meaningful = reader.read(6) + 1
+            trailing = 64 - leading - meaningful
+        value ^= reader.read(meaningful) << trailing
+        values.append(value)
+    return np.array(values, dtype=np.uint64).view(np.float64)
+
+
+def _write_varint(buffer, value):
+    # Zigzag, so the missing code (-1) and negative deltas stay short
+    value = ((value << 1) ^ (value >> 63)) & MASK_64
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varints(data):
+    # Vectorized: every byte below 0x80 ends a value, the 7 bit groups before it are little endian
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if len(raw) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    position = np.arange(len(raw)) - np.repeat(starts, ends - starts + 1)
+    groups = (raw & 0x7F).astype(np.uint64) << (7*position).astype(np.uint64)
+    values = np.bitwise_or.reduceat(groups, starts)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def encode_runs(codes):
+    '''
+    int codes -> run-length encoding: (code, run length) zigzag varint pairs.
+    AC states keep their value for hours, so a day of bool / category codes is usually a handful of runs.
+    '''
+    codes = np.asarray(codes, dtype=np.int64)
+    if len(codes) == 0:
+        return b''
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+    lengths = np.diff(np.concatenate([starts, [len(codes)]]))
+    buffer = bytearray()
+    for code, length in zip(codes[starts].tolist(), lengths.tolist()):
+        _write_varint(buffer, code)
+        _write_varint(buffer, length)
+    return bytes(buffer)
+
+
+def decode_runs(data, count, dtype=np.int32):
+    pairs = _read_varints(data)
+    decoded = np.repeat(pairs[0::2].astype(dtype), pairs[1::2])
+    if len(decoded) != count:
+        raise ValueError(f"Run-length stream holds {len(decoded)} values, expected {count}")
+    return decoded
+
+
+def _decimals(values):
+    # The fewest decimals that reproduce every value exactly, None if there are more than MAX_DECIMALS
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10.0**decimals
+        scaled = np.round(values*scale)
+        if np.all(np.abs(scaled) < 2**53) and np.array_equal((scaled.astype(np.int64)/scale).view(np.uint64), values.view(np.uint64)):
+            return decimals
+    return None
+
+
+def encode_floats(values):
+    '''
+    float64 -> one of two encodings, whichever fits the column:
+        - decimal: measurements with few decimals (21.5 °C, 40.2 %) are scaled to integers, their deltas are
+          run-length encoded (slowly changing and constant columns become a few runs), missing values are
+          stored as runs of a mask
+        - XOR: Gorilla XOR encoding (see encode_xor) for any other floats
+    '''
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    present = values[~missing]
+    decimals = _decimals(present) if np.all(np.isfinite(present)) else None
+    if decimals is None:
+        return FLOAT_HEADER.pack(FLOAT_XOR, 0, 0) + encode_xor(values)
+    scaled = np.round(present*10.0**decimals).astype(np.int64)
+    missing_runs = encode_runs(missing) if missing.any() else b''
+    deltas = np.diff(scaled, prepend=0) if len(scaled) else scaled
+    return FLOAT_HEADER.pack(FLOAT_DECIMAL, decimals, len(missing_runs)) + missing_runs + encode_runs(deltas)
+
+
+def decode_floats(data, count):
+    if count == 0:
+        return np.empty(0, dtype=np.float64)
+    encoding, decimals, missing_length = FLOAT_HEADER.unpack_from(data, 0)
+    data = data[FLOAT_HEADER.size:]
+    if encoding == FLOAT_XOR:
+        return decode_xor(data, count)
+    missing = decode_runs(data[:missing_length], count, bool) if missing_length else np.zeros(count, dtype=bool)
+    present = int(count - missing.sum())
+    values = np.full(count, np.nan)
+    values[~missing] = np.cumsum(decode_runs(data[missing_length:], present, np.int64))/10.0**decimals
+    return values
+
+
+def encode_column(kind, raw):
+    return encode_floats(raw) if kind == 'float' else encode_runs(raw)
+
+
+def decode_column_stream(kind, data, count):
+    return decode_floats(data, count) if kind == 'float' else decode_runs(data, count, COLUMN_DTYPES[kind])
+
+
+def encode_block(times, columns, schema):
+    '''
+    Encodes one device's series: times (int64 epoch [ms]) and the raw columns of a ColumnarBuffer
+    (float64 for 'float', int codes for 'bool' / 'category', see ColumnarBuffer.column()) in schema order.
+    '''
+    streams = [encode_timestamps(times)] + [encode_column(kind, columns[name]) for name, kind in schema.items()]
+    return (BLOCK_HEADER.pack(len(times), len(streams))
+            + b''.join(STREAM_LENGTH.pack(len(stream)) for stream in streams)
+            + b''.join(streams))
+
+
+def decode_block(block, schema, columns=None):
+    '''
+    Returns {'time': int64 epoch [ms], <column>: raw array} of an encoded block.
+    Only the streams of the requested columns are decoded, the others are skipped.
+    '''
+    block = memoryview(block)
+    count, stream_count = BLOCK_HEADER.unpack_from(block, 0)
+    offset = BLOCK_HEADER.size
+    lengths = [STREAM_LENGTH.unpack_from(block, offset + i*STREAM_LENGTH.size)[0] for i in range(stream_count)]
+    offset += stream_count*STREAM_LENGTH.size
+    streams = []
+    for length in lengths:
+        streams.append(block[offset:offset+length])
+        offset += length
+    columns = columns if columns is not None else list(schema)
+    data = {'time': decode_timestamps(streams[0], count)}
+    for stream, (name, kind) in zip(streams[1:], schema.items()):
+        if name in columns:
+            data[name] = decode_column_stream(kind, stream, count)
+    return data
@@ -0,0 +1,216 @@
+import math
+import numpy as np
+
+# Column kinds and how they are stored
+#   float    -> float64, missing = NaN
+#   bool     -> int8 (0/1), missing = -1
+#   category -> int32 codes into a per-column dictionary, missing = -1
+COLUMN_DTYPES = {
+    'float': np.float64,
+    'bool': np.int8,
+    'category': np.int32
+}
+MISSING_CODE = -1
+INITIAL_CAPACITY = 64
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def decode_column(kind, raw, categories=None):
+    '''
+    Translates stored bool/category codes back to their values (None for missing)
+    '''
+    if kind == 'category':
+        lookup = np.array(list(categories) + [None], dtype=object)
+        return lookup[raw]  # MISSING_CODE (-1) picks the trailing None
+    if kind == 'bool':
+        lookup = np.array([False, True, None], dtype=object)
+        return lookup[raw]
+    return raw
+
+
+class ColumnarBuffer():
+    '''
+    Columnar buffer
+    ===============
+    Compact, array-backed time series for one device.
+
+    Timestamps are stored as int64 epoch milliseconds, measurements as float64 and states as
+    dictionary encoded categoricals (e.g. mode, fanLevel). The arrays grow by doubling, so appending
+    is amortized O(1), and only the filled part is pickled. Rows are kept sorted by time.
+
+    schema: {column_name: 'float' | 'bool' | 'category'}
+    '''
+    def __init__(self, schema, capacity=INITIAL_CAPACITY):
+        for name, kind in schema.items():
+            if kind not in COLUMN_DTYPES:
+                raise ValueError(f"Column '{name}' has unknown kind '{kind}', expected one of {list(COLUMN_DTYPES)}")
+        self.schema = dict(schema)
+        self.categories = {name: [] for name, kind in self.schema.items() if kind == 'category'}
+        self._category_codes = {name: {} for name in self.categories}
+        self._size = 0
+        self._times = np.empty(capacity, dtype=np.int64)
+        self._columns = {name: np.empty(capacity, dtype=COLUMN_DTYPES[kind]) for name, kind in self.schema.items()}
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def times(self):
+        ''' int64 epoch milliseconds '''
+        return self._times[:self._size]
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + sum(self.column(name).nbytes for name in self.schema)
+
+    def column(self, name):
+        ''' Raw column (category columns are returned as int32 codes, see decoded()) '''
+        return self._columns[name][:self._size]
+
+    def decoded(self, name):
+        ''' Column with the category codes translated back to their values (None for missing) '''
+        return decode_column(self.schema[name], self.column(name), self.categories.get(name))
+
+    def append(self, time_ms, values):
+        if self._size == len(self._times):
+            self._grow(2*len(self._times))
+        i = self._size
+        if i > 0 and time_ms < self._times[i-1]:
+            # Rows arriving out of order (e.g. backfilled history) are inserted so the buffer stays sorted by time
+            i = int(np.searchsorted(self.times, time_ms, side='right'))
+            self._times[i+1:self._size+1] = self._times[i:self._size]
+            for name in self.schema:
+                self._columns[name][i+1:self._size+1] = self._columns[name][i:self._size]
+        self._times[i] = time_ms
+        for name, kind in self.schema.items():
+            self._columns[name][i] = self._encode(name, kind, values.get(name))
+        self._size += 1
+
+    def drop_head(self, count):
+        '''
+        Removes the oldest `count` rows (they are expected to be durable on disk already)
+        '''
+        count = min(count, self._size)
+        remaining = self._size - count
+        self._times[:remaining] = self._times[count:self._size]
+        for name in self.schema:
+            self._columns[name][:remaining] = self._columns[name][count:self._size]
+        self._size = remaining
+        # Give memory back if the buffer is mostly empty after the eviction
+        if len(self._times) > 4*max(self._size, INITIAL_CAPACITY):
+            self._resize(2*max(self._size, INITIAL_CAPACITY))
+        return count
+
+    def to_dict(self, decode=True):
+        data = {'time': self.times.copy()}
+        for name in self.schema:
+            data[name] = self.decoded(name).copy() if decode else self.column(name).copy()
+        return data
+
+    def _encode(self, name, kind, value):
+        if kind == 'float':
+            return np.nan if is_missing(value) else float(value)
+        if kind == 'bool':
+            return MISSING_CODE if is_missing(value) else int(bool(value))
+        if is_missing(value):
+            return MISSING_CODE
+        codes = self._category_codes[name]
+        if value not in codes:
+            codes[value] = len(self.categories[name])
+            self.categories[name].append(value)
+        return codes[value]
+
+    def _grow(self, capacity):
+        self._resize(max(capacity, INITIAL_CAPACITY))
+
+    def _resize(self, capacity):
+        times = np.empty(capacity, dtype=np.int64)
+        times[:self._size] = self.times
+        self._times = times
+        for name, kind in self.schema.items():
+            column = np.empty(capacity, dtype=COLUMN_DTYPES[kind])
+            column[:self._size] = self.column(name)
+            self._columns[name] = column
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_times'] = self.times.copy()
+        state['_columns'] = {name: self.column(name).copy() for name in self.schema}
+        return state
+
+
+class TimeSeriesStore():
+    '''
+    Time series store
+    =================
+    The in-memory data of a sensor: one ColumnarBuffer per device, all sharing the same schema.
+    This is the API every Sensor writes its samples through (see Sensor._record).
+
+    Retention (optional, per device):
+        - retention_rows: keep at most this many of the newest rows in memory
+        - retention_seconds: keep only rows newer than this many seconds before the newest row
+    Older rows are evicted in batches by evict(), once they are durable on disk. keep_from ({device: epoch
+    seconds}) protects the rows that are not durable yet: rows at or after it are never evicted.
+    '''
+    def __init__(self, schema, retention_rows=None, retention_seconds=None):
+        self.schema = dict(schema)
+        self.retention_rows = retention_rows
+        self.retention_seconds = retention_seconds
+        self._buffers = {}
+
+    def append(self, device, time, values):
+        '''
+        time: epoch seconds
+        '''
+        if device not in self._buffers:
+            self._buffers[device] = ColumnarBuffer(self.schema)
+        self._buffers[device].append(int(round(time*1000)), values)
+
+    def devices(self):
+        return list(self._buffers)
+
+    def needs_eviction(self, keep_from=None):
+        keep_from = keep_from if keep_from else {}
+        return any(self._rows_to_evict(buffer, keep_from.get(device)) > 0 for device, buffer in self._buffers.items())
+
+    def evict(self, keep_from=None):
+        '''
+        Drops the rows outside the retention window (older than keep_from[device]). Returns the number of rows evicted.
+        '''
+        keep_from = keep_from if keep_from else {}
+        evicted = 0
+        for device, buffer in self._buffers.items():
+            count = self._rows_to_evict(buffer, keep_from.get(device))
+            if count > 0:
+                evicted += buffer.drop_head(count)
+        return evicted
+
+    def _rows_to_evict(self, buffer, keep_from=None):
+        count = 0
+        if self.retention_rows is not None:
+            count = max(count, len(buffer) - self.retention_rows)
+        if self.retention_seconds is not None and len(buffer) > 0:
+            cutoff = buffer.times.max() - int(self.retention_seconds*1000)
+            count = max(count, int(np.searchsorted(buffer.times, cutoff, side='left')))
+        if keep_from is not None:
+            count = min(count, int(np.searchsorted(buffer.times, int(round(keep_from*1000)), side='left')))
+        # Evict in batches of at least 1/8 of the window, so the arrays are not shifted on every sample
+        if count < max(1, len(buffer)//8):
+            return 0
+        return count
+
+    def __getitem__(self, device):
+        return self._buffers[device]
+
+    def __contains__(self, device):
+        return device in self._buffers
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self._buffers.values())
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self._buffers.values())
@@ -0,0 +1,222 @@
+import logging
+import os
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+
+import pytz
+
+from data_mining.metrics import METRICS
+from data_mining.storage.segment_log import encode_frame, read_frames, parse_segment_name, SEGMENT_SUFFIX
+from data_mining.storage.formats import FORMATS, write_columnar, sync_folder, COLUMNAR_FOLDER
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+COMPACTED_SESSION = 'compacted'
+SETTLE_TIME = 60*60  # [seconds]
+
+
+def deduplicate(rows):
+    '''
+    Keeps the last written row per (device, time) and sorts the rows by time (then device)
+    '''
+    unique_rows = {}
+    for row in rows:
+        unique_rows[(row['device'], int(round(row['time']*1000)))] = row
+    return [unique_rows[key] for key in sorted(unique_rows, key=lambda key: (key[1], key[0]))]
+
+
+def columnar_rows(path, columnar_format):
+    '''
+    Reads every device of a columnar file back into rows ({'device', 'time' [epoch seconds], 'values'})
+    '''
+    rows = []
+    for device in [d['name'] for d in columnar_format.meta(path)['devices']]:
+        data = columnar_format.read(path, device)
+        columns = [name for name in data if name != 'time']
+        for i, time_ms in enumerate(data['time']):
+            rows.append({
+                'device': device,
+                'time': int(time_ms)/1000,
+                'values': {name: _plain(data[name][i]) for name in columns}
+            })
+    return rows
+
+
+def _plain(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+class Compactor():
+    '''
+    Compaction
+    ==========
+    Every session (process run) writes its own fragments, data/<sensor>/log/<sensor>_<YYYY-MM-DD>__<session_id>.seg
+    (and data/<sensor>/columnar/<sensor>_<YYYY-MM-DD>__<session_id>.<format> once sealed), so frequent restarts
+    leave many overlapping files per day. compact() merges the fragments of every closed day (before today) into a
+    single time sorted, deduplicated file per sensor and day:
+
+        <sensor>_<YYYY-MM-DD>__compacted.seg / .npz / .parquet
+
+    holding all devices of that day. Rows with the same device and time are kept once (the last written).
+
+    Safe while mining continues: the merged file is written next to the fragments and renamed into place, and
+    the fragments are only removed after that. Days with a fragment that is still open, or was modified within
+    settle_time seconds (e.g. late Tibber rows after midnight, another process still writing), are left for the
+    next run. Only one compaction should run at a time per data folder.
+
+    compactor = Compactor('data/sensibo', 'sensibo')
+    compactor.compact()   # {'days': ..., 'files': ..., 'rows': ..., 'duplicates': ...}
+    '''
+    def __init__(self, folder, sensor_name, schema=None, settle_time=SETTLE_TIME, lock=None, open_segments=None):
+        self.folder = Path(folder)
+        self.sensor_name = sensor_name
+        self.schema = schema
+        self.settle_time = settle_time
+        # The storage backend passes its lock and open segments, the swap is then atomic for its writer too
+        self._lock = lock if lock is not None else nullcontext()
+        self._open_segments = open_segments if open_segments is not None else list
+
+    def compact(self, today=None):
+        today = today if today else datetime.now(tz=LOCAL_TIMEZONE).date()
+        stats = {'days': 0, 'files': 0, 'rows': 0, 'duplicates': 0}
+        self._remove_temporary_files()
+        for day, paths in self._closed_days(self.folder / 'log', SEGMENT_SUFFIX, today):
+            self._add(stats, self._compact_segments(day, paths))
+        for columnar_format in FORMATS.values():
+            for day, paths in self._closed_days(self.folder / COLUMNAR_FOLDER, columnar_format.suffix, today):
+                self._add(stats, self._compact_columnar(day, paths, columnar_format))
+        METRICS.inc('datamining_compacted_files_total', stats['files'], source=self.sensor_name)
+        METRICS.inc('datamining_compaction_duplicates_total', stats['duplicates'], source=self.sensor_name)
+        return stats
+
+    def _closed_days(self, folder, suffix, today):
+        fragments_per_day = {}
+        for path in sorted(folder.glob(f"{self.sensor_name}_*{suffix}")):
+            try:
+                _, day, _ = parse_segment_name(path)
+            except ValueError:
+                continue
+            if day < today:
+                fragments_per_day.setdefault(day, []).append(path)
+        for day, paths in sorted(fragments_per_day.items()):
+            # A day that is compacted already and got no new fragments since is skipped
+            if len(paths) == 1 and parse_segment_name(paths[0])[2] == COMPACTED_SESSION:
+                continue
+            # The merged file is read first, so rows written later by a session win
+            paths.sort(key=lambda path: parse_segment_name(path)[2] != COMPACTED_SESSION)
+            yield day, paths
+
+    def _is_settled(self, paths):
+        with self._lock:
+            open_segments = set(self._open_segments())
+        now = time.time()
+        for path in paths:
+            if path in open_segments:
+                return False
+            if now - path.stat().st_mtime < self.settle_time:
+                return False
+        return True
+
+    def _compact_segments(self, day, paths):
+        if not self._is_settled(paths):
+            return None
+        try:
+            sizes = {path: path.stat().st_size for path in paths}
+            rows = []
+            for path in paths:
+                rows += read_frames(path)[0]
+            unique_rows = deduplicate(rows)
+            target = self._target(day, SEGMENT_SUFFIX, self.folder / 'log')
+            temporary_path = target.with_name(target.name + '.tmp')
+            with open(temporary_path, 'wb') as f:
+                f.write(b''.join(encode_frame(row) for row in unique_rows))
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock:
+                # A late row may have been appended to a fragment (or reopened it) while merging
+                changed = [path for path in paths if not path.exists() or path.stat().st_size != sizes[path]
+                           or path in self._open_segments()]
+                if changed:
+                    temporary_path.unlink()
+                    return None
+                os.replace(temporary_path, target)
+                sync_folder(target.parent)
+                self._remove_fragments(paths, target)
+        except Exception as e:
+            logging.error(f"{self.sensor_name}: could not compact the segments of {day}: " + str(e))
+            print(f"{self.sensor_name}: could not compact the segments of {day}: " + str(e))
+            return None
+        return {'days': 1, 'files': len(paths), 'rows': len(unique_rows), 'duplicates': len(rows) - len(unique_rows)}
+
+    def _compact_columnar(self, day, paths, columnar_format):
+        # Sealed files are never appended to, only new ones appear (and are left for the next run)
+        if not self._is_settled(paths):
+            return None
+        try:
+            rows = []
+            schema = dict(self.schema) if self.schema else {}
+            for path in paths:
+                rows += columnar_rows(path, columnar_format)
+                for name, kind in columnar_format.meta(path)['schema'].items():
+                    schema.setdefault(name, kind)
+            unique_rows = deduplicate(rows)
+            if not unique_rows:
+                return None
+            target = self._target(day, columnar_format.suffix, self.folder / COLUMNAR_FOLDER)
+            temporary_path = write_columnar(target.with_name(target.name + '.tmp'), unique_rows, schema, columnar_format)
+            with self._lock:
+                # Sealing checks for existing names under the same lock, so it never picks the merged file's name
+                os.replace(temporary_path, target)
+                sync_folder(target.parent)
+                self._remove_fragments(paths, target)
+        except Exception as e:
+            logging.error(f"{self.sensor_name}: could not compact the {columnar_format.suffix} files of {day}: " + str(e))
+            print(f"{self.sensor_name}: could not compact the {columnar_format.suffix} files of {day}: " + str(e))
+            return None
+        return {'days': 1, 'files': len(paths), 'rows': len(unique_rows), 'duplicates': len(rows) - len(unique_rows)}
+
+    def _target(self, day, suffix, folder):
+        return folder / f"{self.sensor_name}_{day.strftime('%Y-%m-%d')}__{COMPACTED_SESSION}{suffix}"
+
+    def _remove_fragments(self, paths, target):
+        for path in paths:
+            if path != target:
+                path.unlink()
+
+    def _remove_temporary_files(self):
+        # Left behind by a compaction that was interrupted before the rename, the fragments are still complete
+        for folder in [self.folder / 'log', self.folder / COLUMNAR_FOLDER]:
+            for path in folder.glob(f"{self.sensor_name}_*__{COMPACTED_SESSION}.*.tmp"):
+                path.unlink()
+
+    def _add(self, stats, result):
+        if result is None:
+            return
+        for key in stats:
+            stats[key] += result[key]
+
+
+def compact_tree(basedir='data', settle_time=SETTLE_TIME):
+    '''
+    Compacts the closed days of every sensor in basedir (data/<sensor>/...), e.g. while no miner is running
+    '''
+    results = {}
+    for sensor_folder in sorted(p for p in Path(basedir).iterdir() if p.is_dir()):
+        if not (sensor_folder / 'log').is_dir() and not (sensor_folder / COLUMNAR_FOLDER).is_dir():
+            continue
+        results[sensor_folder.name] = Compactor(sensor_folder, sensor_folder.name, settle_time=settle_time).compact()
+        stats = results[sensor_folder.name]
+        print(f"{sensor_folder.name}: merged {stats['files']} files into {stats['days']} days, "
+              f"{stats['rows']} rows, {stats['duplicates']} duplicates removed")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Merge the per session files of closed days into one file per sensor and day')
+    parser.add_argument('basedir', type = str, nargs = '?', default = 'data')
+    parser.add_argument('--settle-time', type = float, default = SETTLE_TIME,
+                        help = 'skip days with files modified within this many seconds')
+    args = parser.parse_args()
+    compact_tree(args.basedir, args.settle_time)
@@ -0,0 +1,407 @@
+import json
+import logging
+import os
+import pickle
+import struct
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pytz
+
+from data_mining.storage.columnar import ColumnarBuffer, decode_column, is_missing
+from data_mining.storage.codec import encode_block, decode_block
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+COLUMNAR_FOLDER = 'columnar'
+GORILLA_MAGIC = b'DMTS'
+GORILLA_HEADER = struct.Struct('<4sI')  # magic | byte length of the json meta
+
+
+def infer_schema(rows):
+    '''
+    Column kinds for rows without a known schema: bool -> 'bool', numbers -> 'float', anything else -> 'category'
+    '''
+    schema = {}
+    for row in rows:
+        for name, value in row['values'].items():
+            if is_missing(value) or schema.get(name) == 'category':
+                continue
+            if isinstance(value, bool):
+                kind = 'bool'
+            elif isinstance(value, (int, float)):
+                kind = 'float'
+            else:
+                kind = 'category'
+            if name in schema and schema[name] != kind:
+                kind = 'category'
+            schema[name] = kind
+    return schema
+
+
+def rows_to_buffers(rows, schema):
+    '''
+    Groups rows ({'device', 'time' [epoch seconds], 'values'}) into one time sorted ColumnarBuffer per device
+    '''
+    buffers = {}
+    for row in sorted(rows, key=lambda row: row['time']):
+        if row['device'] not in buffers:
+            buffers[row['device']] = ColumnarBuffer(schema)
+        buffers[row['device']].append(int(round(row['time']*1000)), row['values'])
+    return buffers
+
+
+def device_stats(buffer):
+    return {
+        'min_time': int(buffer.times.min())/1000,
+        'max_time': int(buffer.times.max())/1000,
+        'rows': len(buffer)
+    }
+
+
+class NpzFormat():
+    '''
+    NPZ format
+    ==========
+    One zip archive of deflate compressed arrays per file: '<i>.time' (datetime64[ms]) and
+    '<i>.<column>' for device number i, plus a json 'meta' entry with the schema, devices,
+    their time ranges and category dictionaries. np.load only decompresses the arrays that
+    are accessed, so reading one column does not load the others.
+    '''
+    suffix = '.npz'
+
+    def write(self, path, buffers, schema):
+        arrays = {}
+        meta = {'schema': schema, 'devices': []}
+        for i, (device, buffer) in enumerate(buffers.items()):
+            arrays[f'{i}.time'] = buffer.times.astype('datetime64[ms]')
+            for name in schema:
+                arrays[f'{i}.{name}'] = buffer.column(name)
+            meta['devices'].append({'name': device, 'categories': buffer.categories, **device_stats(buffer)})
+        arrays['meta'] = np.array(json.dumps(meta))
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    def meta(self, path):
+        with np.load(path) as npz:
+            return json.loads(str(npz['meta']))
+
+    def read(self, path, device, columns=None):
+        with np.load(path) as npz:
+            meta = json.loads(str(npz['meta']))
+            names = [d['name'] for d in meta['devices']]
+            if device not in names:
+                return None
+            i = names.index(device)
+            columns = columns if columns is not None else list(meta['schema'])
+            data = {'time': npz[f'{i}.time'].astype(np.int64)}
+            for name in columns:
+                if name not in meta['schema']:
+                    continue
+                categories = meta['devices'][i]['categories'].get(name)
+                data[name] = decode_column(meta['schema'][name], npz[f'{i}.{name}'], categories)
+            return data
+
+
+class ParquetFormat():
+    '''
+    Parquet format (requires pyarrow)
+    =================================
+    One zstd compressed row group per device with a dictionary encoded 'device' column,
+    'time' as timestamp[ms, UTC] and dictionary encoded category columns. The schema, devices
+    and their time ranges are stored in the file metadata.
+    '''
+    suffix = '.parquet'
+
+    def write(self, path, buffers, schema):
+        import pyarrow.parquet as pq
+        meta = {'schema': schema, 'devices': [
+            {'name': device, **device_stats(buffer)} for device, buffer in buffers.items()
+        ]}
+        tables = [self._to_table(device, buffer, schema) for device, buffer in buffers.items()]
+        arrow_schema = tables[0].schema.with_metadata({'datamining': json.dumps(meta)})
+        with pq.ParquetWriter(path, arrow_schema, compression='zstd') as writer:
+            for table in tables:
+                writer.write_table(table.cast(arrow_schema))
+
+    def meta(self, path):
+        import pyarrow.parquet as pq
+        return json.loads(pq.read_schema(path).metadata[b'datamining'])
+
+    def read(self, path, device, columns=None):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        meta = json.loads(parquet_file.schema_arrow.metadata[b'datamining'])
+        names = [d['name'] for d in meta['devices']]
+        if device not in names:
+            return None
+        columns = [name for name in (columns if columns is not None else meta['schema']) if name in meta['schema']]
+        table = parquet_file.read_row_group(names.index(device), columns=['time'] + columns)
+        data = {'time': table.column('time').cast('int64').to_numpy()}
+        for name in columns:
+            if meta['schema'][name] == 'float':
+                data[name] = table.column(name).to_numpy()
+            else:
+                data[name] = np.array(table.column(name).to_pylist(), dtype=object)
+        return data
+
+    def _to_table(self, device, buffer, schema):
+        import pyarrow as pa
+        arrays = {
+            'device': pa.DictionaryArray.from_arrays(
+                pa.array(np.zeros(len(buffer), dtype=np.int32)), pa.array([device])),
+            'time': pa.array(buffer.times, type=pa.timestamp('ms', tz='UTC'))
+        }
+        for name, kind in schema.items():
+            raw = buffer.column(name)
+            if kind == 'float':
+                arrays[name] = pa.array(raw, type=pa.float64())
+            elif kind == 'bool':
+                arrays[name] = pa.array(raw == 1, mask=raw < 0, type=pa.bool_())
+            else:
+                categories = [str(c) for c in buffer.categories[name]]
+                arrays[name] = pa.DictionaryArray.from_arrays(
+                    pa.array(raw, mask=raw < 0, type=pa.int32()), pa.array(categories, type=pa.string()))
+        return pa.table(arrays)
+
+
+class GorillaFormat():
+    '''
+    Gorilla format
+    ==============
+    Time series specific compression (see storage.codec): one block per device with delta-of-delta
+    timestamps, XOR encoded floats and run-length encoded bool/category columns, behind a json 'meta'
+    header with the schema, devices, their time ranges, category dictionaries and block positions.
+    Reading one column decodes only the time stream and that column's stream.
+    '''
+    suffix = '.tsz'
+
+    def write(self, path, buffers, schema):
+        blocks = []
+        meta = {'schema': schema, 'devices': []}
+        offset = 0
+        for device, buffer in buffers.items():
+            block = encode_block(buffer.times, {name: buffer.column(name) for name in schema}, schema)
+            meta['devices'].append({'name': device, 'categories': buffer.categories, 'offset': offset,
+                                    'length': len(block), **device_stats(buffer)})
+            blocks.append(block)
+            offset += len(block)
+        encoded_meta = json.dumps(meta).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(GORILLA_HEADER.pack(GORILLA_MAGIC, len(encoded_meta)))
+            f.write(encoded_meta)
+            f.write(b''.join(blocks))
+
+    def meta(self, path):
+        with open(path, 'rb') as f:
+            return self._read_meta(f)
+
+    def read(self, path, device, columns=None):
+        with open(path, 'rb') as f:
+            meta = self._read_meta(f)
+            names = [d['name'] for d in meta['devices']]
+            if device not in names:
+                return None
+            device_meta = meta['devices'][names.index(device)]
+            f.seek(device_meta['offset'], os.SEEK_CUR)
+            block = f.read(device_meta['length'])
+        columns = [name for name in (columns if columns is not None else meta['schema']) if name in meta['schema']]
+        raw = decode_block(block, meta['schema'], columns)
+        data = {'time': raw['time']}
+        for name in columns:
+            data[name] = decode_column(meta['schema'][name], raw[name], device_meta['categories'].get(name))
+        return data
+
+    def _read_meta(self, f):
+        magic, meta_length = GORILLA_HEADER.unpack(f.read(GORILLA_HEADER.size))
+        if magic != GORILLA_MAGIC:
+            raise ValueError(f"{f.name} is not a {self.suffix} file")
+        return json.loads(f.read(meta_length))
+
+
+FORMATS = {
+    'npz': NpzFormat(),
+    'parquet': ParquetFormat(),
+    'gorilla': GorillaFormat()
+}
+
+
+def get_format(name):
+    if name not in FORMATS:
+        raise ValueError(f"Unknown storage format '{name}', expected one of {['segment'] + list(FORMATS)}")
+    return FORMATS[name]
+
+
+def format_of(path):
+    for columnar_format in FORMATS.values():
+        if Path(path).suffix == columnar_format.suffix:
+            return columnar_format
+    return None
+
+
+def write_columnar(path, rows, schema, columnar_format):
+    '''
+    Writes rows atomically (temporary file + rename) to a columnar file, synced to disk before and after the rename
+    '''
+    path = Path(path)
+    buffers = rows_to_buffers(rows, schema)
+    if not buffers:
+        return None
+    temporary_path = path.with_name(path.name + '.tmp')
+    columnar_format.write(temporary_path, buffers, schema)
+    # The segments a sealed file replaces are removed right after, its data has to be on disk before the rename
+    sync_file(temporary_path)
+    os.replace(temporary_path, path)
+    sync_folder(path.parent)
+    return path
+
+
+def sync_file(path):
+    # The formats write through their own file objects (e.g. pyarrow's), so the file is synced by path
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync_folder(folder):
+    # Makes a rename durable (not supported on every platform)
+    try:
+        descriptor = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def _legacy_rows(sensor_data, default_device='default'):
+    '''
+    Flattens the nested dicts of the old pickle files into rows.
+    Returns (rows, dropped) with the names of the columns that could not be matched to the timestamps.
+    '''
+    data = sensor_data.get('data', sensor_data)
+    series = {}
+    if isinstance(data.get('time'), list):
+        series[default_device] = data                   # weather: no device level
+    else:
+        series = {device: values for device, values in data.items() if isinstance(values, dict)}
+
+    rows = []
+    dropped = set()
+    for device, values in series.items():
+        times = values.get('times', values.get('time', []))
+        columns = {}
+        for group in [values, values.get('measurements', {}), values.get('states', {})]:
+            for name, column in group.items():
+                if name in ('time', 'times', 'measurements', 'states'):
+                    continue
+                if isinstance(column, list) and len(column) == len(times):
+                    columns[name] = column
+                elif isinstance(column, (int, float, str, bool)) and times:
+                    # The old WeatherAPI overwrote the list with the latest value, which belongs to the last time only
+                    columns[name] = [None]*(len(times) - 1) + [column]
+                else:
+                    dropped.add(name)
+        for i, timestamp in enumerate(times):
+            rows.append({
+                'device': device,
+                'time': timestamp.timestamp(),
+                'values': {name: column[i] for name, column in columns.items()}
+            })
+    return rows, dropped
+
+
+def legacy_device_names(params):
+    '''
+    Device names of the series without a device level in the old pickles, as the live sources name them
+    (weather: "<lat>,<lon>" of params['weather'])
+    '''
+    device_names = {}
+    weather = (params or {}).get('weather', {})
+    if weather.get('lat') is not None and weather.get('lon') is not None:
+        device_names['weather'] = f"{weather['lat']},{weather['lon']}"
+    return device_names
+
+
+def convert_pickle_tree(basedir='data', format='npz', remove=False, params=None):
+    '''
+    One-shot converter for data mined with the old pickle storage (data/<sensor>/{daily,weekly,monthly,yearly}/*.pkl).
+    Every pickle held the full session history, so rows are deduplicated by (device, time) and written
+    as one columnar file per sensor and day: data/<sensor>/columnar/<sensor>_<YYYY-MM-DD>__legacy.<format>
+
+    params: the DataMiner params the data was mined with, the weather series is named like the live
+    WeatherAPI device ("<lat>,<lon>"), without them it is called 'default'.
+    With remove=True only the pickles that were converted are deleted.
+
+    Only run this on your own files, loading pickles executes arbitrary code.
+    '''
+    columnar_format = get_format(format)
+    device_names = legacy_device_names(params)
+    written = []
+    for sensor_folder in sorted(p for p in Path(basedir).iterdir() if p.is_dir()):
+        pickle_files = sorted(sensor_folder.glob('*/*.pkl'))
+        if not pickle_files:
+            continue
+        default_device = device_names.get(sensor_folder.name, 'default')
+        if default_device == 'default' and sensor_folder.name == 'weather':
+            logging.warning("convert_pickle_tree: no weather lat/lon in params, the weather series is named 'default'")
+            print("convert_pickle_tree: no weather lat/lon in params, the weather series is named 'default'")
+        unique_rows = {}
+        converted_files = []
+        dropped_columns = set()
+        for pickle_file in pickle_files:
+            try:
+                with open(pickle_file, 'rb') as f:
+                    rows, dropped = _legacy_rows(pickle.load(f), default_device)
+            except Exception as e:
+                logging.error(f"convert_pickle_tree: could not convert {pickle_file}: " + str(e))
+                print(f"convert_pickle_tree: could not convert {pickle_file}: " + str(e))
+                continue
+            for row in rows:
+                unique_rows[(row['device'], row['time'])] = row
+            dropped_columns |= dropped
+            converted_files.append(pickle_file)
+        if dropped_columns:
+            logging.warning(f"convert_pickle_tree: {sensor_folder.name}: dropped columns {sorted(dropped_columns)}, they do not match the timestamps")
+            print(f"convert_pickle_tree: {sensor_folder.name}: dropped columns {sorted(dropped_columns)}, they do not match the timestamps")
+
+        rows_per_day = {}
+        for row in unique_rows.values():
+            day = datetime.fromtimestamp(row['time'], tz=LOCAL_TIMEZONE).date()
+            rows_per_day.setdefault(day, []).append(row)
+        schema = infer_schema(unique_rows.values())
+        output_folder = sensor_folder / COLUMNAR_FOLDER
+        output_folder.mkdir(parents=True, exist_ok=True)
+        try:
+            for day, rows in sorted(rows_per_day.items()):
+                path = output_folder / f"{sensor_folder.name}_{day.strftime('%Y-%m-%d')}__legacy{columnar_format.suffix}"
+                written.append(write_columnar(path, rows, schema, columnar_format))
+        except Exception as e:
+            logging.error(f"convert_pickle_tree: could not write the {format} files of {sensor_folder.name}, keeping its pickles: " + str(e))
+            print(f"convert_pickle_tree: could not write the {format} files of {sensor_folder.name}, keeping its pickles: " + str(e))
+            continue
+        failed = len(pickle_files) - len(converted_files)
+        print(f"{sensor_folder.name}: converted {len(converted_files)} pickle files into {len(rows_per_day)} {format} files"
+              + (f", {failed} failed" if failed else ""))
+
+        if remove:
+            for pickle_file in converted_files:
+                pickle_file.unlink()
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert pickle files from old data mining sessions to a columnar format')
+    parser.add_argument('basedir', type = str, nargs = '?', default = 'data')
+    parser.add_argument('--format', type = str, default = 'npz', choices = list(FORMATS))
+    parser.add_argument('--remove', action = 'store_true', help = 'delete the converted pickle files')
+    parser.add_argument('--lat', type = str, default = None, help = 'weather latitude the data was mined with')
+    parser.add_argument('--lon', type = str, default = None, help = 'weather longitude the data was mined with')
+    args = parser.parse_args()
+    convert_pickle_tree(args.basedir, args.format, args.remove, params = {'weather': {'lat': args.lat, 'lon': args.lon}})
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from data_mining.storage.segment_log import read_frames, parse_segment_name, SEGMENT_SUFFIX
+from data_mining.storage.columnar import is_missing
+from data_mining.storage.formats import FORMATS, COLUMNAR_FOLDER, format_of
+from data_mining.storage.rollups import RollupStore, ROLLUP_FOLDER
+
+INDEX_FILE_NAME = 'index.json'
+
+
+def to_epoch(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def values_to_array(values):
+    '''
+    Numbers become float64 (missing = NaN), everything else (states, booleans) an object array (missing = None)
+    '''
+    present = [v for v in values if not is_missing(v)]
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return np.array([np.nan if is_missing(v) else v for v in values], dtype=np.float64)
+    return np.array([None if is_missing(v) else v for v in values], dtype=object)
+
+
+class DataReader():
+    '''
+    Data reader
+    ===========
+    Query api over the files written by the DataMiner.
+
+    Keeps an index of every data file -> (sensor, device, min_time, max_time, rows), persisted in
+    data/index.json. Files are only re-scanned when their size or modification time changed, so
+    refreshing the index while mining is running is cheap.
+
+    reader = DataReader('data')
+    temperature = reader.read('sensibo', 'Living room', start, end, columns=['temperature'])
+    '''
+    def __init__(self, basedir='data', index_file=None):
+        self.basedir = Path(basedir)
+        self.index_file = Path(index_file) if index_file else self.basedir / INDEX_FILE_NAME
+        self.index = self._load_index()
+
+    def refresh_index(self):
+        '''
+        Scans for new or changed files and persists the index. Returns the number of (re)indexed files.
+        '''
+        files = {str(path.relative_to(self.basedir)): path for path in self._data_files()}
+        changed = 0
+        for name in [name for name in self.index if name not in files]:
+            del self.index[name]
+        for name, path in files.items():
+            stat = path.stat()
+            entry = self.index.get(name)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                continue
+            try:
+                self.index[name] = self._index_file(path, stat)
+                changed += 1
+            except Exception as e:
+                logging.error(f"DataReader: could not index {path}: " + str(e))
+                print(f"DataReader: could not index {path}: " + str(e))
+        if changed or not self.index_file.exists():
+            self._save_index()
+        return changed
+
+    def files(self, sensor, device=None, start=None, end=None):
+        '''
+        Returns the data files that contain rows for sensor/device overlapping start <= time < end.
+        '''
+        start, end = to_epoch(start), to_epoch(end)
+        overlapping = []
+        for name, entry in sorted(self.index.items()):
+            if entry['sensor'] != sensor:
+                continue
+            for device_name, stats in entry['devices'].items():
+                if device is not None and device_name != device:
+                    continue
+                if (start is None or stats['max_time'] >= start) and (end is None or stats['min_time'] < end):
+                    overlapping.append(self.basedir / name)
+                    break
+        return overlapping
+
+    def devices(self, sensor):
+        return sorted({
+            device for entry in self.index.values() if entry['sensor'] == sensor for device in entry['devices']
+        })
+
+    def read(self, sensor, device, start=None, end=None, columns=None, as_frame=False):
+        '''
+        Reads the rows of sensor/device with start <= time < end (datetimes or epoch seconds, None = unbounded)
+        by opening only the overlapping files.
+
+        Returns {'time': int64 epoch [ms], <column>: array, ...}, or a pandas DataFrame indexed by time if as_frame=True.
+        '''
+        self.refresh_index()
+        start, end = to_epoch(start), to_epoch(end)
+        parts = [self._read_file(path, device, columns) for path in self.files(sensor, device, start, end)]
+        parts = [part for part in parts if part is not None]
+        if columns is None:
+            columns = []
+            for part in parts:
+                columns += [name for name in part if name != 'time' and name not in columns]
+
+        data = {'time': np.concatenate([part['time'] for part in parts] + [np.empty(0, dtype=np.int64)])}
+        for name in columns:
+            # A column missing from a file (e.g. added later) is filled with missing values
+            arrays = [part[name] if name in part else np.full(len(part['time']), None, dtype=object) for part in parts]
+            data[name] = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.float64)
+
+        in_range = np.ones(len(data['time']), dtype=bool)
+        if start is not None:
+            in_range &= data['time'] >= start*1000
+        if end is not None:
+            in_range &= data['time'] < end*1000
+        order = np.argsort(data['time'][in_range], kind='stable')
+        data = {name: values[in_range][order] for name, values in data.items()}
+
+        if as_frame:
+            import pandas as pd
+            index = pd.to_datetime(data.pop('time'), unit='ms', utc=True)
+            return pd.DataFrame(data, index=index)
+        return data
+
+    def latest(self, sensor, device, column, before=None):
+        '''
+        Returns (times, values) of the newest sample of sensor/device with a value in `column` and time < before
+        (datetime or epoch seconds, None = unbounded), however old: arrays of length 1, or 0 if there is none.
+        Files are opened newest first until no older file can hold a newer sample.
+        '''
+        self.refresh_index()
+        before = to_epoch(before)
+        candidates = []
+        for name, entry in self.index.items():
+            stats = entry['devices'].get(device) if entry['sensor'] == sensor else None
+            if stats and (before is None or stats['min_time'] < before):
+                candidates.append((stats['max_time'], name))
+        newest = (np.empty(0, dtype=np.int64), np.empty(0, dtype=object))
+        for max_time, name in sorted(candidates, reverse=True):
+            if len(newest[0]) and max_time*1000 < newest[0][0]:
+                break
+            data = self._read_file(self.basedir / name, device, [column])
+            if data is None or column not in data:
+                continue
+            values = data[column]
+            keep = np.not_equal(values, None).astype(bool) if values.dtype == object else ~np.isnan(values)
+            if before is not None:
+                keep &= data['time'] < before*1000
+            found = np.flatnonzero(keep)
+            if len(found) and (not len(newest[0]) or data['time'][found].max() > newest[0][0]):
+                i = found[np.argmax(data['time'][found])]
+                newest = (data['time'][i:i + 1], values[i:i + 1])
+        return newest
+
+    def read_rollup(self, sensor, device, metric, granularity, start=None, end=None):
+        '''
+        Reads precomputed 'hour' / 'day' / 'week' / 'month' aggregates instead of the raw rows (see RollupStore).
+        Returns {'time': int64 epoch [ms], 'count', 'sum', 'min', 'max', 'last', 'mean'}
+        '''
+        rollups = RollupStore(self.basedir / sensor / ROLLUP_FOLDER, sensor, read_only=True)
+        return rollups.read(device, metric, granularity, to_epoch(start), to_epoch(end))
+
+    def _data_files(self):
+        files = list(self.basedir.glob(f'*/log/*{SEGMENT_SUFFIX}'))
+        for columnar_format in FORMATS.values():
+            files += self.basedir.glob(f'*/{COLUMNAR_FOLDER}/*{columnar_format.suffix}')
+        return sorted(files)
+
+    def _read_file(self, path, device, columns=None):
+        '''
+        Returns {'time': int64 epoch [ms], <column>: array, ...} for one device in one file, or None
+        '''
+        columnar_format = format_of(path)
+        if columnar_format:
+            return columnar_format.read(path, device, columns)
+
+        rows = [row for row in read_frames(path)[0] if row['device'] == device]
+        if not rows:
+            return None
+        if columns is None:
+            columns = []
+            for row in rows:
+                columns += [name for name in row['values'] if name not in columns]
+        data = {'time': np.array([int(round(row['time']*1000)) for row in rows], dtype=np.int64)}
+        for name in columns:
+            data[name] = values_to_array([row['values'].get(name) for row in rows])
+        return data
+
+    def _index_file(self, path, stat):
+        sensor_name, _, _ = parse_segment_name(path)
+        columnar_format = format_of(path)
+        if columnar_format:
+            meta = columnar_format.meta(path)
+            return {
+                'sensor': sensor_name,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'devices': {d['name']: {k: d[k] for k in ('min_time', 'max_time', 'rows')} for d in meta['devices']}
+            }
+
+        devices = {}
+        for row in read_frames(path)[0]:
+            stats = devices.setdefault(row['device'], {'min_time': row['time'], 'max_time': row['time'], 'rows': 0})
+            stats['min_time'] = min(stats['min_time'], row['time'])
+            stats['max_time'] = max(stats['max_time'], row['time'])
+            stats['rows'] += 1
+        return {
+            'sensor': sensor_name,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'devices': devices
+        }
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"DataReader: could not load index {self.index_file}, rebuilding it: " + str(e))
+            return {}
+
+    def _save_index(self):
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        temporary_file = self.index_file.with_suffix('.tmp')
+        with open(temporary_file, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temporary_file, self.index_file)
@@ -0,0 +1,303 @@
+import logging
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pytz
+
+from data_mining.storage.segment_log import encode_frame, read_frames, recover_segment
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+GRANULARITIES = ['hour', 'day', 'week', 'month']
+ROLLUP_FOLDER = 'rollups'
+ROLLUP_SUFFIX = '.rollup'
+COMPACT_RATIO = 4  # the rollup log is rewritten once it holds this many records per bucket
+
+
+def local_midnight(day):
+    return LOCAL_TIMEZONE.localize(datetime(day.year, day.month, day.day)).timestamp()
+
+
+def bucket_starts(times, granularity):
+    '''
+    Start (epoch seconds) of the local hour/day/week (monday)/month of every time in `times` (epoch seconds).
+    The calendar is only evaluated once per distinct hour, the rest is vectorized.
+    '''
+    hours = np.floor(np.asarray(times, dtype=np.float64)/3600)*3600
+    if granularity == 'hour':
+        return hours
+    distinct_hours, inverse = np.unique(hours, return_inverse=True)
+    starts = np.empty(len(distinct_hours), dtype=np.float64)
+    for i, hour in enumerate(distinct_hours):
+        day = datetime.fromtimestamp(hour, tz=LOCAL_TIMEZONE).date()
+        if granularity == 'week':
+            day -= timedelta(days=day.weekday())
+        elif granularity == 'month':
+            day = day.replace(day=1)
+        starts[i] = local_midnight(day)
+    return starts[inverse]
+
+
+def bucket_end(start, granularity):
+    ''' Start (epoch seconds) of the bucket after the one starting at `start` '''
+    if granularity == 'hour':
+        return start + 3600
+    day = datetime.fromtimestamp(start, tz=LOCAL_TIMEZONE).date()
+    if granularity == 'day':
+        return local_midnight(day + timedelta(days=1))
+    if granularity == 'week':
+        return local_midnight(day + timedelta(days=7))
+    return local_midnight((day.replace(day=1) + timedelta(days=32)).replace(day=1))
+
+
+def to_floats(values):
+    ''' Numeric/bool column values (None for missing) as float64, NaN for missing '''
+    return np.array([np.nan if value is None or isinstance(value, str) else float(value) for value in values], dtype=np.float64)
+
+
+class RollupStore():
+    '''
+    Rollups
+    =======
+    Precomputed aggregates (count, sum, min, max, last) of every numeric column per device at hour, day,
+    week and month granularity, kept up to date on every append. A dashboard query over a year then reads
+    ~8760 hourly or 12 monthly rows instead of every raw sample.
+
+    Changed buckets are appended as records to data/<sensor>/rollups/<sensor>.rollup (framed like the segment
+    log, the newest record of a bucket wins). The file is compacted when it has grown to COMPACT_RATIO records
+    per bucket.
+
+    Only rows newer than everything rolled up for their device are added incrementally. Rows that arrive late or
+    twice (retried writes, re-polled hours, backfill) are split off by split_late(), their buckets are recomputed
+    from the stored rows by recompute(), so no row is counted twice.
+
+    rollups.read('Living room', 'temperature', 'day', start, end)
+        -> {'time': int64 epoch [ms], 'count', 'sum', 'min', 'max', 'last', 'mean'}
+    '''
+    def __init__(self, folder, sensor_name, granularities=GRANULARITIES, read_only=False):
+        for granularity in granularities:
+            if granularity not in GRANULARITIES:
+                raise ValueError(f"Unknown rollup granularity '{granularity}', expected one of {GRANULARITIES}")
+        self.folder = Path(folder)
+        self.sensor_name = sensor_name
+        self.granularities = list(granularities)
+        self.path = self.folder / f"{sensor_name}{ROLLUP_SUFFIX}"
+        self.read_only = read_only
+        self.buckets = {}   # (granularity, device, metric) -> {start: [count, sum, min, max, last, last_time]}
+        self._newest = {}   # device -> newest rolled up time (epoch seconds)
+        self._dirty = set()
+        self._records = 0
+        self._load()
+
+    def exists(self):
+        return self.path.exists()
+
+    def add(self, device, times, columns):
+        '''
+        Adds samples of one device: times (epoch seconds) and {metric: float array} of the same length.
+        '''
+        times = np.asarray(times, dtype=np.float64)
+        if not len(times):
+            return
+        for granularity in self.granularities:
+            starts = bucket_starts(times, granularity)
+            for metric, values in columns.items():
+                values = np.asarray(values, dtype=np.float64)
+                valid = ~np.isnan(values)
+                if valid.any():
+                    self._merge(granularity, device, metric, starts[valid], times[valid], values[valid])
+
+    def add_rows(self, rows, metrics):
+        '''
+        Adds rows ({'device', 'time' [epoch seconds], 'values'}) for the given numeric/bool metrics.
+        '''
+        per_device = {}
+        for row in rows:
+            per_device.setdefault(row['device'], []).append(row)
+        for device, device_rows in per_device.items():
+            columns = {metric: to_floats([row['values'].get(metric) for row in device_rows]) for metric in metrics}
+            self.add(device, [row['time'] for row in device_rows], columns)
+
+    def split_late(self, rows):
+        '''
+        Returns (new rows, late rows): late rows are at or before the newest rolled up time of their device,
+        or repeat a (device, time) within rows. Adding them would count them twice, see recompute().
+        '''
+        new_rows, late_rows = [], []
+        seen = set()
+        for row in rows:
+            key = (row['device'], row['time'])
+            if row['time'] > self._newest.get(row['device'], -np.inf) and key not in seen:
+                new_rows.append(row)
+            else:
+                late_rows.append(row)
+            seen.add(key)
+        return new_rows, late_rows
+
+    def recompute(self, device, times, read):
+        '''
+        Recomputes the buckets of one device containing `times` (epoch seconds) from all of their stored samples.
+        read(start, end) -> {'time': int64 epoch [ms], <metric>: values} with one sample per time.
+        Hours are read back in one go, coarser buckets are combined from the hours.
+        '''
+        times = np.asarray(times, dtype=np.float64)
+        if not len(times):
+            return
+        hours = np.unique(bucket_starts(times, 'hour'))
+        granularities = sorted(self.granularities, key=GRANULARITIES.index)
+        for granularity in granularities:
+            if granularity == 'hour':
+                self._replace_from_samples(granularity, device, hours, read(hours[0], hours[-1] + 3600))
+            elif 'hour' in granularities:
+                for start in np.unique(bucket_starts(hours, granularity)).tolist():
+                    self._combine_hours(granularity, device, start)
+            else:
+                for start in np.unique(bucket_starts(hours, granularity)).tolist():
+                    self._replace_from_samples(granularity, device, [start], read(start, bucket_end(start, granularity)))
+
+    def flush(self):
+        '''
+        Appends the changed buckets to the rollup log.
+        '''
+        if not self._dirty:
+            return 0
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'ab') as f:
+            for key, start in sorted(self._dirty, key=lambda item: (item[0], item[1])):
+                f.write(encode_frame(self._record(key, start)))
+        written = len(self._dirty)
+        self._records += written
+        self._dirty = set()
+        if self._records > COMPACT_RATIO*max(self._bucket_count(), 256):
+            self.compact()
+        return written
+
+    def compact(self):
+        ''' Rewrites the rollup log with one record per bucket (temporary file + rename) '''
+        temporary_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary_path, 'wb') as f:
+            for key, buckets in self.buckets.items():
+                for start in sorted(buckets):
+                    f.write(encode_frame(self._record(key, start)))
+        os.replace(temporary_path, self.path)
+        self._records = self._bucket_count()
+
+    def clear(self):
+        self.buckets = {}
+        self._newest = {}
+        self._dirty = set()
+        self._records = 0
+        if self.path.exists():
+            self.path.unlink()
+
+    def devices(self):
+        return sorted({device for _, device, _ in self.buckets})
+
+    def newest(self, device):
+        ''' The newest rolled up time of device (epoch seconds), None if nothing is rolled up for it '''
+        newest = self._newest.get(device)
+        return float(newest) if newest is not None else None
+
+    def read(self, device, metric, granularity, start=None, end=None):
+        '''
+        Returns the buckets of device/metric whose start is in start <= time < end (epoch seconds, None = unbounded).
+        '''
+        buckets = self.buckets.get((granularity, device, metric), {})
+        starts = sorted(s for s in buckets if (start is None or s >= start) and (end is None or s < end))
+        stats = np.array([buckets[s][:5] for s in starts], dtype=np.float64).reshape(len(starts), 5)
+        data = {'time': np.array([int(round(s*1000)) for s in starts], dtype=np.int64)}
+        for i, name in enumerate(['count', 'sum', 'min', 'max', 'last']):
+            data[name] = stats[:, i]
+        data['mean'] = data['sum']/np.where(data['count'] > 0, data['count'], np.nan)
+        return data
+
+    def _merge(self, granularity, device, metric, starts, times, values):
+        # Samples are grouped by bucket (stable, so the newest sample of a bucket is found by time below)
+        order = np.argsort(starts, kind='stable')
+        starts, times, values = starts[order], times[order], values[order]
+        first = np.flatnonzero(np.concatenate([[True], starts[1:] != starts[:-1]]))
+        counts = np.diff(np.concatenate([first, [len(starts)]]))
+        sums = np.add.reduceat(values, first)
+        minimums = np.minimum.reduceat(values, first)
+        maximums = np.maximum.reduceat(values, first)
+        newest = np.array([i + np.argmax(times[i:i + n]) for i, n in zip(first, counts)], dtype=np.int64)
+
+        key = (granularity, device, metric)
+        buckets = self.buckets.setdefault(key, {})
+        self._newest[device] = max(self._newest.get(device, -np.inf), float(times.max()))
+        for i, start in enumerate(starts[first].tolist()):
+            stats = buckets.get(start)
+            last_time, last = float(times[newest[i]]), float(values[newest[i]])
+            if stats is None:
+                buckets[start] = [int(counts[i]), float(sums[i]), float(minimums[i]), float(maximums[i]), last, last_time]
+            else:
+                stats[0] += int(counts[i])
+                stats[1] += float(sums[i])
+                stats[2] = min(stats[2], float(minimums[i]))
+                stats[3] = max(stats[3], float(maximums[i]))
+                if last_time >= stats[5]:
+                    stats[4], stats[5] = last, last_time
+            self._dirty.add((key, start))
+
+    def _replace_from_samples(self, granularity, device, starts, data):
+        times = data['time']/1000
+        sample_starts = bucket_starts(times, granularity)
+        for metric in [name for name in data if name != 'time']:
+            key = (granularity, device, metric)
+            buckets = self.buckets.setdefault(key, {})
+            for start in starts:
+                if buckets.pop(start, None) is not None:
+                    self._dirty.add((key, start))
+            values = to_floats(data[metric])
+            selected = np.isin(sample_starts, starts) & ~np.isnan(values)
+            if selected.any():
+                self._merge(granularity, device, metric, sample_starts[selected], times[selected], values[selected])
+
+    def _combine_hours(self, granularity, device, start):
+        end = bucket_end(start, granularity)
+        for (hour_granularity, hour_device, metric), hours in list(self.buckets.items()):
+            if hour_granularity != 'hour' or hour_device != device:
+                continue
+            key = (granularity, device, metric)
+            buckets = self.buckets.setdefault(key, {})
+            stats = [hours[hour] for hour in hours if start <= hour < end]
+            if buckets.pop(start, None) is not None or stats:
+                self._dirty.add((key, start))
+            if not stats:
+                continue
+            newest = max(stats, key=lambda hour: hour[5])
+            buckets[start] = [sum(hour[0] for hour in stats), sum(hour[1] for hour in stats),
+                              min(hour[2] for hour in stats), max(hour[3] for hour in stats), newest[4], newest[5]]
+
+    def _record(self, key, start):
+        granularity, device, metric = key
+        # A bucket without samples left (after a recompute) is written as None, and dropped when loaded
+        stats = self.buckets[key].get(start)
+        return {'g': granularity, 'device': device, 'metric': metric, 'start': start, 'stats': stats}
+
+    def _bucket_count(self):
+        return sum(len(buckets) for buckets in self.buckets.values())
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            # A torn tail would hide every record appended after it (readers leave that to the writer)
+            if not self.read_only:
+                recover_segment(self.path)
+            records, _ = read_frames(self.path)
+        except Exception as e:
+            logging.error(f"{self.sensor_name}: could not read the rollups {self.path}: " + str(e))
+            print(f"{self.sensor_name}: could not read the rollups {self.path}: " + str(e))
+            return
+        for record in records:
+            if record['g'] in self.granularities:
+                key = (record['g'], record['device'], record['metric'])
+                buckets = self.buckets.setdefault(key, {})
+                if record['stats'] is None:
+                    buckets.pop(record['start'], None)
+                    continue
+                buckets[record['start']] = record['stats']
+                self._newest[record['device']] = max(self._newest.get(record['device'], -np.inf), record['stats'][5])
+        self._records = len(records)
@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import pytz
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+
+# Every record is framed as: payload length (uint32) | crc32 of payload (uint32) | payload
+FRAME_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.seg'
+PERIODS = ['daily', 'weekly', 'monthly', 'yearly']
+
+
+def encode_frame(record):
+    payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+    return FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_frames(path):
+    '''
+    Reads all valid records from a segment file.
+    Returns (records, valid_bytes) where valid_bytes is the offset of the first torn or corrupt frame.
+    '''
+    records = []
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(buffer):
+        length, checksum = FRAME_HEADER.unpack_from(buffer, offset)
+        start = offset + FRAME_HEADER.size
+        payload = buffer[start:start+length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append(json.loads(payload))
+        offset = start + length
+    return records, offset
+
+
+def recover_segment(path):
+    '''
+    Truncates a torn tail (left behind by a crash in the middle of a write) from a segment file.
+    Returns the number of bytes removed.
+    '''
+    _, valid_bytes = read_frames(path)
+    size = os.path.getsize(path)
+    if valid_bytes < size:
+        with open(path, 'r+b') as f:
+            f.truncate(valid_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        logging.warning(f"SegmentLog: recovered torn tail in {path}, removed {size - valid_bytes} bytes")
+    return size - valid_bytes
+
+
+def parse_segment_name(path):
+    '''
+    Segment files are named <sensor>_<YYYY-MM-DD>__<session_id>.seg
+    Returns (sensor_name, day, session_id).
+    '''
+    stem = Path(path).stem
+    name_and_day, session_id = stem.split('__', 1)
+    sensor_name, day = name_and_day.rsplit('_', 1)
+    return sensor_name, datetime.strptime(day, '%Y-%m-%d').date(), session_id
+
+
+def day_in_period(day, period, at):
+    if period == 'daily':
+        return day == at
+    if period == 'weekly':
+        return day.isocalendar()[:2] == at.isocalendar()[:2]
+    if period == 'monthly':
+        return (day.year, day.month) == (at.year, at.month)
+    if period == 'yearly':
+        return day.year == at.year
+    raise ValueError(f"Unknown period '{period}', expected one of {PERIODS}")
+
+
+class SegmentLog():
+    '''
+    Append-only segment log
+    =======================
+    One physical log per sensor. Every call to append() writes only the new rows as framed
+    records (length + crc32 + json payload) to the segment file of the day they belong to:
+
+        data/<sensor>/log/<sensor>_<YYYY-MM-DD>__<session_id>.seg
+
+    The daily, weekly, monthly and yearly views are read from the same segments (see read()).
+
+    A failed append is rolled back: every segment it wrote to is truncated to where the append started, so a
+    retry never follows a partial frame (readers stop at the first bad frame). If a segment can not be
+    truncated, the session continues in new segments (<session_id>-<n>), the torn one is recovered on the next start.
+
+    Settings:
+        - fsync_every: > 0
+            = fsync after this many records have been appended since the last fsync
+        - fsync_interval: [seconds]
+            = fsync if this long has passed since the last fsync
+    '''
+    def __init__(self, folder, sensor_name, session_id, fsync_every=64, fsync_interval=60):
+        self.folder = Path(folder)
+        self.sensor_name = sensor_name
+        self.session_id = session_id
+        self._session_ids = [session_id]   # this session's ids, a new one after a segment could not be rolled back
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._handles = {}
+        self._unsynced_records = 0
+        self._last_fsync = time.monotonic()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.recover()
+
+    def append(self, rows):
+        '''
+        rows: list of {'device': str, 'time': epoch seconds, 'values': {...}}
+        '''
+        if not rows:
+            return 0
+        frames_per_day = {}
+        for row in rows:
+            day = datetime.fromtimestamp(row['time'], tz=LOCAL_TIMEZONE).date()
+            frames_per_day.setdefault(day, []).append(encode_frame(row))
+
+        offsets = {}
+        try:
+            for day, frames in frames_per_day.items():
+                handle = self._get_handle(day)
+                offsets[day] = os.fstat(handle.fileno()).st_size
+                data = memoryview(b''.join(frames))
+                while data:
+                    data = data[handle.write(data):]
+        except Exception:
+            self._roll_back(offsets)
+            raise
+
+        self._unsynced_records += len(rows)
+        if (self._unsynced_records >= self.fsync_every
+                or time.monotonic() - self._last_fsync >= self.fsync_interval):
+            self.sync()
+
+        # Only keep the newest day open, older segments are rotated out
+        newest_day = max(self._handles)
+        for day in [d for d in self._handles if d != newest_day]:
+            self._close_handle(day)
+        return len(rows)
+
+    def is_own_session(self, session_id):
+        return session_id in self._session_ids
+
+    def _roll_back(self, offsets):
+        for day, offset in offsets.items():
+            handle = self._handles[day]
+            try:
+                os.ftruncate(handle.fileno(), offset)
+            except OSError as e:
+                logging.error(f"SegmentLog: could not roll back {handle.name}, continuing in a new segment: " + str(e))
+                del self._handles[day]
+                try:
+                    handle.close()
+                except OSError:
+                    pass
+                self.session_id = f"{self._session_ids[0]}-{len(self._session_ids)}"
+                self._session_ids.append(self.session_id)
+
+    def sync(self):
+        for handle in self._handles.values():
+            handle.flush()
+            os.fsync(handle.fileno())
+        self._unsynced_records = 0
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        for day in list(self._handles):
+            self._close_handle(day)
+
+    def segment_path(self, day, session_id=None):
+        session_id = session_id if session_id else self.session_id
+        return self.folder / f"{self.sensor_name}_{day.strftime('%Y-%m-%d')}__{session_id}{SEGMENT_SUFFIX}"
+
+    def open_segments(self):
+        return [self.segment_path(day) for day in self._handles]
+
+    def segments(self):
+        return sorted(self.folder.glob(f"{self.sensor_name}_*{SEGMENT_SUFFIX}"))
+
+    def read(self, period='daily', at=None):
+        '''
+        Returns all records (from every session) in the daily/weekly/monthly/yearly period containing `at`,
+        sorted by time.
+        '''
+        at = at if at else datetime.now(tz=LOCAL_TIMEZONE)
+        at = at.date() if isinstance(at, datetime) else at
+        records = []
+        for path in self.segments():
+            _, day, _ = parse_segment_name(path)
+            if day_in_period(day, period, at):
+                records += read_frames(path)[0]
+        return sorted(records, key=lambda record: record['time'])
+
+    def read_range(self, start=None, end=None, device=None):
+        '''
+        Returns all records (from every session) with start <= time < end, sorted by time.
+        start, end: epoch seconds (None = unbounded)
+        '''
+        first_day = datetime.fromtimestamp(start, tz=LOCAL_TIMEZONE).date() if start is not None else None
+        last_day = datetime.fromtimestamp(end, tz=LOCAL_TIMEZONE).date() if end is not None else None
+        records = []
+        for path in self.segments():
+            _, day, _ = parse_segment_name(path)
+            if (first_day and day < first_day) or (last_day and day > last_day):
+                continue
+            records += [
+                record for record in read_frames(path)[0]
+                if (device is None or record['device'] == device)
+                and (start is None or record['time'] >= start)
+                and (end is None or record['time'] < end)
+            ]
+        return sorted(records, key=lambda record: record['time'])
+
+    def recover(self):
+        '''
+        A crashed session can only have left a torn tail in the newest segment it was writing,
+        so only the newest segment of every other session is checked.
+        '''
+        newest_per_session = {}
+        for path in self.segments():
+            _, day, session_id = parse_segment_name(path)
+            if self.is_own_session(session_id):
+                continue
+            if session_id not in newest_per_session or day > newest_per_session[session_id][0]:
+                newest_per_session[session_id] = (day, path)
+        removed_bytes = 0
+        for _, path in newest_per_session.values():
+            removed_bytes += recover_segment(path)
+        return removed_bytes
+
+    def _get_handle(self, day):
+        if day not in self._handles:
+            # Unbuffered, so a failed write leaves nothing behind to be flushed later
+            self._handles[day] = open(self.segment_path(day), 'ab', buffering=0)
+        return self._handles[day]
+
+    def _close_handle(self, day):
+        handle = self._handles.pop(day)
+        handle.flush()
+        os.fsync(handle.fileno())
+        handle.close()
@@ -0,0 +1,252 @@
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+
+from data_mining.metrics import METRICS
+from data_mining.storage.columnar import is_missing
+from data_mining.storage.reader import to_epoch
+
+SQLITE_FILE = 'datamining.sqlite'
+BUSY_TIMEOUT = 5000  # [ms]
+
+# samples holds one value per source, device, time and column. WITHOUT ROWID stores the table in its primary
+# key's b-tree, so (source_id, device_id, time) range queries are answered from that index alone (covering).
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES sources(id),
+    name TEXT NOT NULL,
+    UNIQUE (source_id, name)
+);
+CREATE TABLE IF NOT EXISTS columns (
+    id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES sources(id),
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    UNIQUE (source_id, name)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    source_id INTEGER NOT NULL,
+    device_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    column_id INTEGER NOT NULL,
+    value,
+    PRIMARY KEY (source_id, device_id, time, column_id)
+) WITHOUT ROWID;
+'''
+
+
+def _sql_value(kind, value):
+    if kind == 'bool':
+        return int(bool(value))
+    if kind == 'float':
+        return float(value)
+    return value if isinstance(value, (int, float, str)) else str(value)
+
+
+class SQLiteSink():
+    '''
+    SQLite sink
+    ===========
+    Writes every stored row (params['sqlite']) into one normalized SQLite database next to the segment log:
+    sources, devices and columns get an id once, samples holds (source, device, time [epoch ms], column, value).
+    Missing values are not stored, rows written twice (same source, device, time and column) replace each other.
+
+    The database runs in WAL mode, so readers (see SQLiteReader) never block the writer and see every committed
+    batch. Each call to write() is one transaction, the storage writer hands over all rows of a sensor from a
+    group commit at once.
+
+    sink = SQLiteSink('datamining.sqlite')
+    sink.write('sensibo', rows, schema)
+    '''
+    def __init__(self, path=SQLITE_FILE, synchronous='NORMAL'):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Used from the storage writer's thread and on close from the event loop, always under the lock
+        self._connection = sqlite3.connect(str(self.path), isolation_level=None, check_same_thread=False)
+        self._connection.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT}')
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute(f'PRAGMA synchronous = {synchronous}')
+        self._connection.executescript(SCHEMA)
+        self._source_ids = {}
+        self._device_ids = {}
+        self._column_ids = {}
+
+    def write(self, source, rows, schema):
+        '''
+        rows: list of {'device': str, 'time': epoch seconds, 'values': {...}}, schema: {column: 'float' | 'bool' | 'category'}
+        '''
+        if not rows:
+            return 0
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                source_id = self._source_id(cursor, source)
+                column_ids = {name: self._column_id(cursor, source_id, name, kind) for name, kind in schema.items()}
+                samples = []
+                for row in rows:
+                    device_id = self._device_id(cursor, source_id, row['device'])
+                    time_ms = int(round(row['time']*1000))
+                    for name, value in row['values'].items():
+                        if name not in column_ids or is_missing(value):
+                            continue
+                        samples.append((source_id, device_id, time_ms, column_ids[name], _sql_value(schema[name], value)))
+                cursor.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)', samples)
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                # Ids created in the rolled back transaction are gone too
+                self._source_ids, self._device_ids, self._column_ids = {}, {}, {}
+                raise
+        return len(samples)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _source_id(self, cursor, source):
+        if source not in self._source_ids:
+            cursor.execute('INSERT OR IGNORE INTO sources (name) VALUES (?)', (source,))
+            self._source_ids[source] = cursor.execute('SELECT id FROM sources WHERE name = ?', (source,)).fetchone()[0]
+        return self._source_ids[source]
+
+    def _device_id(self, cursor, source_id, device):
+        key = (source_id, device)
+        if key not in self._device_ids:
+            cursor.execute('INSERT OR IGNORE INTO devices (source_id, name) VALUES (?, ?)', key)
+            self._device_ids[key] = cursor.execute(
+                'SELECT id FROM devices WHERE source_id = ? AND name = ?', key).fetchone()[0]
+        return self._device_ids[key]
+
+    def _column_id(self, cursor, source_id, name, kind):
+        key = (source_id, name)
+        if key not in self._column_ids:
+            cursor.execute('INSERT OR IGNORE INTO columns (source_id, name, kind) VALUES (?, ?, ?)', (source_id, name, kind))
+            self._column_ids[key] = cursor.execute(
+                'SELECT id FROM columns WHERE source_id = ? AND name = ?', key).fetchone()[0]
+        return self._column_ids[key]
+
+
+class SQLiteReader():
+    '''
+    SQLite reader
+    =============
+    Read-only access to the database of the SQLite sink. The connection is opened with mode=ro, so any number
+    of analysis processes can query while the DataMiner keeps writing (WAL mode: readers see the last committed
+    batch and never block the writer).
+
+    reader = SQLiteReader('datamining.sqlite')
+    data = reader.read('sensibo', 'Living room', start, end, columns=['temperature'])
+    rows = reader.query('SELECT COUNT(*) FROM samples')
+    '''
+    def __init__(self, path=SQLITE_FILE):
+        self.path = Path(path)
+        uri = f"file:{quote(str(self.path.resolve()))}?mode=ro"
+        self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self._connection.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT}')
+
+    def sources(self):
+        return [name for (name,) in self._connection.execute('SELECT name FROM sources ORDER BY name')]
+
+    def devices(self, source):
+        return [name for (name,) in self._connection.execute(
+            'SELECT devices.name FROM devices JOIN sources ON sources.id = devices.source_id '
+            'WHERE sources.name = ? ORDER BY devices.name', (source,))]
+
+    def columns(self, source):
+        ''' {column: 'float' | 'bool' | 'category'} '''
+        return dict(self._connection.execute(
+            'SELECT columns.name, columns.kind FROM columns JOIN sources ON sources.id = columns.source_id '
+            'WHERE sources.name = ? ORDER BY columns.id', (source,)))
+
+    def read(self, source, device, start=None, end=None, columns=None, as_frame=False):
+        '''
+        Reads source/device with start <= time < end (datetimes or epoch seconds, None = unbounded), like DataReader.read().
+        Returns {'time': int64 epoch [ms], <column>: array, ...}, or a pandas DataFrame indexed by time if as_frame=True.
+        '''
+        start, end = to_epoch(start), to_epoch(end)
+        kinds = self.columns(source)
+        columns = [name for name in (columns if columns is not None else kinds) if name in kinds]
+        ids = self._connection.execute(
+            'SELECT sources.id, devices.id FROM sources JOIN devices ON devices.source_id = sources.id '
+            'WHERE sources.name = ? AND devices.name = ?', (source, device)).fetchone()
+        samples = []
+        if ids is not None and columns:
+            column_ids = dict(self._connection.execute(
+                f"SELECT name, id FROM columns WHERE source_id = ? AND name IN ({', '.join('?'*len(columns))})",
+                (ids[0], *columns)))
+            samples = self._connection.execute(
+                f"SELECT time, column_id, value FROM samples WHERE source_id = ? AND device_id = ? AND time >= ? AND time < ? "
+                f"AND column_id IN ({', '.join('?'*len(column_ids))}) ORDER BY time",
+                (*ids, int(start*1000) if start is not None else -2**63, int(end*1000) if end is not None else 2**63 - 1,
+                 *column_ids.values())).fetchall()
+        else:
+            column_ids = {}
+
+        times = np.array([sample[0] for sample in samples], dtype=np.int64)
+        unique_times, positions = np.unique(times, return_inverse=True)
+        data = {'time': unique_times}
+        names = {column_id: name for name, column_id in column_ids.items()}
+        for name in columns:
+            data[name] = np.full(len(unique_times), np.nan) if kinds[name] == 'float' else np.full(len(unique_times), None, dtype=object)
+        for (_, column_id, value), position in zip(samples, positions):
+            name = names[column_id]
+            data[name][position] = bool(value) if kinds[name] == 'bool' else value
+
+        if as_frame:
+            import pandas as pd
+            index = pd.to_datetime(data.pop('time'), unit='ms', utc=True)
+            return pd.DataFrame(data, index=index)
+        return data
+
+    def latest(self, source, device, column, before=None):
+        '''
+        Returns (times, values) of the newest sample of source/device in `column` with time < before
+        (datetime or epoch seconds, None = unbounded), like DataReader.latest(): arrays of length 1 or 0.
+        '''
+        before = to_epoch(before)
+        kind = self.columns(source).get(column)
+        sample = self._connection.execute(
+            'SELECT samples.time, samples.value FROM samples '
+            'JOIN sources ON sources.id = samples.source_id '
+            'JOIN devices ON devices.id = samples.device_id '
+            'JOIN columns ON columns.id = samples.column_id '
+            'WHERE sources.name = ? AND devices.name = ? AND columns.name = ? AND samples.time < ? '
+            'ORDER BY samples.time DESC LIMIT 1',
+            (source, device, column, int(before*1000) if before is not None else 2**63 - 1)).fetchone()
+        if sample is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=object)
+        value = bool(sample[1]) if kind == 'bool' else sample[1]
+        return (np.array([sample[0]], dtype=np.int64),
+                np.array([value], dtype=np.float64 if kind == 'float' else object))
+
+    def query(self, sql, parameters=()):
+        ''' Runs any read-only statement, e.g. aggregates across devices '''
+        return self._connection.execute(sql, parameters).fetchall()
+
+    def close(self):
+        self._connection.close()
+
+
+def write_sink(sink, source, rows, schema):
+    '''
+    Writes rows to the sink without failing the caller: the segment log stays the source of truth,
+    a failed batch is logged and missing from the database.
+    '''
+    try:
+        return sink.write(source, rows, schema)
+    except Exception as e:
+        METRICS.inc('datamining_sink_errors_total', source=source)
+        logging.error(f"{source}: could not write {len(rows)} rows to the SQLite sink {sink.path}: " + str(e))
+        print(f"{source}: could not write {len(rows)} rows to the SQLite sink {sink.path}: " + str(e))
+        return 0
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from data_mining.metrics import METRICS
+
+
+class StorageWriter():
+    '''
+    Storage writer
+    ==============
+    One background writer stage shared by all sensors of a DataMiner. Sensors hand their new rows to
+    submit() and go on sampling; a single worker thread writes them, so disk latency never delays a tick.
+
+        - backpressure: at most max_pending_rows rows are queued or being written, submit() waits while
+          the queue is full (a hand-off larger than the whole queue is let through once it is empty)
+        - group commit: the queued rows of all sources are written together once max_batch_rows rows are
+          queued, or flush_interval seconds after the first one. Every storage gets a single append per
+          batch (one write per segment file, one rollup flush), in the order the rows were submitted.
+        - durability: every storage of a batch is fsynced in the writer thread before the futures resolve,
+          so a resolved future means its rows are on disk (sensors only evict those from memory)
+        - flush() waits until everything submitted so far is written, close() flushes and stops the writer
+        - if the writer task itself dies, submit(), flush() and close() raise its error instead of waiting
+
+    future = await writer.submit(storage, rows)   # resolves to the number of durable rows, or the error
+    '''
+    def __init__(self, max_pending_rows=10000, max_batch_rows=2000, flush_interval=1):
+        self.max_pending_rows = max_pending_rows
+        self.max_batch_rows = max_batch_rows
+        self.flush_interval = flush_interval
+        self.batches = 0
+        self._queue = deque()           # (storage, rows, future)
+        self._queued_rows = 0
+        self._pending_rows = 0          # queued + being written
+        self._space = None              # asyncio.Condition, notified when rows have been written
+        self._has_rows = None           # asyncio.Event, set when the queue is not empty
+        self._write_now = None          # asyncio.Event, set when a batch is full or a flush is requested
+        self._task = None
+        self._executor = None
+        self._closing = False
+        self._error = None              # what stopped the writer task
+
+    async def submit(self, storage, rows):
+        '''
+        Queues rows ({'device', 'time', 'values'}) for storage.append(), waiting while the queue is full.
+        Returns a future with the result of the write.
+        '''
+        self._start()
+        self._raise_if_stopped()
+        future = asyncio.get_running_loop().create_future()
+        if not rows:
+            future.set_result(0)
+            return future
+        async with self._space:
+            if not self._has_room(len(rows)):
+                METRICS.inc('datamining_writer_backpressure_total')
+                await self._space.wait_for(lambda: self._has_room(len(rows)) or self._error is not None)
+                self._raise_if_stopped()
+            self._queue.append((storage, rows, future))
+            self._queued_rows += len(rows)
+            self._pending_rows += len(rows)
+        METRICS.set('datamining_writer_pending_rows', self._pending_rows)
+        self._has_rows.set()
+        if self._queued_rows >= self.max_batch_rows:
+            self._write_now.set()
+        return future
+
+    async def flush(self):
+        ''' Writes the queued rows right away and waits until every row submitted so far is written '''
+        if self._task is None:
+            return
+        self._raise_if_stopped()
+        async with self._space:
+            if self._pending_rows:
+                self._write_now.set()
+                await self._space.wait_for(lambda: self._pending_rows == 0 or self._error is not None)
+                self._raise_if_stopped()
+
+    async def close(self):
+        if self._task is None:
+            return
+        try:
+            await self.flush()
+        finally:
+            self._closing = True
+            self._has_rows.set()
+            self._write_now.set()
+            try:
+                await self._task
+            finally:
+                self._executor.shutdown(wait=True)
+                self._task = None
+                self._closing = False
+                self._error = None
+
+    def _raise_if_stopped(self):
+        if self._error is not None:
+            raise self._error
+
+    def _start(self):
+        if self._task is not None:
+            return
+        self._space = asyncio.Condition()
+        self._has_rows = asyncio.Event()
+        self._write_now = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage-writer')
+        self._task = asyncio.ensure_future(self._run())
+
+    def _has_room(self, rows):
+        return self._pending_rows == 0 or self._pending_rows + rows <= self.max_pending_rows
+
+    async def _run(self):
+        try:
+            await self._write_loop()
+        except BaseException as e:
+            self._error = e
+            logging.error("Storage writer stopped: " + repr(e))
+            # Wakes up sensors waiting for room or a flush, they raise the error
+            async with self._space:
+                self._space.notify_all()
+
+    async def _write_loop(self):
+        while True:
+            await self._has_rows.wait()
+            if not self._write_now.is_set():
+                try:
+                    await asyncio.wait_for(self._write_now.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch = list(self._queue)
+            self._queue.clear()
+            self._queued_rows = 0
+            self._has_rows.clear()
+            self._write_now.clear()
+            if batch:
+                await self._commit(batch)
+                async with self._space:
+                    self._pending_rows -= sum(len(rows) for _, rows, _ in batch)
+                    self._space.notify_all()
+                METRICS.set('datamining_writer_pending_rows', self._pending_rows)
+            if self._closing and not self._queue:
+                return
+
+    async def _commit(self, batch):
+        groups = {}
+        for storage, rows, future in batch:
+            group = groups.setdefault(id(storage), (storage, [], []))
+            group[1].extend(rows)
+            group[2].append((future, len(rows)))
+        groups = list(groups.values())
+        with METRICS.timer('datamining_writer_commit_seconds'):
+            results = await asyncio.get_running_loop().run_in_executor(self._executor, self._write_groups, groups)
+        self.batches += 1
+        METRICS.inc('datamining_writer_batches_total')
+        METRICS.inc('datamining_writer_rows_total', sum(len(rows) for _, rows, _ in groups))
+        for (storage, rows, futures), result in zip(groups, results):
+            for future, count in futures:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(count)
+
+    def _write_groups(self, groups):
+        # Runs in the writer thread, a group is only acknowledged once it is synced
+        results = []
+        for storage, rows, _ in groups:
+            try:
+                with METRICS.timer('datamining_writer_append_seconds', source=storage.sensor_name):
+                    storage.append(rows)
+                    storage.sync()
+                results.append(len(rows))
+            except Exception as e:
+                logging.error(f"{storage.sensor_name}: storage writer could not write {len(rows)} rows: " + str(e))
+                results.append(e)
+        return results
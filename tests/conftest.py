@@ -0,0 +1,11 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+# The repository is the data_mining package, the tests import it by that name from any checkout folder
+ROOT = Path(__file__).resolve().parents[1]
+if 'data_mining' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('data_mining', ROOT / '__init__.py', submodule_search_locations=[str(ROOT)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['data_mining'] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from data_mining.storage.alignment import Aligner, asof, fill, resample
+from data_mining.storage.backend import StorageBackend
+from data_mining.storage.reader import DataReader
+
+S = 1760000400  # epoch seconds, on the 10 min grid
+
+
+def _store(folder, sensor, device, samples):
+    storage = StorageBackend(folder / sensor, sensor, 'session', {'temperature': 'float'}, rollups=False)
+    storage.append([{'device': device, 'time': t, 'values': {'temperature': value}} for t, value in samples])
+    storage.close()
+
+
+@pytest.fixture
+def reader(tmp_path):
+    _store(tmp_path, 'sensibo', 'Room', [(S + 60, 20.0), (S + 120, 21.0), (S + 1260, 23.0)])
+    _store(tmp_path, 'weather', 'Oslo', [(S - 7200, 4.0), (S + 900, 5.0)])
+    return DataReader(tmp_path)
+
+
+def test_incremental_update_matches_one_pass(reader):
+    def aligner():
+        return (Aligner(reader, frequency=600, start=S)
+                .add('sensibo', 'Room', 'temperature', fill='ffill', fill_limit=1)
+                .add('weather', 'Oslo', 'temperature', how='asof', name='outdoor')
+                .add('weather', 'Oslo', 'temperature', how='asof', tolerance=600, name='recent'))
+
+    incremental = aligner()
+    first = incremental.update(end=S + 600)
+    assert first['time'].tolist() == [S*1000]
+    frame = incremental.update(end=S + 1800)
+    once = aligner().update(end=S + 1800)
+
+    assert frame['time'].tolist() == [(S + i*600)*1000 for i in range(3)]
+    assert np.array_equal(frame['temperature'], [20.5, 20.5, 23.0])
+    # Without tolerance the sample from two hours before the start is carried into every update
+    assert np.array_equal(frame['outdoor'], [4.0, 4.0, 5.0])
+    assert np.array_equal(frame['recent'], [np.nan, np.nan, 5.0], equal_nan=True)
+    for name in frame:
+        assert np.array_equal(frame[name], once[name], equal_nan=True)
+
+
+def test_recompute_picks_up_late_samples(reader, tmp_path):
+    aligner = Aligner(reader, frequency=600, start=S).add('sensibo', 'Room', 'temperature', aggregation='count')
+    assert aligner.update(end=S + 1800)['temperature'].tolist() == [2, 0, 1]
+    _store(tmp_path, 'sensibo', 'Room', [(S + 700, 22.0)])
+    reader.refresh_index()
+    aligner.recompute(S + 600)
+    assert aligner.update(end=S + 1800)['temperature'].tolist() == [2, 1, 1]
+
+
+def test_resample_asof_and_fill():
+    times = np.array([0, 100, 250, 900], dtype=np.int64)
+    values = np.array([1.0, 3.0, np.nan, 7.0])
+    assert np.array_equal(resample(times, values, 0, 300, 4, 'mean'), [2.0, np.nan, np.nan, 7.0], equal_nan=True)
+    assert np.array_equal(resample(times, values, 0, 300, 4, 'count'), [2, 0, 0, 1])
+    assert np.array_equal(asof(times, values, np.array([-1, 260, 950]), tolerance=200), [np.nan, 3.0, 7.0], equal_nan=True)
+    gaps = np.array([1.0, np.nan, np.nan, np.nan, 5.0])
+    assert np.array_equal(fill(gaps, 'ffill', limit=2), [1, 1, 1, np.nan, 5], equal_nan=True)
+    assert np.array_equal(fill(gaps, 'interpolate'), [1, 2, 3, 4, 5])
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+
+import pytz
+
+from data_mining.data_sources import Sensor
+from data_mining.storage import TimeSeriesStore
+from data_mining.storage.writer import StorageWriter
+
+
+class HistorySensor(Sensor):
+    ''' A sensor with one device, stored samples every 10 minutes except a gap, and an api history covering it '''
+    sensor_name = 'history'
+    sampling_time = 600
+    end_mining_at = None
+
+    def __init__(self, history, **kwargs):
+        self.data = TimeSeriesStore({'temperature': 'float'})
+        self.history = history
+        self.append_threads = []
+        super().__init__(**kwargs)
+        append = self._storage.append
+
+        def recording_append(rows):
+            self.append_threads.append(threading.current_thread().name)
+            return append(rows)
+        self._storage.append = recording_append
+
+    def _backfill_devices(self):
+        return ['pod']
+
+    async def _fetch_history(self, gaps):
+        return self.history
+
+
+def _rows(times):
+    return [{'device': 'pod', 'time': datetime.fromtimestamp(t, tz=pytz.utc), 'values': {'temperature': 20.0}}
+            for t in times]
+
+
+def test_backfill_goes_through_the_storage_writer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    now = (int(time.time()) // 600)*600
+    stored = [now - 7*24*3600 + i*600 for i in range(1, 7*24*6)]
+    gap = [t for t in stored if now - 6*3600 < t < now - 3*3600]
+    stored = [t for t in stored if t not in gap]
+
+    async def main():
+        writer = StorageWriter(flush_interval=0.05)
+        sensor = HistorySensor(_rows(gap), writer=writer)
+        for row in _rows(stored):
+            sensor._record(row['device'], row['time'], row['values'])
+        await sensor._store()
+        added = await sensor.backfill()
+        await sensor._close_storage()
+        await writer.close()
+        return sensor, added
+
+    sensor, added = asyncio.run(main())
+    assert added == len(gap)
+    assert set(sensor.append_threads) == {'storage-writer_0'}
+    times = sensor._storage.read('pod')['time']//1000
+    assert times.tolist() == sorted(stored + gap)
@@ -0,0 +1,52 @@
+import os
+
+from data_mining.backup import BackupStore
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def _files(folder):
+    return {str(path.relative_to(folder)): path.read_bytes() for path in sorted(folder.glob('**/*')) if path.is_file()}
+
+
+def test_snapshot_and_restore(tmp_path):
+    data = tmp_path / 'data'
+    _write(data / 'sensibo' / 'log' / 'a.seg', b'x'*96)
+    _write(data / 'weather' / 'log' / 'b.seg', b'y'*10)
+    store = BackupStore(tmp_path / 'backups', chunk_size=32)
+    first = store.snapshot(data)
+
+    # Appending only adds the chunks of the new data, the unchanged file is not read again
+    with open(data / 'sensibo' / 'log' / 'a.seg', 'ab') as f:
+        f.write(b'z'*32)
+    os.utime(data / 'sensibo' / 'log' / 'a.seg', (1, 1))
+    chunks = len(list(store.chunk_folder.glob('*/*')))
+    second = store.snapshot(data)
+    assert len(list(store.chunk_folder.glob('*/*'))) == chunks + 1
+    assert store.snapshots() == [first, second]
+
+    assert store.restore(tmp_path / 'restored') == 2
+    assert _files(tmp_path / 'restored') == _files(data)
+    store.restore(tmp_path / 'first', snapshot=first)
+    assert (tmp_path / 'first' / 'sensibo' / 'log' / 'a.seg').read_bytes() == b'x'*96
+
+
+def test_retention_removes_unreferenced_chunks(tmp_path):
+    data = tmp_path / 'data'
+    store = BackupStore(tmp_path / 'backups', chunk_size=16)
+    for i in range(3):
+        _write(data / 'file', bytes([i])*16)
+        os.utime(data / 'file', (i + 1, i + 1))
+        store.snapshot(data, max_copies=2)
+    assert len(store.snapshots()) == 2
+    # The chunk of the first snapshot is gone, the two kept snapshots restore
+    assert len(list(store.chunk_folder.glob('*/*'))) == 2
+    store.restore(tmp_path / 'restored', snapshot=store.snapshots()[0])
+    assert (tmp_path / 'restored' / 'file').read_bytes() == bytes([1])*16
+
+
+def test_missing_object_is_not_backed_up(tmp_path):
+    assert BackupStore(tmp_path / 'backups').snapshot(tmp_path / 'nothing') is None
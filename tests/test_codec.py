@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from data_mining.storage.codec import (
+    encode_timestamps, decode_timestamps, encode_floats, decode_floats, encode_runs, decode_runs,
+    encode_block, decode_block)
+
+T0 = 1760000000  # epoch seconds
+
+
+def test_timestamps_roundtrip():
+    times = np.array([T0*1000 + i*60000 for i in range(100)] + [T0*1000 + 6_000_123, T0*1000 + 7_000_000], dtype=np.int64)
+    assert np.array_equal(decode_timestamps(encode_timestamps(times), len(times)), times)
+    assert len(decode_timestamps(encode_timestamps(times[:1]), 1)) == 1
+
+
+@pytest.mark.parametrize('values', [
+    [21.5, 21.5, 21.6, np.nan, 22.0, -0.0, -3.25],     # decimal encoding, missing values and -0.0
+    [np.pi, np.e, 1/3, np.nan, 1e300, -1e-300],          # XOR encoding
+    [np.nan, np.nan],
+])
+def test_floats_roundtrip(values):
+    values = np.array(values, dtype=np.float64)
+    decoded = decode_floats(encode_floats(values), len(values))
+    assert np.array_equal(decoded, values, equal_nan=True)
+    assert np.array_equal(np.signbit(decoded), np.signbit(values))
+
+
+def test_runs_roundtrip():
+    codes = np.array([0, 0, 0, 1, 1, -1, 2, 2, 2, 2], dtype=np.int32)
+    assert np.array_equal(decode_runs(encode_runs(codes), len(codes), np.int32), codes)
+    with pytest.raises(ValueError):
+        decode_runs(encode_runs(codes), len(codes) + 1, np.int32)
+
+
+def test_block_roundtrip():
+    schema = {'temperature': 'float', 'on': 'bool', 'mode': 'category'}
+    times = np.arange(10, dtype=np.int64)*90_000 + T0*1000
+    columns = {
+        'temperature': np.linspace(20, 22, 10).round(1),
+        'on': np.array([1, 1, 0, 0, -1, 1, 1, 1, 0, 0], dtype=np.int8),
+        'mode': np.array([0, 0, 0, 1, 1, 1, -1, 2, 2, 2], dtype=np.int32),
+    }
+    decoded = decode_block(encode_block(times, columns, schema), schema)
+    assert np.array_equal(decoded['time'], times)
+    for name in schema:
+        assert np.array_equal(decoded[name], columns[name])
+    assert set(decode_block(encode_block(times, columns, schema), schema, columns=['on'])) == {'time', 'on'}
@@ -0,0 +1,60 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from data_mining.storage.backend import StorageBackend
+from data_mining.storage.compaction import Compactor
+from data_mining.storage.segment_log import SegmentLog, read_frames
+
+T0 = 1760000000  # epoch seconds, 2025-10-09
+SCHEMA = {'temperature': 'float'}
+
+
+def _rows(device, start, count, temperature=20.0):
+    return [{'device': device, 'time': T0 + i*60, 'values': {'temperature': temperature + i}}
+            for i in range(start, start + count)]
+
+
+def test_segments_of_closed_days_are_merged(tmp_path):
+    # Two sessions wrote overlapping rows (a restart re-polled the same measurements), the second one wins
+    for session, rows in [('first', _rows('a', 0, 5) + _rows('b', 0, 2)), ('second', _rows('a', 3, 4, temperature=30.0))]:
+        log = SegmentLog(tmp_path / 'log', 'sensor', session)
+        log.append(rows)
+        log.close()
+
+    stats = Compactor(tmp_path, 'sensor', settle_time=0).compact(today=date(2025, 10, 10))
+    assert stats == {'days': 1, 'files': 2, 'rows': 9, 'duplicates': 2}
+    [path] = SegmentLog(tmp_path / 'log', 'sensor', 'reader').segments()
+    assert path.name == 'sensor_2025-10-09__compacted.seg'
+    rows = read_frames(path)[0]
+    assert [row['time'] for row in rows] == sorted(row['time'] for row in rows)
+    assert [row['values']['temperature'] for row in rows if row['device'] == 'a'] == [20, 21, 22, 33, 34, 35, 36]
+
+    # Nothing new since: the day is left alone
+    assert Compactor(tmp_path, 'sensor', settle_time=0).compact(today=date(2025, 10, 10))['days'] == 0
+
+
+def test_open_and_recent_fragments_are_left_for_the_next_run(tmp_path):
+    log = SegmentLog(tmp_path / 'log', 'sensor', 'open')
+    log.append(_rows('a', 0, 3))
+    compactor = Compactor(tmp_path, 'sensor', settle_time=0, open_segments=log.open_segments)
+    assert compactor.compact(today=date(2025, 10, 10))['days'] == 0
+    log.close()
+    assert Compactor(tmp_path, 'sensor').compact(today=date(2025, 10, 10))['days'] == 0
+    assert Compactor(tmp_path, 'sensor', settle_time=0).compact(today=date(2025, 10, 10))['days'] == 1
+
+
+@pytest.mark.parametrize('format', ['npz', 'parquet'])
+def test_sealed_files_are_merged(tmp_path, format):
+    for session, rows in [('first', _rows('a', 0, 5)), ('second', _rows('a', 3, 4, temperature=30.0))]:
+        storage = StorageBackend(tmp_path, 'sensor', session, SCHEMA, format=format, rollups=False)
+        storage.append(rows)
+        storage.close()
+    storage = StorageBackend(tmp_path, 'sensor', 'reader', SCHEMA, format=format, rollups=False)
+    assert len(storage.columnar_files()) == 2
+
+    stats = storage.compact(settle_time=0)
+    assert stats['files'] == 2 and stats['duplicates'] == 2
+    assert [path.name for path in storage.columnar_files()] == [f'sensor_2025-10-09__compacted.{format}']
+    assert np.array_equal(storage.read('a')['temperature'], [20, 21, 22, 33, 34, 35, 36])
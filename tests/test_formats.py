@@ -0,0 +1,86 @@
+import os
+import pickle
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import data_mining.storage.formats as formats
+from data_mining.storage.formats import convert_pickle_tree, get_format, write_columnar
+from data_mining.storage.reader import DataReader
+
+T0 = 1760000000  # epoch seconds
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.parametrize('format', ['npz', 'parquet', 'gorilla'])
+def test_columnar_roundtrip(tmp_path, format):
+    schema = {'temperature': 'float', 'on': 'bool', 'mode': 'category'}
+    rows = [{'device': device, 'time': T0 + i*90, 'values': {
+        'temperature': 20 + i/10 if i != 3 else None, 'on': i % 2 == 0, 'mode': ['heat', 'cool'][i % 2]}}
+        for i in range(6) for device in ['a', 'b']]
+    columnar_format = get_format(format)
+    path = write_columnar(tmp_path / f'sensor_2025-10-09__s{columnar_format.suffix}', rows, schema, columnar_format)
+    assert [path.name for path in tmp_path.iterdir()] == [path.name]
+
+    data = columnar_format.read(path, 'b', ['temperature', 'mode'])
+    assert set(data) == {'time', 'temperature', 'mode'}
+    assert np.array_equal(data['time'], [(T0 + i*90)*1000 for i in range(6)])
+    assert np.array_equal(data['temperature'], [20, 20.1, 20.2, np.nan, 20.4, 20.5], equal_nan=True)
+    assert list(data['mode']) == ['heat', 'cool']*3
+    assert columnar_format.read(path, 'c') is None
+    assert [device['name'] for device in columnar_format.meta(path)['devices']] == ['a', 'b']
+
+
+def test_columnar_file_is_synced_before_and_after_the_rename(tmp_path, monkeypatch):
+    calls = []
+    fsync, replace = os.fsync, os.replace
+
+    def recording_fsync(descriptor):
+        calls.append(('fsync', os.readlink(f'/proc/self/fd/{descriptor}')))
+        fsync(descriptor)
+
+    def recording_replace(source, target):
+        calls.append(('replace', str(target)))
+        replace(source, target)
+    monkeypatch.setattr(formats.os, 'fsync', recording_fsync)
+    monkeypatch.setattr(formats.os, 'replace', recording_replace)
+
+    rows = [{'device': 'a', 'time': T0, 'values': {'temperature': 20.0}}]
+    path = write_columnar(tmp_path / 'sensor_2025-10-09__s.parquet', rows, {'temperature': 'float'}, get_format('parquet'))
+    assert calls == [('fsync', str(path) + '.tmp'), ('replace', str(path)), ('fsync', str(tmp_path))]
+
+
+def test_convert_pickle_tree(data_folder):
+    times = [datetime(2026, 10, 2, 10, minute, tzinfo=timezone.utc) for minute in range(3)]
+    sensibo = data_folder / 'data' / 'sensibo' / 'daily'
+    weather = data_folder / 'data' / 'weather' / 'daily'
+    sensibo.mkdir(parents=True)
+    weather.mkdir(parents=True)
+    # Every old pickle held the full session history, so rows repeat across files
+    for session in ['a', 'b']:
+        with open(sensibo / f'sensibo_2026-10-02__{session}.pkl', 'wb') as f:
+            pickle.dump({'data': {'Room': {
+                'times': times, 'measurements': {'temperature': [21.0, 21.5, 22.0]}, 'states': {'on': [True, True, False]}
+            }}}, f)
+    (sensibo / 'sensibo_2026-10-02__corrupt.pkl').write_bytes(b'not a pickle')
+    with open(weather / 'weather_2026-10-02__a.pkl', 'wb') as f:
+        pickle.dump({'data': {'time': times, 'temperature': 4.5}}, f)
+
+    convert_pickle_tree('data', 'npz', remove=True, params={'weather': {'lat': '63.4', 'lon': '10.335'}})
+
+    # Converted pickles are removed, the one that could not be loaded is kept
+    assert [path.name for path in sensibo.iterdir()] == ['sensibo_2026-10-02__corrupt.pkl']
+    assert list(weather.iterdir()) == []
+    reader = DataReader('data')
+    room = reader.read('sensibo', 'Room')
+    assert np.array_equal(room['time'], [int(t.timestamp()*1000) for t in times])
+    assert np.array_equal(room['temperature'], [21.0, 21.5, 22.0])
+    assert list(room['on']) == [True, True, False]
+    assert reader.devices('weather') == ['63.4,10.335']
+    assert np.array_equal(reader.read('weather', '63.4,10.335')['temperature'], [np.nan, np.nan, 4.5], equal_nan=True)
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+import data_mining.data_sources as data_sources
+from data_mining.data_sources import TibberAPI, TibberRealtimeSensor
+from data_mining.data_sources.resilience import Resilience
+from data_mining.data_sources.realtime import Downsampler
+
+
+class FakeHome():
+    def __init__(self, home_id, real_time):
+        self.home_id = home_id
+        self.has_real_time_consumption = None      # like pyTibber, unknown until the home is looked up
+        self._real_time = real_time
+
+    async def update_real_time_consumption_enabled(self):
+        self.has_real_time_consumption = self._real_time
+
+
+class FakeTibber():
+    def __init__(self, homes):
+        self.homes = homes
+
+    async def update_info(self):
+        pass
+
+    def get_homes(self):
+        return self.homes
+
+
+class FakeSession():
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_tibber(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    session = FakeSession()
+    homes = []
+    monkeypatch.setattr(data_sources, 'open_tibber_connection', lambda api_key: (FakeTibber(homes), session))
+    return homes, session
+
+
+def test_real_time_homes_are_looked_up_per_home(fake_tibber):
+    homes, session = fake_tibber
+    homes += [FakeHome('pulse', True), FakeHome('plain', False)]
+    sensor = TibberRealtimeSensor('key')
+    assert sensor.home_ids is None
+    assert asyncio.run(sensor._get_real_time_homes()) == ['pulse']
+    assert session.closed
+    assert sensor.metadata.get() == ['pulse']
+    sensor._storage.close()
+
+
+def test_no_real_time_homes_are_not_cached(fake_tibber):
+    homes, _ = fake_tibber
+    homes.append(FakeHome('plain', False))
+    sensor = TibberRealtimeSensor('key')
+    assert asyncio.run(sensor._get_real_time_homes()) == []
+    assert sensor.metadata.get() is None
+    # A home that gets a Pulse later is found by the next lookup
+    homes.append(FakeHome('pulse', True))
+    assert asyncio.run(sensor._get_real_time_homes()) == ['pulse']
+    sensor._storage.close()
+
+
+def test_downsampler_aggregates_complete_intervals():
+    downsampler = Downsampler(60)
+    assert downsampler.add(0, 100.0) == []
+    assert downsampler.add(30, 300.0) == []
+    assert downsampler.add(59, None) == []
+    assert downsampler.add(61, 50.0) == [{'time': 0, 'mean': 200.0, 'min': 100.0, 'max': 300.0, 'count': 2}]
+    assert downsampler.add(10, 1000.0) == []        # late reading of a written interval
+    assert downsampler.flush() == [{'time': 60, 'mean': 50.0, 'min': 50.0, 'max': 50.0, 'count': 1}]
+    assert downsampler.flush() == []
+
+
+class FlakyTibber(FakeTibber):
+    def __init__(self, homes, failures):
+        super().__init__(homes)
+        self.failures = failures
+
+    async def update_info(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('Tibber is down')
+
+
+class FakeHistoryHome(FakeHome):
+    info = {'viewer': {'home': {'appNickname': 'Home'}}}
+
+    async def update_info(self):
+        pass
+
+    async def get_historic_data(self, n, resolution):
+        return [{'from': '2026-10-18T10:00:00+02:00', 'consumption': 1.5, 'cost': 3.0, 'totalCost': 3.5}]
+
+
+def test_tibber_connects_again_while_it_has_no_homes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tibber = FlakyTibber([FakeHistoryHome('home', False)], failures=1)
+    sessions = []
+
+    def open_connection(api_key):
+        sessions.append(FakeSession())
+        return tibber, sessions[-1]
+    monkeypatch.setattr(data_sources, 'open_tibber_connection', open_connection)
+
+    async def main():
+        sensor = TibberAPI('key', 3600, resilience=Resilience('tibber', max_retries=0))
+        connected = await sensor._connect()
+        first = await sensor._get_latest_measurement()
+        second = await sensor._get_latest_measurement()
+        await sensor._close_connection()
+        sensor._storage.close()
+        return sensor, connected, first, second
+
+    sensor, connected, first, second = asyncio.run(main())
+    assert (connected, first, second) == (False, True, True)
+    assert [home.home_id for home in sensor.homes] == ['home']
+    assert len(sessions) == 2 and all(session.closed for session in sessions)
+    assert [row['device'] for row in sensor._pending_rows] == ['Home', 'Home']
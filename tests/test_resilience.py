@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from data_mining.data_sources.resilience import (
+    Resilience, CircuitBreaker, CircuitOpenError, HTTPStatusError, TokenBucket, is_transient, retry_after)
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Upstream():
+    ''' Fails with the given errors in turn, then answers '''
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def test_circuit_breaker_opens_and_probes():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    # Half-open after reset_timeout: one probe, whose failure opens the circuit again
+    clock.now = 60
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    clock.now = 120
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow() and breaker.failures == 0
+
+
+def test_transient_errors_are_retried():
+    resilience = Resilience('test', max_retries=3, backoff_base=0)
+    upstream = Upstream(HTTPStatusError(503), asyncio.TimeoutError())
+    assert asyncio.run(resilience.call(upstream)) == 'ok'
+    assert upstream.calls == 3 and resilience.retries == 2
+    assert resilience.breaker.state == 'closed'
+
+
+def test_client_errors_are_not_retried():
+    resilience = Resilience('test', max_retries=3, backoff_base=0, failure_threshold=1)
+    upstream = Upstream(HTTPStatusError(401))
+    with pytest.raises(HTTPStatusError):
+        asyncio.run(resilience.call(upstream))
+    assert upstream.calls == 1
+    # The api answered, so the circuit stays closed
+    assert resilience.breaker.state == 'closed'
+
+
+def test_open_circuit_rejects_calls():
+    resilience = Resilience('test', max_retries=5, backoff_base=0, failure_threshold=2)
+    upstream = Upstream(*[HTTPStatusError(502)]*3)
+    with pytest.raises(HTTPStatusError):
+        asyncio.run(resilience.call(upstream))
+    assert upstream.calls == 2
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(resilience.call(upstream))
+    assert upstream.calls == 2 and resilience.rejected == 1
+
+
+def test_retry_after_and_transient_statuses():
+    assert retry_after(HTTPStatusError(429, {'Retry-After': '7'})) == 7
+    assert retry_after(HTTPStatusError(429, {'Retry-After': 'Thu, 01 Jan 1970 00:00:00 GMT'})) == 0
+    assert retry_after(HTTPStatusError(503)) is None
+    assert is_transient(HTTPStatusError(429)) and is_transient(HTTPStatusError(500))
+    assert not is_transient(HTTPStatusError(404)) and not is_transient(ValueError())
+
+
+def test_token_bucket_limits_the_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=2, clock=clock)
+    assert [bucket.reserve() for _ in range(4)] == [0, 0, 0.5, 1.0]
+    clock.now = 10
+    bucket.pause(3)
+    assert bucket.reserve() == 3
@@ -0,0 +1,44 @@
+import pytest
+
+from data_mining.storage.backend import StorageBackend
+
+T0 = 1760000000  # epoch seconds
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _rows(device, times, temperature):
+    return [{'device': device, 'time': t, 'values': {'temperature': temperature(t), 'on': True}} for t in times]
+
+
+def test_rollups_count_every_row_once(data_folder):
+    schema = {'temperature': 'float', 'on': 'bool'}
+    storage = StorageBackend('data/sensor', 'sensor', 'first', schema)
+    times = [T0 + i*600 for i in range(12)]
+    rows = _rows('d', times, lambda t: (t - T0)/600)
+    storage.append(rows[:6])
+    storage.append(rows[3:6])                                    # a retried write
+    storage.append(rows[6:])
+    storage.append(rows[8:10])                                   # a re-polled hour
+    storage.append(_rows('d', [T0 - 30*3600 + i*600 for i in range(3)], lambda t: 100.0))   # backfill
+
+    def check(storage):
+        for granularity in ['hour', 'day', 'week', 'month']:
+            rollup = storage.read_rollup('d', 'temperature', granularity)
+            assert rollup['count'].sum() == 15
+            assert rollup['sum'].sum() == sum(range(12)) + 300
+            assert storage.read_rollup('d', 'on', granularity)['sum'].sum() == 15
+        assert storage.read_rollup('d', 'temperature', 'month')['max'].max() == 100
+
+    check(storage)
+    storage.close()
+    # Loaded from the rollup log, and rebuilt from the stored rows (duplicates included)
+    storage = StorageBackend('data/sensor', 'sensor', 'second', schema)
+    check(storage)
+    storage.rebuild_rollups()
+    check(storage)
+    storage.close()
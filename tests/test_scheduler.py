@@ -0,0 +1,80 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from data_mining.scheduler import Scheduler, AcceleratedClock, LOCAL_TIMEZONE
+
+MINUTE = 60
+HOUR = 60*MINUTE
+
+
+def local(*args):
+    return LOCAL_TIMEZONE.localize(datetime(*args))
+
+
+def _run_overrunning_job(policy):
+    # 10 min ticks from 00:10 to 00:50, the first run takes 25 min (virtual) and overruns the 00:20 and 00:30 ticks
+    midnight = local(2026, 10, 18).timestamp()
+    clock = AcceleratedClock(speed=3600, start=midnight + 10)
+    scheduler = Scheduler(clock)
+    ticks = []
+
+    async def callback(scheduled_time):
+        ticks.append(scheduled_time.strftime('%H:%M'))
+        if len(ticks) == 1:
+            await clock.sleep(25*MINUTE)
+        return True
+
+    job = asyncio.run(scheduler.run_job('job', 10*MINUTE, callback, missed_tick_policy=policy,
+                                        end_at=local(2026, 10, 18, 1, 0)))
+    return ticks, job
+
+
+@pytest.mark.parametrize('policy, expected_ticks, missed', [
+    ('skip', ['00:10', '00:40', '00:50'], 2),
+    ('coalesce', ['00:10', '00:30', '00:40', '00:50'], 1),
+    ('catch_up', ['00:10', '00:20', '00:30', '00:40', '00:50'], 0),
+])
+def test_missed_tick_policies(policy, expected_ticks, missed):
+    ticks, job = _run_overrunning_job(policy)
+    assert ticks == expected_ticks
+    assert job.missed_ticks == missed
+    assert job.runs == len(expected_ticks)
+    if policy != 'skip':
+        # The runs of missed ticks start late
+        assert job.max_lag > 4*MINUTE
+
+
+def test_ticks_restart_at_midnight():
+    scheduler = Scheduler()
+    # 7 min does not divide a day, the last tick of the day is 23:55 and the next one midnight
+    after = local(2026, 10, 18, 23, 56).timestamp()
+    assert scheduler.next_tick(after, 7*MINUTE) == local(2026, 10, 19).timestamp()
+    assert scheduler.next_tick(local(2026, 10, 19).timestamp() + 1, 7*MINUTE) == local(2026, 10, 19, 0, 7).timestamp()
+    # Offsets shift the grid of the day
+    assert scheduler.next_tick(after, 7*MINUTE, offset=30) == local(2026, 10, 19).timestamp() + 30
+
+
+@pytest.mark.parametrize('day, hours', [((2026, 3, 29), 23), ((2026, 10, 25), 25), ((2026, 10, 18), 24)])
+def test_hourly_ticks_across_dst_changes(day, hours):
+    scheduler = Scheduler()
+    tick = local(*day).timestamp()
+    ticks = []
+    while True:
+        tick = scheduler.next_tick(tick + 1e-3, HOUR)
+        if datetime.fromtimestamp(tick, tz=LOCAL_TIMEZONE).date() != datetime(*day).date():
+            break
+        ticks.append(datetime.fromtimestamp(tick, tz=LOCAL_TIMEZONE))
+    # Every tick of the day on a whole hour, one hour apart
+    assert len(ticks) == hours - 1
+    assert all(tick.minute == 0 and tick.second == 0 for tick in ticks)
+    assert all((b - a).total_seconds() == HOUR for a, b in zip(ticks, ticks[1:]))
+
+
+def test_long_intervals_use_the_epoch_grid():
+    scheduler = Scheduler()
+    interval = 2*24*HOUR
+    after = local(2026, 10, 18, 12).timestamp()
+    tick = scheduler.next_tick(after, interval)
+    assert tick % interval == 0 and after <= tick < after + interval
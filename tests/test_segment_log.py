@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+import data_mining.storage.segment_log as segment_log
+from data_mining.storage.segment_log import SegmentLog, encode_frame, read_frames
+
+T0 = 1760000000  # epoch seconds
+
+
+def _rows(start, count):
+    return [{'device': 'd', 'time': T0 + i*60, 'values': {'temperature': float(i)}} for i in range(start, start + count)]
+
+
+class TornWrite():
+    ''' Writes half of the data, then fails like a full disk '''
+    def __init__(self, handle):
+        self._handle = handle
+
+    def write(self, data):
+        self._handle.write(data[:len(data)//2])
+        raise OSError('No space left on device')
+
+    def fileno(self):
+        return self._handle.fileno()
+
+
+def _fail_next_append(log, monkeypatch):
+    get_handle = log._get_handle
+    monkeypatch.setattr(log, '_get_handle', lambda day: TornWrite(get_handle(day)))
+    return lambda: monkeypatch.setattr(log, '_get_handle', get_handle)
+
+
+def test_failed_append_is_rolled_back(tmp_path, monkeypatch):
+    log = SegmentLog(tmp_path, 'sensor', 'session')
+    log.append(_rows(0, 3))
+    restore = _fail_next_append(log, monkeypatch)
+    with pytest.raises(OSError):
+        log.append(_rows(3, 3))
+    restore()
+    log.append(_rows(3, 3))          # the retry of the storage writer
+    log.close()
+    records, valid_bytes = read_frames(log.segments()[0])
+    assert records == _rows(0, 6)
+    assert valid_bytes == log.segments()[0].stat().st_size
+
+
+def test_segment_that_can_not_be_rolled_back_is_rotated(tmp_path, monkeypatch):
+    log = SegmentLog(tmp_path, 'sensor', 'session')
+    log.append(_rows(0, 3))
+    restore = _fail_next_append(log, monkeypatch)
+
+    def ftruncate(descriptor, length):
+        raise OSError('Input/output error')
+    monkeypatch.setattr(segment_log.os, 'ftruncate', ftruncate)
+    with pytest.raises(OSError):
+        log.append(_rows(3, 3))
+    restore()
+    monkeypatch.setattr(segment_log.os, 'ftruncate', os.ftruncate)
+    log.append(_rows(3, 3))
+    log.close()
+    rotated, torn = log.segments()
+    assert rotated.name.endswith('__session-1.seg') and torn.name.endswith('__session.seg')
+    assert log.is_own_session('session') and log.is_own_session('session-1')
+    # Complete frames of the failed append stay in the torn segment (compaction and rollups count them once)
+    assert read_frames(torn)[0][:3] == _rows(0, 3)
+    assert read_frames(rotated)[0] == _rows(3, 3)
+    # The next session truncates the torn tail
+    SegmentLog(tmp_path, 'sensor', 'next')
+    assert read_frames(torn)[1] == torn.stat().st_size
+
+
+def test_segment_log_recover_truncates_torn_tail(tmp_path):
+    log = SegmentLog(tmp_path / 'log', 'sensor', 'crashed')
+    rows = [{'device': 'd', 'time': T0 + i*60, 'values': {'temperature': float(i)}} for i in range(5)]
+    log.append(rows)
+    log.close()
+    path = log.segments()[0]
+    with open(path, 'ab') as f:
+        f.write(encode_frame(rows[0])[:-3])     # a crash in the middle of a write
+
+    # The next session recovers the newest segment of the crashed one
+    SegmentLog(tmp_path / 'log', 'sensor', 'next')
+    records, valid_bytes = read_frames(path)
+    assert records == rows
+    assert valid_bytes == path.stat().st_size
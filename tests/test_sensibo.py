@@ -0,0 +1,105 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+import pytz
+
+from data_mining.benchmarks.fake_servers import FakeUpstream
+from data_mining.data_sources import SensiboSensor, UNCHANGED
+from data_mining.data_sources.http_client import AsyncHTTPClient
+from data_mining.data_sources.sensibo_client import SensiboClientAPI
+from data_mining.storage import StorageBackend
+
+
+class FixedClock():
+    def __init__(self, now):
+        self._now = now
+
+    def now(self):
+        return self._now
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    upstream = FakeUpstream(FixedClock(time.time()), pods=2, seed=1).start()
+    yield upstream
+    upstream.stop()
+
+
+def _sample_once(upstream):
+    async def main():
+        sensor = SensiboSensor('key', 600, None, server=upstream.sensibo_url)
+        try:
+            result = await sensor._get_latest_measurement()
+            if result is True:
+                await sensor._store()
+        finally:
+            await sensor._close_storage()
+            await sensor._owned_http_client.close()
+        return sensor, result
+    return asyncio.run(main())
+
+
+def test_restart_skips_the_stored_measurement(upstream):
+    first, result = _sample_once(upstream)
+    assert result is True
+    assert set(first._last_measurement_time) == {'Room 0', 'Room 1'}
+
+    requests = upstream.stats()['requests']
+    second, result = _sample_once(upstream)
+    assert second._last_measurement_time == first._last_measurement_time
+    assert result == UNCHANGED
+    # Only the two measurements were requested, no ac states
+    assert upstream.stats()['requests'] - requests == 2
+    assert len(second._storage.read('Room 0')['time']) == 1
+
+
+@pytest.mark.parametrize('format, rollups', [('segment', True), ('segment', False), ('npz', False)])
+def test_newest_times_in_one_pass(tmp_path, format, rollups):
+    day = 24*3600
+    now = time.time()
+    schema = {'temperature': 'float'}
+    rows = [
+        {'device': 'a', 'time': now - 3*day, 'values': {'temperature': 20.0}},
+        {'device': 'b', 'time': now - 2*day, 'values': {'temperature': 21.0}},
+        {'device': 'a', 'time': now - 2*day + 60, 'values': {'temperature': 22.0}},
+        {'device': 'c', 'time': now - 10*day, 'values': {'temperature': 23.0}},
+    ]
+    storage = StorageBackend(tmp_path, 'sensibo', 'session', schema, format=format, rollups=rollups)
+    storage.append(rows)
+    storage.close()
+
+    storage = StorageBackend(tmp_path, 'sensibo', 'restart', schema, format=format, rollups=rollups)
+    newest = storage.newest_times(['a', 'b', 'c', 'd'], now - 7*day)
+    assert newest == {'a': pytest.approx(now - 2*day + 60, abs=1e-3), 'b': pytest.approx(now - 2*day, abs=1e-3)}
+
+
+def test_client_closes_only_its_own_http_client(upstream):
+    async def main():
+        own = SensiboClientAPI('key', server=upstream.sensibo_url)
+        shared_client = AsyncHTTPClient()
+        shared = SensiboClientAPI('key', http_client=shared_client, server=upstream.sensibo_url)
+        for client in [own, shared]:
+            assert len(await client.async_devices()) == 2
+            await client.aclose()
+        assert own._http_client._session is None
+        assert not shared_client._session.closed
+        await shared_client.close()
+    asyncio.run(main())
+
+
+def test_sensor_closes_the_client_when_mining_ends(upstream):
+    async def main():
+        sensor = SensiboSensor('key', 600, datetime.now(tz=pytz.utc), server=upstream.sensibo_url)
+        closed = []
+        aclose = sensor.home.aclose
+
+        async def recording_aclose():
+            closed.append(True)
+            await aclose()
+        sensor.home.aclose = recording_aclose
+        await sensor.start_mining()
+        return closed
+    assert asyncio.run(main()) == [True]
@@ -0,0 +1,43 @@
+from datetime import date, datetime, timedelta
+
+import pytz
+
+from data_mining.data_sources import SpotMarketAPI
+from data_mining.data_sources.spot_prices import SpotPriceCache
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/Oslo')
+
+
+class FakeElspot():
+    ''' Nord Pool stand-in: 24 hourly prices per area, inf for days after `published_until` '''
+    def __init__(self, published_until):
+        self.published_until = published_until
+        self.requests = []
+
+    def hourly(self, end_date):
+        self.requests.append(end_date)
+        midnight = LOCAL_TIMEZONE.localize(datetime(end_date.year, end_date.month, end_date.day))
+        price = float('inf') if end_date > self.published_until else float(end_date.day)
+        return {'areas': {area: {'values': [{'start': midnight + timedelta(hours=hour), 'value': price}
+                                            for hour in range(24)]} for area in ['Tr.heim', 'Oslo']}}
+
+
+def test_every_published_day_is_requested_once(tmp_path):
+    cache = SpotPriceCache(tmp_path / 'cache')
+    cache.prices_api = FakeElspot(published_until=date(2026, 10, 2))
+    prices = cache.range(date(2026, 10, 1), date(2026, 10, 3), 'Tr.heim')
+    assert len(prices['time']) == 48 and set(prices['price']) == {1.0, 2.0}
+    assert len(cache.range(date(2026, 10, 1), date(2026, 10, 2), 'Oslo')['time']) == 48
+    # The unpublished day is requested again, the cached ones are not
+    assert cache.range(date(2026, 10, 3), date(2026, 10, 3), 'Tr.heim')['time'].size == 0
+    assert cache.prices_api.requests == [date(2026, 10, 1), date(2026, 10, 2), date(2026, 10, 3), date(2026, 10, 3)]
+
+
+def test_zones_are_not_shared(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = SpotMarketAPI(3600)
+    first.zones.append('Bergen')
+    second, third = SpotMarketAPI(3600), SpotMarketAPI(3600, zones='Oslo')
+    assert second.zones == ['Tr.heim'] and third.zones == ['Oslo']
+    for sensor in [first, second, third]:
+        sensor._storage.close()
@@ -0,0 +1,55 @@
+import numpy as np
+
+from data_mining.storage.backend import StorageBackend
+from data_mining.storage.sqlite_sink import SQLiteSink, SQLiteReader
+
+T0 = 1760000000  # epoch seconds
+SCHEMA = {'temperature': 'float', 'on': 'bool', 'mode': 'category'}
+
+
+def _rows(device, start, count, temperature=20.0):
+    return [{'device': device, 'time': T0 + i*60, 'values': {
+        'temperature': temperature + i if i != 2 else None, 'on': i % 2 == 0, 'mode': 'heat'}}
+        for i in range(start, start + count)]
+
+
+def test_sink_roundtrip(tmp_path):
+    sink = SQLiteSink(tmp_path / 'datamining.sqlite')
+    storage = StorageBackend(tmp_path / 'sensibo', 'sensibo', 'session', SCHEMA, rollups=False, sink=sink)
+    storage.append(_rows('Room', 0, 4) + _rows('Hall', 0, 1))
+    # A retried write replaces the samples it repeats
+    storage.append(_rows('Room', 3, 2, temperature=30.0))
+    storage.close()
+
+    reader = SQLiteReader(tmp_path / 'datamining.sqlite')
+    assert reader.sources() == ['sensibo']
+    assert reader.devices('sensibo') == ['Hall', 'Room']
+    assert reader.columns('sensibo') == SCHEMA
+    data = reader.read('sensibo', 'Room')
+    assert np.array_equal(data['time'], [(T0 + i*60)*1000 for i in range(5)])
+    # The missing temperature is not stored
+    assert np.array_equal(data['temperature'], [20, 21, np.nan, 33, 34], equal_nan=True)
+    assert list(data['on']) == [True, False, True, False, True]
+    assert list(data['mode']) == ['heat']*5
+
+    assert set(reader.read('sensibo', 'Room', T0 + 60, T0 + 180, columns=['on'])) == {'time', 'on'}
+    assert len(reader.read('sensibo', 'Room', T0 + 60, T0 + 180)['time']) == 2
+    assert len(reader.read('sensibo', 'Nowhere')['time']) == 0
+
+    times, values = reader.latest('sensibo', 'Room', 'temperature', before=T0 + 180)
+    assert times.tolist() == [(T0 + 60)*1000] and values.tolist() == [21.0]
+    assert len(reader.latest('sensibo', 'Room', 'temperature', before=T0)[0]) == 0
+    assert reader.query('SELECT COUNT(*) FROM samples')[0][0] == 3*5 - 1 + 3
+    reader.close()
+    sink.close()
+
+
+def test_reader_sees_committed_batches_while_writing(tmp_path):
+    sink = SQLiteSink(tmp_path / 'datamining.sqlite')
+    sink.write('weather', _rows('Oslo', 0, 1), SCHEMA)
+    reader = SQLiteReader(tmp_path / 'datamining.sqlite')
+    assert len(reader.read('weather', 'Oslo')['time']) == 1
+    sink.write('weather', _rows('Oslo', 1, 2), SCHEMA)
+    assert len(reader.read('weather', 'Oslo')['time']) == 3
+    reader.close()
+    sink.close()
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+
+import pytest
+
+from data_mining.storage.writer import StorageWriter
+
+
+class FakeStorage():
+    def __init__(self, sensor_name, fail=False):
+        self.sensor_name = sensor_name
+        self.fail = fail
+        self.appends = []
+        self.synced_in = []
+
+    def append(self, rows):
+        if self.fail:
+            raise OSError('No space left on device')
+        self.appends.append(list(rows))
+
+    def sync(self):
+        self.synced_in.append(threading.current_thread().name)
+
+
+def test_group_commit_writes_and_syncs_in_the_writer_thread():
+    async def main():
+        writer = StorageWriter(flush_interval=10)
+        sensibo, weather = FakeStorage('sensibo'), FakeStorage('weather')
+        futures = [
+            await writer.submit(sensibo, [1, 2]),
+            await writer.submit(weather, [3]),
+            await writer.submit(sensibo, [4]),
+        ]
+        await writer.flush()
+        results = [future.result() for future in futures]
+        await writer.close()
+        return sensibo, weather, results, writer.batches
+
+    sensibo, weather, results, batches = asyncio.run(main())
+    assert results == [2, 1, 1]
+    assert batches == 1
+    # One append and one fsync per storage and batch, rows in submission order
+    assert sensibo.appends == [[1, 2, 4]] and weather.appends == [[3]]
+    assert sensibo.synced_in == ['storage-writer_0'] and weather.synced_in == ['storage-writer_0']
+
+
+def test_failed_write_resolves_the_future_with_the_error():
+    async def main():
+        writer = StorageWriter(flush_interval=0.01)
+        future = await writer.submit(FakeStorage('sensibo', fail=True), [1])
+        await writer.flush()
+        await writer.close()
+        return future
+
+    with pytest.raises(OSError):
+        asyncio.run(main()).result()
+
+
+def test_flush_raises_when_the_writer_task_died():
+    async def main():
+        writer = StorageWriter(flush_interval=0.01)
+
+        async def broken_commit(batch):
+            raise RuntimeError('writer task crashed')
+        writer._commit = broken_commit
+        await writer.submit(FakeStorage('sensibo'), [1])
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(writer.flush(), timeout=5)
+        with pytest.raises(RuntimeError):
+            await writer.submit(FakeStorage('sensibo'), [2])
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(writer.close(), timeout=5)
+
+    asyncio.run(main())